@@ -34,6 +34,8 @@ V116.29 中文標題：處置消耗切分點與官方處置同步修正
 """
 
 import os
+import json
+import hashlib
 import twstock
 import yfinance as yf
 import pandas as pd
@@ -46,6 +48,7 @@ import gspread
 import logging
 import traceback
 import nest_asyncio
+from concurrent.futures import ThreadPoolExecutor
 from google.oauth2.service_account import Credentials
 from datetime import datetime, timedelta, time as dt_time, date
 from dateutil.relativedelta import relativedelta
@@ -61,6 +64,8 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from webdriver_manager.chrome import ChromeDriverManager
 
+from stock_common import fetch_twse_punish_json, load_ticker_registry, yahoo_suffix_candidates
+
 nest_asyncio.apply()
 
 # ==========================================
@@ -156,6 +161,32 @@ FINMIND_TOKENS = [t for t in [token1, token2] if t]
 CURRENT_TOKEN_INDEX = 0
 _FINMIND_CACHE = {}
 
+# ==========================================
+# Yahoo 股價執行期快取
+# ==========================================
+# 同一次執行中，技術追蹤與近30日熱門統計都會抓同一檔股票的日線；
+# 以「實際可用的 Yahoo 代號」為 key 快取一次涵蓋兩者需求的最大區間，
+# 並記住每檔股票最後成功的 .TW / .TWO 後綴，避免重複試錯。
+PRICE_HISTORY_LOOKBACK_DAYS = 365
+_PRICE_HISTORY_CACHE = {}
+_RESOLVED_TICKER_CACHE = {}
+
+# ==========================================
+# 處置股90日明細 增量同步
+# ==========================================
+# 本機快取目錄 (GitHub Actions 以 actions/cache 保留)；
+# 內含處置股90日明細副本與「已定案公布日」，下次只需重抓未定案的尾段。
+LOCAL_CACHE_DIR = os.getenv("STOCK_CACHE_DIR", ".stock_cache")
+JAIL_SYNC_STATE_FILE = os.path.join(LOCAL_CACHE_DIR, "jail_sync_state.json")
+JAIL_SHEET_TITLE = "處置股90日明細"
+JAIL_FULL_LOOKBACK_DAYS = 150
+# 公布日早於「今天 - N 日」的處置公告視為已定案，不會再變動
+JAIL_SETTLE_DAYS = 7
+
+# 代號→Yahoo 後綴對照表 (由 stock_holder_rank.py 每週依 ISIN 清單更新)
+TICKER_REGISTRY_SHEET_NAME = "股票市場對照"
+_TICKER_REGISTRY = {}
+
 print(f"啟動 V116.29 台股注意股系統 (修正處置消耗切分點 + 官方處置同步近30日熱門統計)")
 print(f"系統時間 (Taiwan): {TARGET_DATE.strftime('%Y-%m-%d %H:%M:%S')}")
 
@@ -262,6 +293,11 @@ def get_ticker_suffix(market_type):
     if any(k in m for k in keywords): return '.TWO'
     return '.TW'
 
+def resolve_ticker_suffix(code, market_type):
+    """優先以股票市場對照決定 Yahoo 後綴，對照表沒有的代號才依市場欄位判斷。"""
+    code = str(code).replace("'", "").strip()
+    return _TICKER_REGISTRY.get(code) or get_ticker_suffix(market_type)
+
 def connect_google_sheets():
     try:
         if not os.path.exists("service_key.json"): return None, None
@@ -474,12 +510,77 @@ def parse_jail_period(period_str):
             return sd, ed
     return None, None
 
-def get_jail_map_from_sheet(sh):
-    print("從 Google Sheet 讀取處置名單快取 (處置股90日明細)...")
+def load_jail_sync_state():
+    try:
+        with open(JAIL_SYNC_STATE_FILE, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        return state if isinstance(state, dict) else {}
+    except Exception:
+        return {}
+
+def save_jail_sync_state(state):
+    try:
+        os.makedirs(LOCAL_CACHE_DIR, exist_ok=True)
+        with open(JAIL_SYNC_STATE_FILE, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+    except Exception as e:
+        print(f"處置股同步狀態寫入失敗: {e}")
+
+def jail_rows_fingerprint(codes, periods):
+    """以「代號」與「處置期間」兩欄內容計算指紋 (忽略結尾空白列)，用來判斷本機副本是否與工作表一致。"""
+    n = max(len(codes), len(periods))
+    pairs = [(str(codes[i] if i < len(codes) else "").strip(), str(periods[i] if i < len(periods) else "").strip())
+             for i in range(n)]
+    while pairs and pairs[-1] == ("", ""):
+        pairs.pop()
+    return hashlib.sha1("\n".join(f"{c}\t{p}" for c, p in pairs).encode("utf-8")).hexdigest()
+
+def load_jail_table_rows(ws_jail, state):
+    """
+    取得處置股90日明細 (不含標題列)，回傳 (rows, from_local)。
+    只讀「代號」「處置期間」兩欄 (一次 batch_get)，與本機副本指紋相同時直接使用副本；
+    手動修正或筆數相同的替換都會讓指紋不同，改為整張重讀。
+    """
+    local_rows = state.get("rows")
+    if isinstance(local_rows, list) and local_rows:
+        try:
+            code_col, period_col = ws_jail.batch_get(["B2:B", "D2:D"])
+            sheet_fp = jail_rows_fingerprint([r[0] if r else "" for r in code_col],
+                                             [r[0] if r else "" for r in period_col])
+        except Exception as e:
+            print(f"處置股明細指紋讀取失敗: {e}")
+            sheet_fp = None
+        local_fp = jail_rows_fingerprint([r[1] if len(r) > 1 else "" for r in local_rows],
+                                         [r[3] if len(r) > 3 else "" for r in local_rows])
+        if sheet_fp == local_fp:
+            print(f"使用本機處置股副本 ({len(local_rows)} 筆)，略過整張讀取。")
+            return local_rows, True
+        print(f"本機處置股副本與工作表內容不一致 ({len(local_rows)} 筆)，改為整張重讀。")
+
+    values = ws_jail.get_all_values()
+    return (values[1:] if len(values) > 1 else []), False
+
+def get_jail_crawl_start(state, from_local):
+    """有可信的本機副本時，只從「已定案公布日」開始重抓；否則抓完整 150 日。"""
+    full_start = TARGET_DATE.date() - timedelta(days=JAIL_FULL_LOOKBACK_DAYS)
+    if not from_local:
+        return full_start
+    try:
+        settled = datetime.strptime(state.get("settled_date", ""), "%Y-%m-%d").date()
+    except Exception:
+        return full_start
+    return max(full_start, settled)
+
+def get_jail_map_from_sheet(sh, all_jail_data=None):
     jail_map = {}
     try:
-        ws = sh.worksheet("處置股90日明細")
-        rows = ws.get_all_records()
+        if all_jail_data and len(all_jail_data) > 1:
+            print("使用本次同步的處置股90日明細建立處置名單...")
+            rows = [{'代號': r[1], '處置期間': r[3]} for r in all_jail_data[1:] if len(r) >= 4]
+        else:
+            print("從 Google Sheet 讀取處置名單快取 (處置股90日明細)...")
+            ws = sh.worksheet(JAIL_SHEET_TITLE)
+            rows = ws.get_all_records()
         for r in rows:
             code = str(r.get('代號', '')).strip()
             if not code:
@@ -1496,13 +1597,65 @@ def get_daytrade_stats_finmind(stock_id, target_date_str):
         return round(td, 2), round(avg_td, 2)
     except: return None, None
 
-def fetch_history_data(ticker_code):
-    try:
-        df = yf.Ticker(ticker_code).history(period="1y", auto_adjust=False)
-        if df.empty: return pd.DataFrame()
-        df.index = df.index.tz_localize(None)
-        return df
-    except: return pd.DataFrame()
+def _yahoo_ticker_candidates(code, market):
+    """回傳 Yahoo 代號候選清單；已解析過的股票只回傳單一代號，股票市場對照中的股票以對照後綴優先。"""
+    code = str(code).replace("'", "").strip()
+    resolved = _RESOLVED_TICKER_CACHE.get(code)
+    if resolved:
+        return [resolved]
+    return [f"{code}{s}" for s in yahoo_suffix_candidates(code, _TICKER_REGISTRY, get_ticker_suffix(market))]
+
+
+def get_price_history(code, market, start_date=None):
+    """
+    執行期共用的 Yahoo 日線快取 (auto_adjust=False, 去除時區)。
+    一次抓取「近一年」與 start_date 兩者較早者到今天+2 日的區間，
+    回傳 (df, ticker)；df 為快取本體，呼叫端若要修改請自行 copy。
+    """
+    code = str(code).replace("'", "").strip()
+    need_start = TARGET_DATE.date() - timedelta(days=PRICE_HISTORY_LOOKBACK_DAYS)
+    if start_date is not None and start_date < need_start:
+        need_start = start_date
+    fetch_end = TARGET_DATE.date() + timedelta(days=2)
+
+    candidates = _yahoo_ticker_candidates(code, market)
+    ticker = candidates[0]
+    for ticker in candidates:
+        cached = _PRICE_HISTORY_CACHE.get(ticker)
+        if cached is not None and cached['start'] <= need_start:
+            if not cached['df'].empty:
+                return cached['df'], ticker
+            # 已確認此代號在這個區間無資料，不再重抓
+            continue
+        try:
+            raw_df = yf.Ticker(ticker).history(
+                start=need_start.strftime("%Y-%m-%d"),
+                end=fetch_end.strftime("%Y-%m-%d"),
+                auto_adjust=False
+            )
+            if raw_df is None or raw_df.empty:
+                _PRICE_HISTORY_CACHE[ticker] = {'start': need_start, 'df': pd.DataFrame()}
+                continue
+            df = raw_df.copy()
+            if getattr(df.index, 'tz', None) is not None:
+                df.index = df.index.tz_localize(None)
+            df = df.sort_index()
+            _PRICE_HISTORY_CACHE[ticker] = {'start': need_start, 'df': df}
+            _RESOLVED_TICKER_CACHE[code] = ticker
+            return df, ticker
+        except Exception as e:
+            print(f"Yahoo 股價抓取失敗 ({ticker}): {e}")
+
+    return pd.DataFrame(), ticker
+
+
+def fetch_history_data(code, market):
+    """近一年日線 (供 calculate_full_risk 使用)，回傳 (df, 實際使用的 Yahoo 代號)。"""
+    df, ticker = get_price_history(code, market)
+    if df.empty:
+        return pd.DataFrame(), ticker
+    one_year_ago = pd.Timestamp(TARGET_DATE.date() - timedelta(days=PRICE_HISTORY_LOOKBACK_DAYS))
+    return df[df.index >= one_year_ago].copy(), ticker
 
 def _safe_round(v, ndigits=2):
     try:
@@ -1514,13 +1667,8 @@ def _safe_round(v, ndigits=2):
 
 
 def _fetch_technical_history(code, market, start_date, end_date):
-    """抓取技術追蹤用股價資料；以 Yahoo Finance 日線資料計算 MA20。"""
+    """抓取技術追蹤用股價資料；以 Yahoo Finance 日線資料計算 MA20 (共用執行期股價快取)。"""
     code = str(code).replace("'", "").strip()
-    suffix = get_ticker_suffix(market)
-    primary_ticker = f"{code}{suffix}"
-    fallback_suffix = ".TWO" if suffix == ".TW" else ".TW"
-    fallback_ticker = f"{code}{fallback_suffix}"
-    source_label = f"Yahoo:{primary_ticker}"
 
     def _clean_yahoo_history(raw_df):
         if raw_df is None or raw_df.empty:
@@ -1551,22 +1699,15 @@ def _fetch_technical_history(code, market, start_date, end_date):
         df = df.sort_index()
         return df
 
-    for ticker in [primary_ticker, fallback_ticker]:
-        try:
-            source_label = f"Yahoo:{ticker}"
-            raw_df = yf.Ticker(ticker).history(
-                start=start_date.strftime("%Y-%m-%d"),
-                end=end_date.strftime("%Y-%m-%d"),
-                auto_adjust=False
-            )
-            df = _clean_yahoo_history(raw_df)
-            if not df.empty:
-                return df, source_label
-            print(f"技術追蹤 Yahoo 無可用股價資料 ({source_label})")
-        except Exception as e:
-            print(f"技術追蹤 Yahoo 股價抓取失敗 ({source_label}): {e}")
+    raw_df, ticker = get_price_history(code, market, start_date)
+    source_label = f"Yahoo:{ticker}"
+    df = _clean_yahoo_history(raw_df)
+    if df.empty:
+        print(f"技術追蹤 Yahoo 無可用股價資料 ({source_label})")
+        return pd.DataFrame(), source_label
 
-    return pd.DataFrame(), source_label
+    df = df[(df.index.date >= start_date) & (df.index.date < end_date)].copy()
+    return df, source_label
 
 
 # ===========================================================================
@@ -2249,31 +2390,59 @@ def fetch_tpex_jail_90d_requests(s_date, e_date):
         sess.get(url, headers=headers)
         r = sess.post(url, data=payload, headers=headers, timeout=10)
 
-        if r.status_code == 200:
-            data = r.json()
-            if "tables" in data and len(data["tables"]) > 0:
-                rows = data["tables"][0].get("data", [])
-                print(f"    偵測到 {len(rows)} 筆資料...")
-
-                for row in rows:
-                    if len(row) < 6: continue
-                    c_code = str(row[2]).strip()
-                    c_name_raw = str(row[3]).strip()
-                    c_name = c_name_raw.split("(")[0] if "(" in c_name_raw else c_name_raw
-                    c_period = str(row[5]).strip()
-
-                    if c_code.isdigit() and len(c_code) == 4:
-                        clean_data.append({
-                            "Code": c_code,
-                            "Name": c_name,
-                            "Period": c_period,
-                            "Market": "上櫃"
-                        })
+        if r.status_code != 200:
+            print(f"    TPEx Requests 失敗: HTTP {r.status_code}")
+            return None
+
+        data = r.json()
+        if "tables" in data and len(data["tables"]) > 0:
+            rows = data["tables"][0].get("data", [])
+            print(f"    偵測到 {len(rows)} 筆資料...")
+
+            for row in rows:
+                if len(row) < 6: continue
+                c_code = str(row[2]).strip()
+                c_name_raw = str(row[3]).strip()
+                c_name = c_name_raw.split("(")[0] if "(" in c_name_raw else c_name_raw
+                c_period = str(row[5]).strip()
+
+                if c_code.isdigit() and len(c_code) == 4:
+                    clean_data.append({
+                        "Code": c_code,
+                        "Name": c_name,
+                        "Period": c_period,
+                        "Market": "上櫃"
+                    })
     except Exception as e:
         print(f"    TPEx Requests 失敗: {e}")
+        return None
+
+    if clean_data:
+        return pd.DataFrame(clean_data)
+    return pd.DataFrame()
+
+# ==========================================
+# TWSE 處置公告 JSON 端點 (取代 Selenium)
+# ==========================================
+# 只有明確設定 TWSE_PUNISH_USE_SELENIUM=1 時，JSON 失敗才退回 Selenium
+TWSE_PUNISH_USE_SELENIUM = os.getenv("TWSE_PUNISH_USE_SELENIUM", "0") == "1"
+
+def fetch_twse_jail_90d(s_date, e_date):
+    print(f"  [上市] 啟動 JSON 爬蟲 (TWSE 處置公告)... {s_date} ~ {e_date}")
+    clean_data = fetch_twse_punish_json(s_date, e_date, log=lambda msg: print(f"    {msg}"))
+
+    if clean_data is None:
+        if TWSE_PUNISH_USE_SELENIUM:
+            print("    TWSE JSON 失敗，改用 Selenium 備援")
+            return fetch_twse_selenium_90d(s_date, e_date)
+        print("    TWSE JSON 失敗 (未啟用 Selenium 備援)")
+        return None
 
     if clean_data:
+        print(f"    成功解析 {len(clean_data)} 筆資料")
         return pd.DataFrame(clean_data)
+
+    print("    TWSE 無資料")
     return pd.DataFrame()
 
 def fetch_twse_selenium_90d(s_date, e_date):
@@ -2322,7 +2491,9 @@ def fetch_twse_selenium_90d(s_date, e_date):
             except: continue
 
     except Exception as e:
+        # 逾時 / 找不到表格也算失敗：回傳 None，避免推進已定案日期
         print(f"    TWSE Selenium 操作失敗: {e}")
+        return None
     finally:
         driver.quit()
 
@@ -2334,19 +2505,29 @@ def fetch_twse_selenium_90d(s_date, e_date):
     return pd.DataFrame()
 
 
-def run_jail_crawler_pipeline_sync():
+def run_jail_crawler_pipeline_sync(start_date=None):
+    """
+    抓取 start_date ~ 今天+30 的處置公告 (預設為近 150 日)。
+    回傳 (df, complete)；complete 代表上市/上櫃皆成功抓取，可推進已定案日期。
+    """
     end_date = TARGET_DATE.date() + timedelta(days=30)
-    start_date = TARGET_DATE.date() - timedelta(days=150)
+    if start_date is None:
+        start_date = TARGET_DATE.date() - timedelta(days=JAIL_FULL_LOOKBACK_DAYS)
 
-    print(f"啟動全市場處置股抓取 (TWSE: Selenium / TPEx: Requests)")
+    print(f"啟動全市場處置股抓取 (TWSE: JSON / TPEx: Requests)")
     print(f"搜尋範圍 (含未來預告): {start_date} ~ {end_date}")
 
-    df_tpex = fetch_tpex_jail_90d_requests(start_date, end_date)
-    df_twse = fetch_twse_selenium_90d(start_date, end_date)
+    # TPEx / TWSE 為不同主機、互不相依，同時抓取
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        tpex_future = pool.submit(fetch_tpex_jail_90d_requests, start_date, end_date)
+        twse_future = pool.submit(fetch_twse_jail_90d, start_date, end_date)
+        df_tpex = tpex_future.result()
+        df_twse = twse_future.result()
 
+    complete = df_tpex is not None and df_twse is not None
     all_dfs = []
-    if not df_tpex.empty: all_dfs.append(df_tpex)
-    if not df_twse.empty: all_dfs.append(df_twse)
+    if df_tpex is not None and not df_tpex.empty: all_dfs.append(df_tpex)
+    if df_twse is not None and not df_twse.empty: all_dfs.append(df_twse)
 
     if all_dfs:
         print("\n合併處置股資料中...")
@@ -2391,10 +2572,10 @@ def run_jail_crawler_pipeline_sync():
             "Period": "處置期間"
         }, inplace=True)
 
-        return final_df
+        return final_df, complete
     else:
         print("無處置股資料")
-        return pd.DataFrame()
+        return pd.DataFrame(), complete
 
 # ============================
 # Main
@@ -2403,6 +2584,8 @@ def main():
     sh, _ = connect_google_sheets()
     if not sh: return
 
+    load_ticker_registry(sh, _TICKER_REGISTRY, TICKER_REGISTRY_SHEET_NAME)
+
     print("\n" + "="*50)
     print("啟動額外任務：抓取近 90 日處置股清單 (含未來處置)...")
     print("="*50)
@@ -2410,24 +2593,36 @@ def main():
     releasing_codes_map = {}
     all_jail_data = []
 
+    today_date = TARGET_DATE.date()
+    release_calendar_start = today_date - timedelta(days=10)
+    release_calendar_end = today_date + timedelta(days=90)
+
     try:
-        df_jail_90 = run_jail_crawler_pipeline_sync()
+        # 即將出關判斷用的交易日曆與處置股爬蟲同時下載
+        calendar_pool = ThreadPoolExecutor(max_workers=1)
+        release_cal_future = calendar_pool.submit(get_trading_calendar_between, release_calendar_start, release_calendar_end)
+        calendar_pool.shutdown(wait=False)
 
-        sheet_title = "處置股90日明細"
+        sheet_title = JAIL_SHEET_TITLE
         export_cols = ["市場", "代號", "名稱", "處置期間"]
         ws_jail = get_or_create_ws(sh, sheet_title, headers=export_cols)
 
+        # 增量同步：本機副本可信時只重抓「已定案公布日」之後的尾段
+        jail_state = load_jail_sync_state()
+        jail_rows, from_local = load_jail_table_rows(ws_jail, jail_state)
+        crawl_start = get_jail_crawl_start(jail_state, from_local)
+
+        df_jail_90, crawl_complete = run_jail_crawler_pipeline_sync(crawl_start)
+
         if not df_jail_90.empty:
             df_jail_unique = df_jail_90.drop_duplicates(subset=["代號", "處置期間"])
             print(f"正在寫入 Google Sheet: {sheet_title} (新增模式)...")
 
-            existing_rows = ws_jail.get_all_values()
             existing_keys = set()
-            if len(existing_rows) > 1:
-                for r in existing_rows[1:]:
-                    if len(r) >= 4:
-                        k = f"{str(r[1]).strip()}_{str(r[3]).strip()}"
-                        existing_keys.add(k)
+            for r in jail_rows:
+                if len(r) >= 4:
+                    k = f"{str(r[1]).strip()}_{str(r[3]).strip()}"
+                    existing_keys.add(k)
 
             rows_to_append = []
             new_count = 0
@@ -2443,22 +2638,30 @@ def main():
 
             if rows_to_append:
                 ws_jail.append_rows(rows_to_append, value_input_option='USER_ENTERED')
+                jail_rows.extend(rows_to_append)
                 print(f"{sheet_title} 更新完成！成功新增 {new_count} 筆新處置資料。")
             else:
                 print(f"{sheet_title} 無需新增 (所有資料已存在)。")
         else:
             print("查無新處置股資料，僅讀取現有紀錄。")
 
-        print("重新讀取完整資料庫篩選即將出關股票 (5日內)...")
+        settled_date = jail_state.get("settled_date", "") if from_local else ""
+        if crawl_complete:
+            new_settled = (TARGET_DATE.date() - timedelta(days=JAIL_SETTLE_DAYS)).strftime("%Y-%m-%d")
+            settled_date = max(settled_date, new_settled)
+        save_jail_sync_state({
+            "settled_date": settled_date,
+            "rows": jail_rows,
+            "updated_at": TARGET_DATE.strftime("%Y-%m-%d %H:%M:%S"),
+        })
+
+        print("使用同步後的處置股資料篩選即將出關股票 (5日內)...")
 
-        all_jail_data = ws_jail.get_all_values()
+        all_jail_data = [export_cols] + jail_rows
 
         releasing_rows = []
-        today_date = TARGET_DATE.date()
         stock_latest_end = {}
-        release_calendar_start = today_date - timedelta(days=10)
-        release_calendar_end = today_date + timedelta(days=90)
-        release_cal_dates = get_trading_calendar_between(release_calendar_start, release_calendar_end)
+        release_cal_dates = release_cal_future.result()
 
         if len(all_jail_data) > 1:
             for r in all_jail_data[1:]:
@@ -2575,7 +2778,7 @@ def main():
         f"統計區間 {recent_30_trade_dates[0].strftime('%Y-%m-%d')} ~ {recent_30_trade_dates[-1].strftime('%Y-%m-%d')}。"
     )
 
-    jail_map = get_jail_map_from_sheet(sh)
+    jail_map = get_jail_map_from_sheet(sh, all_jail_data)
     official_disposal_status_map = build_official_disposal_status_map_from_rows(
         all_jail_data,
         TARGET_DATE.date()
@@ -2605,7 +2808,7 @@ def main():
 
         db_info = precise_db.get(code, {})
         m_type = str(db_info.get('market', '上市')).upper()
-        suffix = '.TWO' if any(k in m_type for k in ['上櫃', 'TWO', 'TPEX', 'OTC']) else '.TW'
+        suffix = resolve_ticker_suffix(code, m_type)
         ticker_code = f"{code}{suffix}"
 
         # ===========================================================
@@ -2705,11 +2908,8 @@ def main():
             est_days_display = "0"
             reason_display = official_disposal_status.get("reason", "官方已公告處置")
 
-        hist = fetch_history_data(ticker_code)
-        if hist.empty:
-            alt_s = '.TWO' if suffix=='.TW' else '.TW'
-            hist = fetch_history_data(f"{code}{alt_s}")
-            if not hist.empty: ticker_code = f"{code}{alt_s}"
+        hist, resolved_ticker = fetch_history_data(code, m_type)
+        if not hist.empty: ticker_code = resolved_ticker
 
         fund = fetch_stock_fundamental(code, ticker_code, precise_db)
 
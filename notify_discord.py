@@ -19,6 +19,8 @@ from matplotlib import font_manager
 from matplotlib.offsetbox import OffsetImage, AnnotationBbox
 from PIL import Image
 
+from stock_common import load_ticker_registry, yahoo_suffix_candidates
+
 # ============================
 # ⚙️ 設定區
 # ============================
@@ -36,6 +38,8 @@ else:
 JAIL_ENTER_THRESHOLD = 3
 JAIL_EXIT_THRESHOLD = 5
 TECH_TRACK_SHEET_NAME = "處置股技術追蹤"
+TICKER_REGISTRY_SHEET_NAME = "股票市場對照"  # 代號→.TW/.TWO 對照 (stock_holder_rank.py 每週更新)
+TICKER_REGISTRY = {}
 
 
 def format_display_price(value):
@@ -75,11 +79,12 @@ def get_ma20_distance_color(pct):
         return TEXT_MUTED
 
 
-def _get_yahoo_suffix_candidates(market):
+def _get_yahoo_suffix_candidates(market, code=""):
+    code = str(code).replace("'", "").strip()
     market_text = str(market)
-    if any(x in market_text for x in ["上櫃", "TPEx", "TWO", "OTC"]):
-        return [".TWO", ".TW"]
-    return [".TW", ".TWO"]
+    suffix = ".TWO" if any(x in market_text for x in ["上櫃", "TPEx", "TWO", "OTC"]) else ".TW"
+    # 股票市場對照有的代號以對照後綴優先，另一個後綴仍保留為備援
+    return yahoo_suffix_candidates(code, TICKER_REGISTRY, suffix)
 
 
 def get_ma20_distance_info(code, market="上市"):
@@ -102,7 +107,7 @@ def get_ma20_distance_info(code, market="上市"):
         MA20_DISTANCE_CACHE[cache_key] = ("--", None)
         return MA20_DISTANCE_CACHE[cache_key]
 
-    for suffix in _get_yahoo_suffix_candidates(market):
+    for suffix in _get_yahoo_suffix_candidates(market, code):
         try:
             df = yf.Ticker(f"{code}{suffix}").history(period="3mo", auto_adjust=True)
             if df is None or df.empty or 'Close' not in df.columns or 'Low' not in df.columns:
@@ -488,8 +493,10 @@ def get_price_rank_info(code, period_str, market):
         if not start_date: return "❓ 未知", "日期錯", "+0.0", "+0.0"
         fetch_start = start_date - timedelta(days=60)
         end_date = datetime.now() + timedelta(days=1)
-        suffix = ".TWO" if any(x in str(market) for x in ["上櫃", "TPEx"]) else ".TW"
-        df = yf.Ticker(f"{code}{suffix}").history(start=fetch_start.strftime("%Y-%m-%d"), end=end_date.strftime("%Y-%m-%d"), auto_adjust=True)
+        df = pd.DataFrame()
+        for suffix in _get_yahoo_suffix_candidates(market, code):
+            df = yf.Ticker(f"{code}{suffix}").history(start=fetch_start.strftime("%Y-%m-%d"), end=end_date.strftime("%Y-%m-%d"), auto_adjust=True)
+            if not df.empty: break
         if not df.empty: df = df.ffill()
         if df.empty or len(df) < 2: return "❓ 未知", "無股價", "+0.0", "+0.0"
         df.index = df.index.tz_localize(None)
@@ -1168,6 +1175,7 @@ def draw_injail_image(data, signal_map=None):
 def main():
     sh = connect_google_sheets()
     if not sh: return
+    load_ticker_registry(sh, TICKER_REGISTRY, TICKER_REGISTRY_SHEET_NAME, log=lambda msg: print(f"📒 {msg}"))
     signal_map = load_signal_status_map(sh)
     price_map = load_current_price_map(sh)
 
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+main.py / stock_release_tracker.py / notify_discord.py 共用的小工具
+(只依賴 requests，訊息由各腳本傳入的 log 輸出)。
+"""
+
+import time
+from datetime import timedelta
+
+import requests
+
+
+# ==========================================
+# TWSE 處置公告 JSON 端點
+# ==========================================
+TWSE_PUNISH_JSON_URL = "https://www.twse.com.tw/rwd/zh/announcement/punish"
+
+TWSE_PUNISH_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Referer": "https://www.twse.com.tw/zh/announcement/punish.html",
+}
+
+
+def iter_month_ranges(s_date, e_date):
+    """把 [s_date, e_date] 切成逐月區段 (每段最多到月底)。"""
+    curr = s_date
+    while curr <= e_date:
+        next_month = curr.replace(day=28) + timedelta(days=4)
+        last_day_of_month = next_month - timedelta(days=next_month.day)
+        yield curr, min(last_day_of_month, e_date)
+        curr = last_day_of_month + timedelta(days=1)
+
+
+def fetch_twse_punish_json(s_date, e_date, retries=3, log=print):
+    """
+    直接呼叫 TWSE 處置公告 JSON 端點 (依公布日期查詢)。
+    以月為單位分頁查詢並以 (代號, 處置起迄時間) 去重；
+    任一分頁失敗回傳 None，查無資料回傳空 list，交由呼叫端決定是否退回 Selenium。
+    log：各腳本自己的輸出函式 (只收到訊息本文)。
+    """
+    sess = requests.Session()
+    clean_data = []
+    seen = set()
+
+    for chunk_start, chunk_end in iter_month_ranges(s_date, e_date):
+        params = {
+            "startDate": chunk_start.strftime("%Y%m%d"),
+            "endDate": chunk_end.strftime("%Y%m%d"),
+            "response": "json",
+        }
+        data = None
+        for attempt in range(retries):
+            try:
+                r = sess.get(TWSE_PUNISH_JSON_URL, params=params, headers=TWSE_PUNISH_HEADERS, timeout=15)
+                r.raise_for_status()
+                data = r.json()
+                break
+            except Exception as e:
+                log(f"TWSE JSON {params['startDate']}~{params['endDate']} 失敗 ({attempt + 1}/{retries}): {e}")
+                time.sleep(2 ** attempt)
+        if data is None:
+            return None
+
+        stat = str(data.get("stat", ""))
+        if stat != "OK":
+            # 查無資料時 stat 為「很抱歉，沒有符合條件的資料!」
+            if "沒有" in stat:
+                continue
+            log(f"TWSE JSON {params['startDate']}~{params['endDate']} 回應異常: {stat}")
+            return None
+
+        fields = [str(f).strip() for f in data.get("fields", [])]
+        idx_code = fields.index("證券代號") if "證券代號" in fields else 2
+        idx_name = fields.index("證券名稱") if "證券名稱" in fields else 3
+        idx_period = fields.index("處置起迄時間") if "處置起迄時間" in fields else 6
+
+        for row in data.get("data", []):
+            if len(row) <= max(idx_code, idx_name, idx_period): continue
+            c_code = str(row[idx_code]).strip()
+            c_name = str(row[idx_name]).strip()
+            c_period = str(row[idx_period]).strip()
+            key = (c_code, c_period)
+            if c_code.isdigit() and len(c_code) == 4 and key not in seen:
+                seen.add(key)
+                clean_data.append({
+                    "Code": c_code,
+                    "Name": c_name,
+                    "Period": c_period,
+                    "Market": "上市"
+                })
+
+    return clean_data
+
+
+# ==========================================
+# 股票市場對照 (代號 → Yahoo 後綴，由 stock_holder_rank.py 每週更新)
+# ==========================================
+TICKER_REGISTRY_SHEET_NAME = "股票市場對照"
+
+
+def load_ticker_registry(sh, registry, sheet_name=TICKER_REGISTRY_SHEET_NAME, log=print):
+    """讀取「股票市場對照」到 registry (代號 → '.TW' / '.TWO')；讀不到時維持原本的市場判斷。"""
+    try:
+        records = sh.worksheet(sheet_name).get_all_records()
+    except Exception as e:
+        log(f"股票市場對照讀取失敗，改用市場欄位判斷後綴: {e}")
+        return registry
+
+    for r in records:
+        code = str(r.get('代號', '')).replace("'", "").strip()
+        suffix = str(r.get('suffix', '')).strip().upper()
+        if code and suffix in ('TW', 'TWO'):
+            registry[code] = f".{suffix}"
+    log(f"股票市場對照: {len(registry)} 檔")
+    return registry
+
+
+def yahoo_suffix_candidates(code, registry, suffix):
+    """
+    回傳 Yahoo 後綴候選 (['.TW', '.TWO'] 其中一種順序)。
+    對照表有的代號以對照後綴優先，另一個後綴仍保留為第二候選 (轉市場後對照表可能尚未更新)；
+    對照表沒有的代號以呼叫端依市場欄位判斷的 suffix 優先。
+    """
+    first = registry.get(code) or suffix
+    return [first, ".TWO" if first == ".TW" else ".TW"]
@@ -7,8 +7,9 @@
 1. 資料邏輯改用 PSCNet / MoneyDJ Stock-Chip0007 JSON。
 2. 使用 ThreadPoolExecutor 多執行緒加速：
    - 補 Stock-Chip0007 API URL 快取
-   - requests 抓 60 週股權分散歷史
-   - yfinance 抓 Top20 股價
+   - 抓 60 週股權分散歷史 (只限新上市或缺週的股票)；
+     有 httpx 時改用 asyncio + 連線共用 + AIMD 自適應併發
+   - yfinance 一次批次下載四張榜單的股價
 3. Google Sheet 使用原本程式設定：
    - SHEET_NAME 預設：台股注意股資料庫_V33
    - HOLDER_HISTORY_SHEET_NAME 預設：每週大戶排行紀錄
@@ -17,7 +18,12 @@
    - 上櫃400張比例歷史
    - PSCNet_API快取
 5. 圖片排版沿用原本程式的白底雙欄格式。
-6. 連2 / 連3 / 連4 判斷方式：
+6. 股權分散歷史存在本機 SQLite (代號 × 週)：
+   - 每週只從集保 OpenData 下載全市場最新一週補進資料庫
+   - 新上市或偵測到缺週的股票才重抓 PSCNet 60 週歷史
+7. HOLDER_RANK_MODE=analytics：只輸出全市場籌碼分析表 (400張籌碼分析 + 本機 Parquet)，
+   含 4/8/12 週累計增減、週增減 Z 分數與百分位。
+8. 連2 / 連3 / 連4 判斷方式：
    - 只看「每週大戶排行紀錄」裡的每週 Top20
    - 本週 Top20 + 上週 Top20 + 上上週 Top20... 連續出現才標記。
 
@@ -28,23 +34,55 @@ GitHub Actions 建議 secrets：
 
 必要套件：
 pip install requests pandas yfinance selenium webdriver-manager gspread matplotlib wcwidth beautifulsoup4
+選用：pip install "httpx[http2]" orjson playwright  (PSCNet 非同步 HTTP/2 抓取、快速 JSON 解析、
+      事件驅動補 API 快取；未安裝時退回 requests / json / Selenium)
 """
 
 import os
 import re
 import json
 import time
+import random
+import asyncio
+import threading
 import base64
+import sqlite3
 import unicodedata
+from functools import lru_cache
 from io import StringIO, BytesIO
+from html import unescape
+from urllib.parse import urljoin, urlparse
 from pathlib import Path
 from datetime import datetime, timedelta
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
+import numpy as np
 import pandas as pd
 import yfinance as yf
 from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+try:
+    import pyarrow  # 籌碼分析表以 Parquet 輸出 (未安裝時改存 CSV)
+except Exception:
+    pyarrow = None
+
+try:
+    import httpx
+except Exception:
+    httpx = None
+
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 需要 h2
+    HTTP2_AVAILABLE = True
+except Exception:
+    HTTP2_AVAILABLE = False
 
 try:
     import gspread
@@ -65,6 +103,13 @@ from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.chrome.options import Options
 from webdriver_manager.chrome import ChromeDriverManager
 
+try:
+    from playwright.sync_api import sync_playwright
+    from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
+except Exception:
+    sync_playwright = None
+    PlaywrightTimeoutError = Exception
+
 
 # ================= 設定區 =================
 
@@ -81,6 +126,9 @@ HOLDER_HISTORY_SHEET_NAME = os.getenv("HOLDER_HISTORY_SHEET_NAME", "每週大戶
 LISTED_RATIO_SHEET_NAME = os.getenv("LISTED_RATIO_SHEET_NAME", "上市400張比例歷史")
 OTC_RATIO_SHEET_NAME = os.getenv("OTC_RATIO_SHEET_NAME", "上櫃400張比例歷史")
 API_CACHE_SHEET_NAME = os.getenv("API_CACHE_SHEET_NAME", "PSCNet_API快取")
+# 代號→市場/Yahoo 後綴對照表：由本程式每週依 ISIN 清單更新，
+# main.py / stock_release_tracker.py / notify_discord.py 讀取後直接決定 .TW / .TWO。
+TICKER_REGISTRY_SHEET_NAME = os.getenv("TICKER_REGISTRY_SHEET_NAME", "股票市場對照")
 
 TOP_N = int(os.getenv("TOP_N", "20"))
 HISTORY_INITIAL_WEEKS = int(os.getenv("HISTORY_INITIAL_WEEKS", "5"))
@@ -92,6 +140,12 @@ PRICE_WORKERS = int(os.getenv("PRICE_WORKERS", "18"))
 # 預設改成 2 個 worker，穩定性優先；要加速可在 GitHub env 調高。
 MAX_DISCOVER_WORKERS = int(os.getenv("MAX_DISCOVER_WORKERS", "2"))
 DISCOVER_TIMEOUT_SEC = int(os.getenv("DISCOVER_TIMEOUT_SEC", "22"))
+# 瀏覽器補快取只需要攔到 API 請求，圖片 / 字型 / CSS 一律不載入。
+DISCOVER_BLOCK_RESOURCE_TYPES = {"image", "font", "stylesheet", "media"}
+DISCOVER_BLOCK_URL_PATTERNS = [
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.svg", "*.ico", "*.webp",
+    "*.css", "*.woff", "*.woff2", "*.ttf", "*.eot",
+]
 
 # 快取補齊最多重跑幾輪。第一輪若只補到一半，第二輪會自動補剩下的。
 DISCOVER_MAX_ROUNDS = int(os.getenv("DISCOVER_MAX_ROUNDS", "3"))
@@ -102,6 +156,18 @@ MAX_ALLOWED_MISSING_API = int(os.getenv("MAX_ALLOWED_MISSING_API", "30"))
 # requests 抓資料允許錯誤檔數。超過就停止，避免漏太多股票仍推播。
 MAX_ALLOWED_REQUEST_ERRORS = int(os.getenv("MAX_ALLOWED_REQUEST_ERRORS", "80"))
 
+# PSCNet JSON 抓取：以 MAX_WORKERS 為起始併發，成功逐步加 1、遇 429/5xx 減半 (AIMD)。
+PSCNET_MIN_CONCURRENCY = int(os.getenv("PSCNET_MIN_CONCURRENCY", "4"))
+PSCNET_MAX_CONCURRENCY = int(os.getenv("PSCNET_MAX_CONCURRENCY", "64"))
+PSCNET_REQUEST_RETRIES = int(os.getenv("PSCNET_REQUEST_RETRIES", "3"))
+PSCNET_RETRY_BASE_SEC = float(os.getenv("PSCNET_RETRY_BASE_SEC", "1.5"))
+# 第一輪失敗的股票隔幾秒再整批重抓一次，之後才套用 MAX_ALLOWED_REQUEST_ERRORS。
+PSCNET_RETRY_PASS_SLEEP = float(os.getenv("PSCNET_RETRY_PASS_SLEEP", "15"))
+
+# 缺 API 快取時先用純 HTTP 推導 (既有快取樣板 / 頁面 HTML 擷取)，失敗的才交給瀏覽器。
+DISCOVER_HTTP_API = os.getenv("DISCOVER_HTTP_API", "1") != "0"
+DISCOVER_TEMPLATE_SAMPLES = int(os.getenv("DISCOVER_TEMPLATE_SAMPLES", "3"))
+
 # 若 Google Sheet 尚無 API 快取，是否用 Selenium headless 補快取。
 DISCOVER_MISSING_API = os.getenv("DISCOVER_MISSING_API", "1") != "0"
 
@@ -109,9 +175,31 @@ DISCOVER_MISSING_API = os.getenv("DISCOVER_MISSING_API", "1") != "0"
 STOCK_LIST_RETRY_TIMES = int(os.getenv("STOCK_LIST_RETRY_TIMES", "5"))
 STOCK_LIST_RETRY_SLEEP = float(os.getenv("STOCK_LIST_RETRY_SLEEP", "8"))
 
+# API 快取在幾天內驗證過 (實際抓到 JSON) 就直接採用，不再檢查 URL 字串。
+API_CACHE_VERIFY_TTL_DAYS = int(os.getenv("API_CACHE_VERIFY_TTL_DAYS", "30"))
+# 同一筆 API URL 連續失敗幾次視為失效，重新補快取。
+API_CACHE_MAX_FAILS = int(os.getenv("API_CACHE_MAX_FAILS", "3"))
+
 # 本機備援快取；GitHub 上主要會以 Google Sheet 的 PSCNet_API快取為準。
 LOCAL_API_CACHE_FILE = Path(os.getenv("LOCAL_API_CACHE_FILE", "pscnet_chip0007_api_cache.json"))
 
+# 股權分散本機資料庫 (代號 × 週)；GitHub Actions 以 actions/cache 保留 .stock_cache。
+LOCAL_CACHE_DIR = Path(os.getenv("STOCK_CACHE_DIR", ".stock_cache"))
+HOLDER_STORE_FILE = LOCAL_CACHE_DIR / "holder_weekly.sqlite"
+# 比例歷史表保留最近幾週 (與 PSCNet 60 週歷史一致)。
+HOLDER_STORE_WEEKS = int(os.getenv("HOLDER_STORE_WEEKS", "60"))
+# 資料庫最後一期與最新一期相隔超過幾天視為整批缺週 (容許連假造成的日期位移)。
+HOLDER_MAX_GAP_DAYS = int(os.getenv("HOLDER_MAX_GAP_DAYS", "10"))
+# 集保戶股權分散表：一次下載全市場最新一週，取代每檔抓 60 週 JSON。
+TDCC_DISTRIBUTION_URL = os.getenv("TDCC_DISTRIBUTION_URL", "https://opendata.tdcc.com.tw/getOD.ashx?id=1-5")
+# 籌碼分析模式 (HOLDER_RANK_MODE=analytics)：全市場 4/8/12 週累計增減、週增減 Z 分數與百分位。
+HOLDER_RANK_MODE = os.getenv("HOLDER_RANK_MODE", "rank")
+HOLDER_ANALYTICS_SHEET_NAME = os.getenv("HOLDER_ANALYTICS_SHEET_NAME", "400張籌碼分析")
+HOLDER_ANALYTICS_FILE = LOCAL_CACHE_DIR / "holder_analytics.parquet"
+HOLDER_ANALYTICS_WINDOWS = [int(x) for x in os.getenv("HOLDER_ANALYTICS_WINDOWS", "4,8,12").split(",") if x.strip()]
+# Z 分數以前幾週的週增減為基準 (不含本週)。
+HOLDER_ZSCORE_WEEKS = int(os.getenv("HOLDER_ZSCORE_WEEKS", "12"))
+
 USER_AGENT = (
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
     "AppleWebKit/537.36 (KHTML, like Gecko) "
@@ -326,7 +414,10 @@ HOLDER_HISTORY_HEADERS = [
     "現價", "週漲跌", "總增減%", "寫入時間"
 ]
 
-API_CACHE_HEADERS = ["代號", "suffix", "api_url", "更新時間"]
+# 舊版第 4 欄「更新時間」沿用為「發現時間」。
+API_CACHE_HEADERS = ["代號", "suffix", "api_url", "發現時間", "驗證時間", "失敗次數"]
+
+TICKER_REGISTRY_HEADERS = ["代號", "股名", "市場", "suffix", "更新時間"]
 
 
 def prepare_service_key_file():
@@ -375,13 +466,16 @@ def get_or_create_ws(sh, title, headers, rows=2000, cols=None):
         ws = sh.add_worksheet(title=title, rows=rows, cols=cols)
         log(f"已建立新工作表：{title}")
 
+    if headers and ws.col_count < len(headers):
+        ws.add_cols(len(headers) - ws.col_count)
+
     values = ws.get_all_values()
     if not values:
         ws.update(values=[headers], range_name="A1")
         log(f"已初始化欄位：{title}")
     elif headers and values[0][:len(headers)] != headers:
         # 只強制修正固定欄位的工作表；比例歷史表會自己整張覆蓋。
-        if title in [HOLDER_HISTORY_SHEET_NAME, API_CACHE_SHEET_NAME]:
+        if title in [HOLDER_HISTORY_SHEET_NAME, API_CACHE_SHEET_NAME, TICKER_REGISTRY_SHEET_NAME]:
             ws.update(values=[headers], range_name="A1")
             log(f"已修正欄位：{title}")
 
@@ -596,8 +690,112 @@ def fetch_all_stock_list(listed_ratio_ws=None, otc_ratio_ws=None, api_cache=None
     return out
 
 
+def update_ticker_registry(ws, stock_df):
+    """
+    以本週股票清單更新「股票市場對照」。
+    既有代號保留（避免 fallback 清單不完整時把舊資料洗掉），
+    市場有變動（例如上櫃轉上市）則以本週清單為準；內容無變化時不寫入。
+    """
+    if stock_df is None or stock_df.empty:
+        return
+
+    existing = {}
+    for r in read_records(ws):
+        code = clean_text(r.get("代號", "")).replace("'", "")
+        suffix = clean_text(r.get("suffix", ""))
+        if code and suffix:
+            existing[code] = {
+                "股名": clean_text(r.get("股名", "")) or code,
+                "市場": clean_text(r.get("市場", "")),
+                "suffix": suffix,
+                "更新時間": clean_text(r.get("更新時間", "")),
+            }
+
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    merged = dict(existing)
+    changed = 0
+    for _, r in stock_df.iterrows():
+        code = clean_text(r["代號"])
+        old = existing.get(code)
+        # API 快取 fallback 沒有股名（股名=代號），沿用既有股名
+        name = old["股名"] if old and r["股名"] == code else r["股名"]
+        if old and old["市場"] == r["市場"] and old["suffix"] == r["suffix"] and old["股名"] == name:
+            continue
+        merged[code] = {"股名": name, "市場": r["市場"], "suffix": r["suffix"], "更新時間": now}
+        changed += 1
+
+    if not changed:
+        log(f"股票市場對照無變動：{len(merged)} 檔")
+        return
+
+    rows = [
+        [f"'{code}", v["股名"], v["市場"], v["suffix"], v["更新時間"]]
+        for code, v in sorted(merged.items())
+    ]
+    overwrite_ws(ws, TICKER_REGISTRY_HEADERS, rows)
+    log(f"股票市場對照已更新：{len(rows)} 檔（變動 {changed} 檔）")
+
+
 # ================= PSCNet / MoneyDJ API 快取 =================
 
+def now_str():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+class ApiCache(dict):
+    """
+    代號.suffix → api_url，用法與一般 dict 相同；另外記錄每筆的
+    發現時間 / 驗證時間 / 失敗次數，以及目前寫在工作表第幾列，存檔時只寫有變動的列。
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.meta = {}
+        self.sheet_rows = {}
+        self.next_row = 2
+        self.local_saved = {}
+
+    def __setitem__(self, key, api_url):
+        if self.get(key) != api_url:
+            now = now_str()
+            self.meta[key] = {"discovered": now, "verified": now, "fail_count": 0}
+        else:
+            # 重新補快取找到同一個 URL，視為重新驗證。
+            self.mark_verified(key)
+        super().__setitem__(key, api_url)
+
+    def update(self, other=(), **kwargs):
+        for key, api_url in dict(other, **kwargs).items():
+            self[key] = api_url
+
+    def mark_verified(self, key):
+        if key in self:
+            self.meta.setdefault(key, {}).update({"verified": now_str(), "fail_count": 0})
+
+    def mark_failed(self, key):
+        if key in self:
+            m = self.meta.setdefault(key, {})
+            m["fail_count"] = int(m.get("fail_count", 0)) + 1
+
+    def is_recently_verified(self, key):
+        m = self.meta.get(key, {})
+        if int(m.get("fail_count", 0)) > 0:
+            return False
+        verified = pd.to_datetime(m.get("verified", ""), errors="coerce")
+        return not pd.isna(verified) and datetime.now() - verified < timedelta(days=API_CACHE_VERIFY_TTL_DAYS)
+
+    def is_failing(self, key):
+        return int(self.meta.get(key, {}).get("fail_count", 0)) >= API_CACHE_MAX_FAILS
+
+    def row_values(self, key):
+        code, suffix = key.split(".", 1) if "." in key else (key, "")
+        m = self.meta.get(key, {})
+        return [
+            code, suffix, self[key],
+            m.get("discovered", ""), m.get("verified", ""), str(int(m.get("fail_count", 0))),
+        ]
+
+
 def local_load_api_cache():
     if not LOCAL_API_CACHE_FILE.exists():
         return {}
@@ -608,47 +806,85 @@ def local_load_api_cache():
 
 
 def local_save_api_cache(cache):
+    data = dict(cache)
+    if data == getattr(cache, "local_saved", None):
+        return
     try:
-        LOCAL_API_CACHE_FILE.write_text(json.dumps(cache, ensure_ascii=False, indent=2), encoding="utf-8")
+        LOCAL_API_CACHE_FILE.write_text(json.dumps(data, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+        if isinstance(cache, ApiCache):
+            cache.local_saved = data
     except Exception as e:
         log(f"⚠️ 本機 API 快取寫入失敗：{e}")
 
 
 def load_api_cache_from_sheet(ws):
-    cache = {}
+    cache = ApiCache()
 
-    records = read_records(ws)
-    for r in records:
-        code = str(r.get("代號", "")).strip().replace("'", "")
-        suffix = str(r.get("suffix", "")).strip()
-        api_url = str(r.get("api_url", "")).strip()
+    try:
+        values = ws.get_all_values()
+    except Exception:
+        values = []
+
+    for row_number, row in enumerate(values[1:], start=2):
+        row = [clean_text(x) for x in row] + [""] * len(API_CACHE_HEADERS)
+        code = row[0].replace("'", "")
+        suffix, api_url = row[1], row[2]
         if code and suffix and api_url:
-            cache[f"{code}.{suffix}"] = api_url
+            key = f"{code}.{suffix}"
+            dict.__setitem__(cache, key, api_url)
+            cache.meta[key] = {"discovered": row[3], "verified": row[4], "fail_count": to_int(row[5], 0)}
+            cache.sheet_rows[key] = (row_number, row[:len(API_CACHE_HEADERS)])
+    cache.next_row = max(2, len(values) + 1)
 
-    # 本機 cache 作為補充
+    # 本機 cache 作為補充；尚未經實際抓取驗證，驗證時間留空，交由 URL 格式檢查與後續抓取判斷。
     local_cache = local_load_api_cache()
+    cache.local_saved = dict(local_cache)
+    now = now_str()
     for k, v in local_cache.items():
         if k not in cache and v:
-            cache[k] = v
+            dict.__setitem__(cache, k, v)
+            cache.meta[k] = {"discovered": now, "verified": "", "fail_count": 0}
 
     log(f"讀取 API 快取：{len(cache)} 筆")
     return cache
 
 
 def save_api_cache_to_sheet(ws, cache):
-    rows = []
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-    for key, api_url in sorted(cache.items()):
-        if "." in key:
-            code, suffix = key.split(".", 1)
-        else:
-            code, suffix = key, ""
-        rows.append([code, suffix, api_url, now])
+    """只寫新增 (append) 與內容有變動的列 (連續列合併成一段 batch_update)。"""
+    appends = []
+    changed = []
+
+    for key in sorted(cache.keys()):
+        values = cache.row_values(key)
+        if key not in cache.sheet_rows:
+            appends.append((key, values))
+        elif cache.sheet_rows[key][1] != values:
+            changed.append((cache.sheet_rows[key][0], key, values))
+
+    if changed:
+        changed.sort()
+        blocks = []
+        for row_number, key, values in changed:
+            if blocks and blocks[-1]["start"] + len(blocks[-1]["values"]) == row_number:
+                blocks[-1]["values"].append(values)
+            else:
+                blocks.append({"start": row_number, "values": [values]})
+        ws.batch_update([
+            {"range": f"A{b['start']}:F{b['start'] + len(b['values']) - 1}", "values": b["values"]}
+            for b in blocks
+        ])
+        for row_number, key, values in changed:
+            cache.sheet_rows[key] = (row_number, values)
+
+    if appends:
+        ws.append_rows([v for _, v in appends], value_input_option="RAW")
+        for i, (key, values) in enumerate(appends):
+            cache.sheet_rows[key] = (cache.next_row + i, values)
+        cache.next_row += len(appends)
 
-    overwrite_ws(ws, API_CACHE_HEADERS, rows)
     local_save_api_cache(cache)
-    log(f"API 快取已寫入 Google Sheet：{len(rows)} 筆")
+    if changed or appends:
+        log(f"API 快取已寫入 Google Sheet：新增 {len(appends)} 筆，更新 {len(changed)} 筆")
 
 
 def make_pscnet_page_url(code, suffix):
@@ -664,6 +900,141 @@ def is_correct_stock_chip0007_url(url, code):
     )
 
 
+_CHIP0007_URL_RE = re.compile(r"""[^"'\s<>()]*twStockData\.xdjjson\?[^"'\s<>()]*""", re.I)
+_SCRIPT_SRC_RE = re.compile(r"""<script[^>]+src=["']([^"']+)["']""", re.I)
+
+
+def make_api_url_template(url, code, suffix):
+    """
+    已知股票的 API URL → 含 {code} / {suffix} 佔位的樣板。
+    其餘參數 (含 token) 原樣保留；無法辨識代號位置時回傳空字串。
+    """
+    if not is_correct_stock_chip0007_url(url, code):
+        return ""
+
+    t = str(url).replace("{", "{{").replace("}", "}}")
+    t = re.sub(rf"(?i)AS{code}(?!\d)", "AS{code}", t)
+    t = re.sub(rf"(?i)(?<!\d){code}\.{re.escape(suffix)}(?![A-Za-z])", "{code}.{suffix}", t)
+    t = re.sub(rf"(?<=[=/]){code}(?=[&/]|$)", "{code}", t)
+    return t if "AS{code}" in t else ""
+
+
+def collect_api_url_templates(cache, limit=DISCOVER_TEMPLATE_SAMPLES):
+    templates = []
+    for key, url in sorted(cache.items()):
+        if "." not in key:
+            continue
+        code, suffix = key.split(".", 1)
+        t = make_api_url_template(url, code, suffix)
+        if t and t not in templates:
+            templates.append(t)
+        if len(templates) >= limit:
+            break
+    return templates
+
+
+def is_chip0007_payload(data):
+    if isinstance(data, list):
+        data = data[0] if data else {}
+    return isinstance(data, dict) and isinstance(data.get("ResultSet"), dict)
+
+
+def verify_api_candidates(candidates, label):
+    """candidates: {api_url: meta}；實際抓一次 JSON，回傳 ({key: api_url}, 未通過的 metas)。"""
+    results, _ = fetch_json_many(candidates.keys(), label=label)
+    found, failed = {}, []
+
+    for url, meta in candidates.items():
+        if is_chip0007_payload(results.get(url)):
+            found[f"{meta['代號']}.{meta['suffix']}"] = url
+        else:
+            failed.append(meta)
+
+    return found, failed
+
+
+def extract_chip0007_url(text, base_url, code):
+    """從頁面 HTML / JS 擷取 twStockData.xdjjson 端點，並把代號參數換成目標股票。"""
+    for raw in _CHIP0007_URL_RE.findall(unescape(text or "")):
+        url = urljoin(base_url, raw)
+        if "x=stock-chip0007" not in url.lower():
+            continue
+        if not is_correct_stock_chip0007_url(url, code):
+            url = re.sub(r"(?i)([?&]a=)[^&]*", rf"\g<1>AS{code}", url)
+        if is_correct_stock_chip0007_url(url, code):
+            return url
+    return ""
+
+
+def discover_api_url_from_page(meta, script_cache):
+    code = str(meta["代號"])
+    suffix = str(meta["suffix"])
+    page_url = make_pscnet_page_url(code, suffix)
+    session = get_http_session()
+
+    resp = session.get(page_url, timeout=20)
+    resp.raise_for_status()
+    url = extract_chip0007_url(resp.text, resp.url, code)
+    if url:
+        return url
+
+    # 端點常寫在共用 JS 裡；同源 script 只下載一次，各檔共用。
+    host = urlparse(resp.url).netloc
+    for src in _SCRIPT_SRC_RE.findall(resp.text):
+        script_url = urljoin(resp.url, unescape(src))
+        if urlparse(script_url).netloc != host:
+            continue
+        if script_url not in script_cache:
+            try:
+                script_cache[script_url] = session.get(script_url, timeout=20).text
+            except Exception:
+                script_cache[script_url] = ""
+        url = extract_chip0007_url(script_cache[script_url], resp.url, code)
+        if url:
+            return url
+
+    return ""
+
+
+def discover_api_urls_http(metas, cache):
+    """
+    不開瀏覽器補 API 快取：
+    1. 以既有快取 URL 為樣板換上新代號 (保留 token 參數)，實際抓 JSON 驗證
+    2. 樣板不通的，下載 PSCNet 頁面 HTML / JS 擷取端點再驗證
+    回傳 ({key: api_url}, 仍找不到的 metas)。
+    """
+    found = {}
+    pending = list(metas)
+
+    for i, template in enumerate(collect_api_url_templates(cache), start=1):
+        if not pending:
+            break
+        candidates = {template.format(code=m["代號"], suffix=m["suffix"]): m for m in pending}
+        hit, pending = verify_api_candidates(candidates, f"API 樣板{i} 驗證")
+        found.update(hit)
+        log(f"API 快取樣板 {i}：命中 {len(hit)}，仍缺 {len(pending)}")
+
+    if pending:
+        script_cache = {}
+        candidates = {}
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+            futures = {ex.submit(discover_api_url_from_page, m, script_cache): m for m in pending}
+            for fut in as_completed(futures):
+                try:
+                    url = fut.result()
+                except Exception:
+                    url = ""
+                if url:
+                    candidates[url] = futures[fut]
+
+        hit, _ = verify_api_candidates(candidates, "API 頁面擷取驗證") if candidates else ({}, [])
+        found.update(hit)
+        pending = [m for m in pending if f"{m['代號']}.{m['suffix']}" not in found]
+        log(f"API 快取頁面擷取：命中 {len(hit)}，仍缺 {len(pending)}")
+
+    return found, pending
+
+
 def make_discovery_driver():
     options = Options()
     options.add_argument("--headless=new")
@@ -676,7 +1047,9 @@ def make_discovery_driver():
     options.add_argument("--disk-cache-size=0")
     options.add_argument("--media-cache-size=0")
     options.add_argument(f"user-agent={USER_AGENT}")
-    options.set_capability("goog:loggingPrefs", {"performance": "ALL", "browser": "ALL"})
+    options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+    # driver.get 送出導覽後立即返回，由效能紀錄判斷是否已攔到 API。
+    options.page_load_strategy = "none"
 
     driver = webdriver.Chrome(
         service=Service(ChromeDriverManager().install()),
@@ -687,6 +1060,7 @@ def make_discovery_driver():
     try:
         driver.execute_cdp_cmd("Network.enable", {})
         driver.execute_cdp_cmd("Network.setCacheDisabled", {"cacheDisabled": True})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": DISCOVER_BLOCK_URL_PATTERNS})
     except Exception:
         pass
 
@@ -708,8 +1082,12 @@ def collect_discovery_urls(driver):
         return urls
 
     for item in logs:
+        raw = item.get("message", "")
+        # 只解析可能含 API 請求的紀錄，其餘跳過 json.loads。
+        if "xdjjson" not in raw.lower():
+            continue
         try:
-            msg = json.loads(item.get("message", "{}")).get("message", {})
+            msg = json.loads(raw).get("message", {})
             method = msg.get("method", "")
             params = msg.get("params", {})
 
@@ -738,7 +1116,80 @@ def chunk_list(items, n_chunks):
     return chunks
 
 
+def discover_cache_worker_playwright(worker_id, metas):
+    """
+    Playwright 版：訂閱 request 事件，攔到 Stock-Chip0007 請求即中止 (不下載 JSON)，
+    並中止圖片 / 字型 / CSS，每檔約一次往返即可取得 URL。
+    """
+    found = {}
+    errors = []
+
+    def on_route(route):
+        req = route.request
+        u = req.url.lower()
+        if req.resource_type in DISCOVER_BLOCK_RESOURCE_TYPES:
+            return route.abort()
+        if "twstockdata.xdjjson" in u and "x=stock-chip0007" in u:
+            return route.abort()
+        return route.continue_()
+
+    with sync_playwright() as pw:
+        browser = pw.chromium.launch(headless=True, args=["--no-sandbox", "--disable-dev-shm-usage"])
+        try:
+            page = browser.new_context(user_agent=USER_AGENT).new_page()
+            page.route("**/*", on_route)
+
+            for idx, meta in enumerate(metas, start=1):
+                code = str(meta["代號"])
+                suffix = str(meta["suffix"])
+                key = f"{code}.{suffix}"
+
+                if idx == 1 or idx % 25 == 0:
+                    log(f"[API快取Worker {worker_id}] 進度 {idx}/{len(metas)}：{code} {meta.get('股名','')}")
+
+                try:
+                    with page.expect_request(
+                        lambda r, c=code: is_correct_stock_chip0007_url(r.url, c),
+                        timeout=DISCOVER_TIMEOUT_SEC * 1000,
+                    ) as req_info:
+                        page.goto(make_pscnet_page_url(code, suffix), wait_until="commit",
+                                  timeout=DISCOVER_TIMEOUT_SEC * 1000)
+                    found[key] = req_info.value.url
+                    try:
+                        page.evaluate("window.stop()")
+                    except Exception:
+                        pass
+                except PlaywrightTimeoutError:
+                    errors.append({
+                        "代號": code,
+                        "股名": meta.get("股名", ""),
+                        "市場": meta.get("市場", ""),
+                        "錯誤": "找不到 Stock-Chip0007 API URL",
+                    })
+                except Exception as e:
+                    errors.append({
+                        "代號": code,
+                        "股名": meta.get("股名", ""),
+                        "市場": meta.get("市場", ""),
+                        "錯誤": repr(e),
+                    })
+        finally:
+            browser.close()
+
+    return found, errors
+
+
 def discover_cache_worker(worker_id, metas):
+    """有 Playwright 用事件驅動版；無法啟動時退回 Selenium。"""
+    if sync_playwright is not None:
+        try:
+            return discover_cache_worker_playwright(worker_id, metas)
+        except Exception as e:
+            log(f"⚠️ [API快取Worker {worker_id}] Playwright 無法使用，改用 Selenium：{repr(e)}")
+    return discover_cache_worker_selenium(worker_id, metas)
+
+
+def discover_cache_worker_selenium(worker_id, metas):
     found = {}
     errors = []
     driver = None
@@ -756,8 +1207,6 @@ def discover_cache_worker(worker_id, metas):
                 if idx == 1 or idx % 25 == 0:
                     log(f"[API快取Worker {worker_id}] 進度 {idx}/{len(metas)}：{code} {meta.get('股名','')}")
 
-                driver.get("about:blank")
-                time.sleep(0.08)
                 drain_discovery_logs(driver)
                 driver.get(page_url)
 
@@ -772,10 +1221,14 @@ def discover_cache_worker(worker_id, metas):
                             break
                     if hit_url:
                         break
-                    time.sleep(0.35)
+                    time.sleep(0.15)
 
                 if hit_url:
                     found[key] = hit_url
+                    try:
+                        driver.execute_script("window.stop();")
+                    except Exception:
+                        pass
                 else:
                     errors.append({
                         "代號": code,
@@ -810,6 +1263,12 @@ def get_missing_api_metas(stock_df, cache):
         code = str(meta["代號"])
         suffix = str(meta["suffix"])
         key = f"{code}.{suffix}"
+        if isinstance(cache, ApiCache):
+            if cache.is_recently_verified(key):
+                continue
+            if cache.is_failing(key):
+                missing.append(meta)
+                continue
         url = cache.get(key, "")
         if not url or not is_correct_stock_chip0007_url(url, code):
             missing.append(meta)
@@ -821,6 +1280,7 @@ def ensure_api_cache_threaded(stock_df, cache, api_ws):
     """
     補 Stock-Chip0007 API 快取。
 
+    先用 HTTP 推導 (discover_api_urls_http)，剩下的才開 Chrome。
     修正版重點：
     1. 不再只跑一輪。
     2. 每一輪都重新計算缺少哪些股票。
@@ -829,6 +1289,14 @@ def ensure_api_cache_threaded(stock_df, cache, api_ws):
     """
     all_errors = []
 
+    missing = get_missing_api_metas(stock_df, cache)
+    if missing and DISCOVER_HTTP_API:
+        log(f"API 快取缺 {len(missing)} 檔，先用 HTTP 推導 API URL...")
+        found, _ = discover_api_urls_http(missing, cache)
+        if found:
+            cache.update(found)
+            save_api_cache_to_sheet(api_ws, cache)
+
     if not DISCOVER_MISSING_API:
         missing = get_missing_api_metas(stock_df, cache)
         if missing:
@@ -924,17 +1392,49 @@ def ensure_api_cache_threaded(stock_df, cache, api_ws):
 
 # ================= PSCNet JSON 解析 =================
 
-def requests_get_json(url, timeout=25):
-    r = requests.get(url, headers=HDR, timeout=timeout)
-    r.raise_for_status()
+_HTTP_LOCAL = threading.local()
+
+
+def get_http_session():
+    """每個執行緒共用一個 requests.Session，保留 keep-alive 連線。"""
+    session = getattr(_HTTP_LOCAL, "session", None)
+    if session is None:
+        session = requests.Session()
+        session.headers.update(HDR)
+        session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+        _HTTP_LOCAL.session = session
+    return session
+
+
+class RetryableHTTPError(Exception):
+    """429 / 5xx：伺服器忙碌，值得退避後重試。"""
+
+
+def decode_json_response(content, fallback_text=None):
+    if orjson is not None:
+        try:
+            return orjson.loads(content[3:] if content.startswith(b"\xef\xbb\xbf") else content)
+        except Exception:
+            pass
 
     try:
-        text = r.content.decode("utf-8-sig")
+        text = content.decode("utf-8-sig")
     except Exception:
+        text = fallback_text() if fallback_text else content.decode("utf-8", errors="ignore")
+    return json.loads(text)
+
+
+def requests_get_json(url, timeout=25):
+    r = get_http_session().get(url, timeout=timeout)
+    if r.status_code == 429 or r.status_code >= 500:
+        raise RetryableHTTPError(f"HTTP {r.status_code}")
+    r.raise_for_status()
+
+    def fallback_text():
         r.encoding = r.apparent_encoding
-        text = r.text
+        return r.text
 
-    return json.loads(text)
+    return decode_json_response(r.content, fallback_text)
 
 
 def get_result_rows(data):
@@ -994,107 +1494,290 @@ def is_400_up_level(level):
     return False
 
 
-def parse_pscnet_json_one_stock(meta, data):
+@lru_cache(maxsize=None)
+def classify_level(raw_level):
+    """
+    分級字串 → (計入總股東人數, 一般分級, 400張以上)。
+    同一種分級字串只做一次正規化與判斷；空字串回傳 None。
+    """
+    level = clean_text(raw_level)
+    if not level:
+        return None
+    return is_total_holder_level(level), is_normal_level(level), is_400_up_level(level)
+
+
+normalize_pscnet_date = lru_cache(maxsize=4096)(normalize_date_str)
+
+
+def parse_pscnet_json_one_stock(data):
+    """
+    單檔 PSCNet JSON → 以日期為單位的欄位陣列：
+    {"資料日期", "400張以上", "400張未滿", "總股東人數"}。
+    逐列只取值並寫入預先配置的陣列，最後以 bincount 依日期加總。
+    """
     result = get_result_rows(data)
-    grouped = {}
+    n = len(result)
 
-    for row in result:
-        date = normalize_date_str(row.get("V1", ""))
-        level = clean_text(row.get("V2", ""))
+    date_index = {}
+    idx = np.empty(n, dtype=np.int64)
+    people = np.zeros(n)
+    shares = np.zeros(n)
+    flags = np.zeros((n, 3), dtype=bool)
 
-        if not date or not level:
+    k = 0
+    for row in result:
+        date = normalize_pscnet_date(row.get("V1", ""))
+        cls = classify_level(str(row.get("V2", "")))
+        if not date or cls is None:
             continue
 
-        people = to_int(row.get("V3", 0))
-        shares = to_float(row.get("V4", 0))
-
-        if date not in grouped:
-            grouped[date] = {
-                "代號": meta["代號"],
-                "股名": meta["股名"],
-                "市場": meta["市場"],
-                "suffix": meta["suffix"],
-                "類別": meta.get("類別", "-"),
-                "資料日期": date,
-                "總股東人數": 0,
-                "正常分級總股數": 0.0,
-                "400張以上股數": 0.0,
-            }
+        idx[k] = date_index.setdefault(date, len(date_index))
+        people[k] = to_int(row.get("V3", 0))
+        shares[k] = to_float(row.get("V4", 0))
+        flags[k] = cls
+        k += 1
 
-        if is_total_holder_level(level):
-            grouped[date]["總股東人數"] += people
+    n_dates = len(date_index)
+    idx, people, shares, flags = idx[:k], people[:k], shares[:k], flags[:k]
 
-        if is_normal_level(level):
-            grouped[date]["正常分級總股數"] += shares
+    holders = np.bincount(idx, weights=np.where(flags[:, 0], people, 0), minlength=n_dates)
+    total_shares = np.bincount(idx, weights=np.where(flags[:, 1], shares, 0), minlength=n_dates)
+    over_shares = np.bincount(idx, weights=np.where(flags[:, 2], shares, 0), minlength=n_dates)
 
-        if is_400_up_level(level):
-            grouped[date]["400張以上股數"] += shares
+    keep = total_shares > 0
+    over_pct = [round(o / t * 100, 2) for o, t in zip(over_shares[keep], total_shares[keep])]
 
-    rows = []
-    for rec in grouped.values():
-        total_shares = rec["正常分級總股數"]
-        over_shares = rec["400張以上股數"]
+    return {
+        "資料日期": np.array(list(date_index), dtype=object)[keep],
+        "400張以上": np.array(over_pct, dtype=float),
+        "400張未滿": np.array([round(100 - o, 2) for o in over_pct], dtype=float),
+        "總股東人數": holders[keep].astype(np.int64),
+    }
 
-        if total_shares <= 0:
-            continue
 
-        over_pct = round(over_shares / total_shares * 100, 2)
-        under_pct = round(100 - over_pct, 2)
+def pscnet_batches_to_frame(batches):
+    """[(meta, batch)] → fetch_pscnet_history_all 的長表，欄位一次串接。"""
+    batches = [(meta, b) for meta, b in batches if len(b["資料日期"])]
+    if not batches:
+        return pd.DataFrame()
 
-        rows.append({
-            "代號": rec["代號"],
-            "股名": rec["股名"],
-            "市場": rec["市場"],
-            "suffix": rec["suffix"],
-            "類別": rec["類別"],
-            "資料日期": rec["資料日期"],
-            "400張以上": over_pct,
-            "400張未滿": under_pct,
-            "總股東人數": rec["總股東人數"],
-        })
+    sizes = [len(b["資料日期"]) for _, b in batches]
+    out = {
+        col: np.repeat([str(meta.get(col, "-")) for meta, _ in batches], sizes)
+        for col in ["代號", "股名", "市場", "suffix", "類別"]
+    }
+    for col in ["資料日期", "400張以上", "400張未滿", "總股東人數"]:
+        out[col] = np.concatenate([b[col] for _, b in batches])
 
-    return rows
+    return pd.DataFrame(out)
 
 
-def fetch_pscnet_history_all(stock_df, cache):
-    metas = [r.to_dict() for _, r in stock_df.iterrows()]
-    out_rows = []
-    errors = []
+def retry_sleep_sec(attempt):
+    """指數退避 + full jitter，避免所有失敗請求同時重打。"""
+    return random.uniform(0, PSCNET_RETRY_BASE_SEC * (2 ** (attempt - 1)))
 
-    def one(meta):
-        code = str(meta["代號"])
-        key = f"{code}.{meta['suffix']}"
-        url = cache.get(key, "")
 
-        if not url:
-            return [], {"代號": code, "股名": meta["股名"], "市場": meta["市場"], "錯誤": "沒有 PSCNet API 快取"}
+def is_retryable_error(e):
+    if isinstance(e, RetryableHTTPError):
+        return True
+    if isinstance(e, requests.HTTPError):
+        return False
+    if httpx is not None and isinstance(e, httpx.HTTPStatusError):
+        return False
+    return not isinstance(e, ValueError)
 
+
+class AIMDLimiter:
+    """
+    AIMD 併發控制 (asyncio)：
+    - 每累積「目前上限」次成功，上限 +1
+    - 遇到 429 / 5xx / 逾時，上限減半；同一波壅塞 1 秒內只減一次
+    """
+
+    def __init__(self, initial, minimum, maximum):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.in_flight = 0
+        self.successes = 0
+        self.last_decrease = 0.0
+        self.cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def release(self, congested):
+        async with self.cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if congested:
+                self.successes = 0
+                if now - self.last_decrease >= 1.0:
+                    self.limit = max(self.minimum, self.limit // 2)
+                    self.last_decrease = now
+            else:
+                self.successes += 1
+                if self.successes >= self.limit:
+                    self.limit = min(self.maximum, self.limit + 1)
+                    self.successes = 0
+            self.cond.notify_all()
+
+
+async def _fetch_json_async(client, limiter, url, timeout=25):
+    last_err = None
+
+    for attempt in range(1, PSCNET_REQUEST_RETRIES + 1):
+        await limiter.acquire()
+        congested = False
         try:
-            data = requests_get_json(url)
-            rows = parse_pscnet_json_one_stock(meta, data)
-            return rows, None
+            r = await client.get(url, timeout=timeout)
+            if r.status_code == 429 or r.status_code >= 500:
+                raise RetryableHTTPError(f"HTTP {r.status_code}")
+            r.raise_for_status()
+            return decode_json_response(r.content, lambda: r.text)
         except Exception as e:
-            return [], {"代號": code, "股名": meta["股名"], "市場": meta["市場"], "錯誤": repr(e), "api_url": url}
+            last_err = e
+            congested = isinstance(e, (RetryableHTTPError, httpx.TimeoutException))
+            if not is_retryable_error(e):
+                raise
+        finally:
+            await limiter.release(congested)
+
+        if attempt < PSCNET_REQUEST_RETRIES:
+            await asyncio.sleep(retry_sleep_sec(attempt))
+
+    raise last_err
 
-    log(f"PSCNet requests 抓 60週資料：{len(metas)} 檔，MAX_WORKERS={MAX_WORKERS}")
 
+async def _fetch_json_many_async(urls, label):
+    limiter = AIMDLimiter(MAX_WORKERS, PSCNET_MIN_CONCURRENCY, PSCNET_MAX_CONCURRENCY)
+    limits = httpx.Limits(max_connections=PSCNET_MAX_CONCURRENCY, max_keepalive_connections=PSCNET_MAX_CONCURRENCY)
+    results, failed = {}, {}
+
+    async with httpx.AsyncClient(headers=HDR, http2=HTTP2_AVAILABLE, limits=limits) as client:
+        async def one(url):
+            try:
+                return url, await _fetch_json_async(client, limiter, url), None
+            except Exception as e:
+                return url, None, e
+
+        tasks = [asyncio.create_task(one(url)) for url in urls]
+        done = 0
+        for fut in asyncio.as_completed(tasks):
+            url, data, err = await fut
+            done += 1
+            if err is None:
+                results[url] = data
+            else:
+                failed[url] = err
+
+            if done % 100 == 0 or done == len(urls):
+                log(f"{label} 進度 {done}/{len(urls)}，失敗 {len(failed)}，併發上限 {limiter.limit}")
+
+    return results, failed
+
+
+def _fetch_json_many_threaded(urls, label):
+    def one(url):
+        last_err = None
+        for attempt in range(1, PSCNET_REQUEST_RETRIES + 1):
+            try:
+                return requests_get_json(url)
+            except Exception as e:
+                last_err = e
+                if not is_retryable_error(e):
+                    break
+                if attempt < PSCNET_REQUEST_RETRIES:
+                    time.sleep(retry_sleep_sec(attempt))
+        raise last_err
+
+    results, failed = {}, {}
     with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
-        futures = {ex.submit(one, meta): meta for meta in metas}
+        futures = {ex.submit(one, url): url for url in urls}
 
         done = 0
         for fut in as_completed(futures):
+            url = futures[fut]
             done += 1
-            rows, err = fut.result()
-            out_rows.extend(rows)
+            try:
+                results[url] = fut.result()
+            except Exception as e:
+                failed[url] = e
 
-            if err:
-                errors.append(err)
+            if done % 100 == 0 or done == len(urls):
+                log(f"{label} 進度 {done}/{len(urls)}，失敗 {len(failed)}")
 
-            if done % 100 == 0 or done == len(metas):
-                log(f"PSCNet 歷史進度 {done}/{len(metas)}，資料列 {len(out_rows)}，錯誤 {len(errors)}")
+    return results, failed
 
-    df = pd.DataFrame(out_rows)
-    if df.empty:
+
+def fetch_json_many(urls, label="PSCNet 歷史"):
+    """批次抓 JSON，回傳 ({url: data}, {url: exception})。有 httpx 用 asyncio，否則退回多執行緒。"""
+    urls = list(dict.fromkeys(urls))
+    if not urls:
+        return {}, {}
+    if httpx is not None:
+        return asyncio.run(_fetch_json_many_async(urls, label))
+    return _fetch_json_many_threaded(urls, label)
+
+
+def fetch_pscnet_history_all(stock_df, cache, require_rows=True):
+    """
+    逐檔抓 PSCNet 60 週歷史。
+    require_rows=False 用於只補新上市 / 缺週股票時，全部失敗也不中斷 (仍檢查錯誤上限)。
+    """
+    metas = [r.to_dict() for _, r in stock_df.iterrows()]
+    batches = []
+    errors = []
+    url_metas = {}
+
+    for meta in metas:
+        code = str(meta["代號"])
+        url = cache.get(f"{code}.{meta['suffix']}", "")
+        if not url:
+            errors.append({"代號": code, "股名": meta["股名"], "市場": meta["市場"], "錯誤": "沒有 PSCNet API 快取"})
+            continue
+        url_metas.setdefault(url, []).append(meta)
+
+    mode = f"httpx asyncio{' HTTP/2' if HTTP2_AVAILABLE else ''}" if httpx is not None else "requests 多執行緒"
+    log(f"PSCNet 抓 60週資料：{len(url_metas)} 檔，{mode}，起始併發 {MAX_WORKERS}")
+
+    results, failed = fetch_json_many(url_metas.keys())
+    if failed:
+        log(f"⚠️ PSCNet 第一輪失敗 {len(failed)} 檔，{PSCNET_RETRY_PASS_SLEEP:.0f} 秒後重抓一次...")
+        time.sleep(PSCNET_RETRY_PASS_SLEEP)
+        retry_results, failed = fetch_json_many(failed.keys(), label="PSCNet 重抓")
+        results.update(retry_results)
+
+    for url, data in results.items():
+        try:
+            batch = parse_pscnet_json_one_stock(data)
+        except Exception as e:
+            failed[url] = e
+            continue
+        batches.extend((meta, batch) for meta in url_metas[url])
+
+    if isinstance(cache, ApiCache):
+        for url, metas_of_url in url_metas.items():
+            for meta in metas_of_url:
+                key = f"{meta['代號']}.{meta['suffix']}"
+                if url in failed:
+                    cache.mark_failed(key)
+                else:
+                    cache.mark_verified(key)
+
+    for url, err in failed.items():
+        for meta in url_metas[url]:
+            errors.append({
+                "代號": str(meta["代號"]), "股名": meta["股名"], "市場": meta["市場"],
+                "錯誤": repr(err), "api_url": url,
+            })
+
+    df = pscnet_batches_to_frame(batches)
+    log(f"PSCNet 歷史完成：資料列 {len(df)}，錯誤 {len(errors)}")
+
+    if df.empty and require_rows:
         raise RuntimeError("PSCNet 沒有抓到任何 60 週歷史資料，請檢查 API 快取或網站連線。")
 
     if len(errors) > MAX_ALLOWED_REQUEST_ERRORS:
@@ -1111,6 +1794,253 @@ def fetch_pscnet_history_all(stock_df, cache):
     return df, pd.DataFrame(errors)
 
 
+# ================= 股權分散本機資料庫 =================
+
+HOLDER_LONG_COLUMNS = ["代號", "資料日期", "400張以上", "400張未滿", "總股東人數"]
+
+
+def open_holder_store():
+    LOCAL_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(HOLDER_STORE_FILE)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS holder_weekly (
+            code TEXT NOT NULL,
+            date TEXT NOT NULL,
+            pct_400_up REAL,
+            pct_400_under REAL,
+            holders INTEGER,
+            PRIMARY KEY (code, date)
+        )
+    """)
+    conn.commit()
+    return conn
+
+
+def save_holder_rows(conn, long_df):
+    """寫入 (代號, 資料日期) 長表；同一週重複寫入時以新資料為準。"""
+    if long_df is None or long_df.empty:
+        return 0
+
+    rows = []
+    for code, date, over_pct, under_pct, holders in long_df[HOLDER_LONG_COLUMNS].itertuples(index=False):
+        rows.append((
+            str(code),
+            normalize_date_str(date),
+            None if pd.isna(over_pct) else float(over_pct),
+            None if pd.isna(under_pct) else float(under_pct),
+            None if pd.isna(holders) else int(holders),
+        ))
+
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO holder_weekly VALUES (?, ?, ?, ?, ?)", rows)
+    return len(rows)
+
+
+def seed_holder_store_from_ratio_sheets(conn, ratio_ws_list):
+    """
+    資料庫是空的 (第一次執行或 actions/cache 過期) 時，
+    先用 Google Sheet 既有的 400張比例歷史表回填，避免全部股票重抓 60 週。
+    舊週只有 400張以上%；400張未滿 / 總股東人數只有最新一週。
+    """
+    rows = []
+
+    for ws in ratio_ws_list:
+        try:
+            values = ws.get_all_values()
+        except Exception:
+            continue
+        if not values or len(values) < 2:
+            continue
+
+        headers = [clean_text(x) for x in values[0]]
+        if "代號" not in headers:
+            continue
+
+        date_idx = [
+            (i, normalize_date_str(h)) for i, h in enumerate(headers)
+            if h not in {"代號", "股名", "類別", "與上週相比增減%", "最新400張未滿", "總股東人數"}
+            and not pd.isna(pd.to_datetime(h, errors="coerce"))
+        ]
+        if not date_idx:
+            continue
+
+        latest_date = max((d for _, d in date_idx), key=date_sort_key)
+        idx_code = headers.index("代號")
+        idx_under = headers.index("最新400張未滿") if "最新400張未滿" in headers else None
+        idx_holders = headers.index("總股東人數") if "總股東人數" in headers else None
+
+        for row in values[1:]:
+            code = clean_text(row[idx_code] if idx_code < len(row) else "").replace("'", "")
+            if not code:
+                continue
+
+            for i, date in date_idx:
+                raw = row[i] if i < len(row) else ""
+                if clean_text(raw) == "":
+                    continue
+                over_pct = to_float(raw, None)
+                if over_pct is None:
+                    continue
+
+                under_pct = round(100 - over_pct, 2)
+                holders = None
+                if date == latest_date:
+                    if idx_under is not None and idx_under < len(row):
+                        under_pct = to_float(row[idx_under], under_pct)
+                    if idx_holders is not None and idx_holders < len(row):
+                        holders = to_int(row[idx_holders], 0) or None
+
+                rows.append((code, date, over_pct, under_pct, holders))
+
+    if rows:
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO holder_weekly VALUES (?, ?, ?, ?, ?)", rows)
+        log(f"✅ 從 400張比例歷史回填股權分散資料庫：{len(rows)} 筆")
+    return len(rows)
+
+
+def fetch_tdcc_latest_week(stock_df):
+    """
+    集保 OpenData 全市場最新一週股權分散表，算法與 parse_pscnet_json_one_stock 相同：
+    1~15 為一般分級、12~15 為 400 張以上、16 為差異數調整、17 為合計。
+    """
+    resp = requests_get_with_retry(
+        TDCC_DISTRIBUTION_URL,
+        headers={"User-Agent": USER_AGENT},
+        timeout=60,
+        retries=3,
+        label="集保股權分散表",
+    )
+    text = resp.content.decode("utf-8-sig", errors="ignore")
+    raw = pd.read_csv(StringIO(text), dtype=str)
+    if raw.shape[1] < 5:
+        raise RuntimeError(f"集保股權分散表欄位異常：{list(raw.columns)}")
+
+    raw = raw.iloc[:, :5]
+    raw.columns = ["資料日期", "代號", "持股分級", "人數", "股數"]
+    raw["代號"] = raw["代號"].map(clean_text)
+    raw = raw[raw["代號"].isin(set(stock_df["代號"].astype(str)))]
+    if raw.empty:
+        raise RuntimeError("集保股權分散表沒有任何清單內股票。")
+
+    level = pd.to_numeric(raw["持股分級"], errors="coerce")
+    people = pd.to_numeric(raw["人數"].str.replace(",", ""), errors="coerce").fillna(0)
+    shares = pd.to_numeric(raw["股數"].str.replace(",", ""), errors="coerce").fillna(0)
+
+    frame = pd.DataFrame({
+        "代號": raw["代號"],
+        "資料日期": raw["資料日期"].map(normalize_date_str),
+        "總股東人數": people.where(level != 17, 0),
+        "正常分級總股數": shares.where(level.between(1, 15), 0),
+        "400張以上股數": shares.where(level.between(12, 15), 0),
+    })
+    g = frame.groupby(["代號", "資料日期"], as_index=False).sum()
+    g = g[g["正常分級總股數"] > 0].copy()
+
+    g["400張以上"] = [round(o / t * 100, 2) for o, t in zip(g["400張以上股數"], g["正常分級總股數"])]
+    g["400張未滿"] = [round(100 - o, 2) for o in g["400張以上"]]
+    g["總股東人數"] = g["總股東人數"].astype(int)
+
+    log(f"✅ 集保股權分散表：{len(g)} 檔，資料日期 {', '.join(sorted(g['資料日期'].unique()))}")
+    return g[HOLDER_LONG_COLUMNS].reset_index(drop=True)
+
+
+def plan_full_history_codes(conn, stock_df, latest_df):
+    """
+    決定哪些股票要重抓 PSCNet 60 週歷史：
+    - 資料庫沒有的股票 (新上市)
+    - 最後一筆早於上一期 (缺週)；若整個資料庫都落後太多週，全部重抓
+    """
+    codes = stock_df["代號"].astype(str)
+    last_dates = dict(conn.execute("SELECT code, MAX(date) FROM holder_weekly GROUP BY code").fetchall())
+
+    if latest_df is None or latest_df.empty or not last_dates:
+        return set(codes)
+
+    latest_date = latest_df["資料日期"].max()
+    row = conn.execute("SELECT MAX(date) FROM holder_weekly WHERE date < ?", (latest_date,)).fetchone()
+    prev_date = row[0] if row else None
+
+    if not prev_date:
+        return set(codes)
+    gap_days = (pd.Timestamp(latest_date) - pd.Timestamp(prev_date)).days
+    if gap_days > HOLDER_MAX_GAP_DAYS:
+        log(f"⚠️ 股權分散資料庫最後一期 {prev_date} 距最新一期 {latest_date} 達 {gap_days} 天，全部重抓。")
+        return set(codes)
+
+    # 集保最新一週沒有的股票 (停牌等) PSCNet 也不會有新資料，不必重抓。
+    latest_codes = set(latest_df["代號"].astype(str))
+    return {
+        c for c in codes
+        if c not in last_dates or (c in latest_codes and last_dates[c] < prev_date)
+    }
+
+
+def load_holder_history_long(conn, stock_df, weeks=HOLDER_STORE_WEEKS):
+    """從資料庫組回 fetch_pscnet_history_all 相同欄位的長表 (最近 weeks 週)。"""
+    dates = [r[0] for r in conn.execute(
+        "SELECT DISTINCT date FROM holder_weekly ORDER BY date DESC LIMIT ?", (int(weeks),)
+    )]
+    if not dates:
+        return pd.DataFrame()
+
+    df = pd.read_sql_query(
+        "SELECT code, date, pct_400_up, pct_400_under, holders FROM holder_weekly WHERE date >= ?",
+        conn,
+        params=(min(dates),),
+    )
+    df.columns = HOLDER_LONG_COLUMNS
+    df["總股東人數"] = df["總股東人數"].astype("Int64")
+
+    meta = stock_df[["代號", "股名", "市場", "suffix", "類別"]].copy()
+    meta["代號"] = meta["代號"].astype(str)
+    df = meta.merge(df, on="代號", how="inner")
+
+    return df[["代號", "股名", "市場", "suffix", "類別"] + HOLDER_LONG_COLUMNS[1:]]
+
+
+def update_holder_store(stock_df, cache, ratio_ws_list=()):
+    """
+    每週更新本機股權分散資料庫並回傳 (history_long, errors_df)：
+    集保 OpenData 補全市場最新一週；新上市 / 缺週股票才逐檔抓 PSCNet 60 週。
+    集保下載失敗時退回全部逐檔抓取。
+    """
+    conn = open_holder_store()
+    try:
+        stored = conn.execute("SELECT COUNT(*) FROM holder_weekly").fetchone()[0]
+        if not stored:
+            seed_holder_store_from_ratio_sheets(conn, ratio_ws_list)
+
+        try:
+            latest_df = fetch_tdcc_latest_week(stock_df)
+        except Exception as e:
+            log(f"⚠️ 集保股權分散表下載失敗，改用 PSCNet 逐檔抓取：{repr(e)}")
+            latest_df = pd.DataFrame()
+
+        full_codes = plan_full_history_codes(conn, stock_df, latest_df)
+        log(f"股權分散資料庫：需重抓 60 週歷史 {len(full_codes)} 檔，其餘只補最新一週。")
+
+        errors_df = pd.DataFrame()
+        if full_codes:
+            full_df = stock_df[stock_df["代號"].astype(str).isin(full_codes)]
+            history_df, errors_df = fetch_pscnet_history_all(
+                full_df, cache, require_rows=latest_df.empty or len(full_codes) == len(stock_df)
+            )
+            save_holder_rows(conn, history_df)
+
+        # 最新一週以集保為準，覆蓋 PSCNet 同週資料。
+        save_holder_rows(conn, latest_df)
+
+        history_long = load_holder_history_long(conn, stock_df)
+    finally:
+        conn.close()
+
+    if history_long.empty:
+        raise RuntimeError("股權分散資料庫沒有任何可用資料，請檢查集保 / PSCNet 連線。")
+
+    return history_long, errors_df
+
+
 # ================= 歷史比例表與排名 =================
 
 def identify_date_columns(df):
@@ -1125,6 +2055,37 @@ def identify_date_columns(df):
     return cols
 
 
+def ratio_matrix_from_hist(hist):
+    """比例歷史表 → (日期欄 新→舊, 股票×週 數值矩陣)；日期欄名只解析一次。"""
+    date_cols = sorted(identify_date_columns(hist), key=lambda x: date_sort_key(x), reverse=True)
+    if not date_cols:
+        return [], np.empty((len(hist), 0))
+    values = hist[date_cols].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=float)
+    return date_cols, values
+
+
+def top_n_indices(scores, n, ascending=False):
+    """
+    scores：股票×週 矩陣；每一週 (欄) 以穩定排序取前 n 名的列索引。
+    同分依列順序，NaN 不列入。回傳每週一個 np.ndarray。
+    """
+    scores = np.asarray(scores, dtype=float)
+    if scores.ndim == 1:
+        scores = scores[:, None]
+    n_rows, n_cols = scores.shape
+    k = min(n, n_rows)
+    if k <= 0:
+        return [np.empty(0, dtype=np.int64) for _ in range(n_cols)]
+
+    key = scores if ascending else -scores
+    key = np.where(np.isnan(key), np.inf, key)
+
+    part = np.argsort(key, axis=0, kind="stable")[:k]
+    part_key = np.take_along_axis(key, part, axis=0)
+
+    return [part[np.isfinite(part_key[:, j]), j] for j in range(n_cols)]
+
+
 def build_ratio_history_from_long(history_long_df, market):
     if history_long_df is None or history_long_df.empty:
         return pd.DataFrame()
@@ -1136,40 +2097,39 @@ def build_ratio_history_from_long(history_long_df, market):
     df["資料日期"] = df["資料日期"].map(normalize_date_str)
     df["_date"] = pd.to_datetime(df["資料日期"], errors="coerce")
     df = df.dropna(subset=["_date"])
+    df["_pct"] = pd.to_numeric(df["400張以上"], errors="coerce")
+    df["代號"] = df["代號"].astype(str)
 
-    date_cols = sorted(df["資料日期"].dropna().unique(), key=lambda x: date_sort_key(x), reverse=True)
-    if not date_cols:
+    values_df = df.dropna(subset=["_pct", "代號", "股名", "類別"])
+    values_df = values_df.drop_duplicates(["代號", "股名", "類別", "資料日期"], keep="first")
+    if values_df.empty:
         return pd.DataFrame()
 
-    latest_date = date_cols[0]
-
-    pivot = df.pivot_table(
-        index=["代號", "股名", "類別"],
-        columns="資料日期",
-        values="400張以上",
-        aggfunc="first"
-    ).reset_index()
+    # 日期軸 (新→舊) 與股票軸 (依 代號/股名/類別 排序) 各建一次，直接填入 股票×週 矩陣。
+    date_cols = sorted(values_df["資料日期"].unique(), key=lambda x: date_sort_key(x), reverse=True)
+    col_pos = {d: i for i, d in enumerate(date_cols)}
+    group = values_df.groupby(["代號", "股名", "類別"], sort=True)
+    row_pos = group.ngroup().to_numpy()
+    keys = group.size().index.to_frame(index=False)
 
-    latest_info = df[df["資料日期"] == latest_date].copy()
-    under_map = dict(zip(latest_info["代號"].astype(str), latest_info["400張未滿"]))
-    holder_map = dict(zip(latest_info["代號"].astype(str), latest_info["總股東人數"]))
+    matrix = np.full((len(keys), len(date_cols)), np.nan)
+    cols = values_df["資料日期"].map(col_pos).to_numpy()
+    matrix[row_pos, cols] = values_df["_pct"].to_numpy()
 
-    pivot["代號"] = pivot["代號"].astype(str)
-    pivot["最新400張未滿"] = pivot["代號"].map(under_map)
-    pivot["總股東人數"] = pivot["代號"].map(holder_map)
+    latest_date = date_cols[0]
+    latest_info = df[df["資料日期"] == latest_date]
+    under_map = dict(zip(latest_info["代號"], latest_info["400張未滿"]))
+    holder_map = dict(zip(latest_info["代號"], latest_info["總股東人數"]))
 
+    out = keys.copy()
     if len(date_cols) >= 2:
-        latest_col = date_cols[0]
-        prev_col = date_cols[1]
-        pivot["與上週相比增減%"] = (
-            pd.to_numeric(pivot[latest_col], errors="coerce")
-            - pd.to_numeric(pivot[prev_col], errors="coerce")
-        ).round(2)
+        out["與上週相比增減%"] = np.round(matrix[:, 0] - matrix[:, 1], 2)
     else:
-        pivot["與上週相比增減%"] = pd.NA
+        out["與上週相比增減%"] = pd.NA
+    out["最新400張未滿"] = out["代號"].map(under_map)
+    out["總股東人數"] = out["代號"].map(holder_map)
+    out = pd.concat([out, pd.DataFrame(matrix, columns=date_cols)], axis=1)
 
-    keep_cols = ["代號", "股名", "類別", "與上週相比增減%", "最新400張未滿", "總股東人數"] + date_cols
-    out = pivot[[c for c in keep_cols if c in pivot.columns]].copy()
     out = out.sort_values("與上週相比增減%", ascending=False, na_position="last").reset_index(drop=True)
 
     return out
@@ -1179,19 +2139,17 @@ def build_rank_from_history(hist, market, rank_type="增加"):
     if hist is None or hist.empty:
         return pd.DataFrame()
 
-    df = hist.copy()
-    df["總增減"] = pd.to_numeric(df["與上週相比增減%"], errors="coerce")
-    df = df.dropna(subset=["總增減"])
-
-    if df.empty:
+    diff = pd.to_numeric(hist["與上週相比增減%"], errors="coerce").to_numpy(dtype=float)
+    idx = top_n_indices(diff, TOP_N, ascending=(rank_type == "減少"))[0]
+    if len(idx) == 0:
         return pd.DataFrame()
 
-    date_cols = identify_date_columns(df)
+    date_cols = identify_date_columns(hist)
     date_cols = sorted(date_cols, key=lambda x: date_sort_key(x), reverse=True)
     latest_date = date_cols[0] if date_cols else ""
 
-    ascending = True if rank_type == "減少" else False
-    out = df.sort_values("總增減", ascending=ascending).head(TOP_N).copy().reset_index(drop=True)
+    out = hist.iloc[idx].copy().reset_index(drop=True)
+    out["總增減"] = diff[idx]
     out["市場"] = market
     out["suffix"] = ".TW" if market == "上市" else ".TWO"
     out["最新日期"] = latest_date
@@ -1236,6 +2194,71 @@ def write_ratio_history_sheet(ws, hist):
     overwrite_ws(ws, headers, rows)
 
 
+# ================= 籌碼分析 (全市場) =================
+
+def build_holder_analytics(hist, market, windows=None, z_weeks=HOLDER_ZSCORE_WEEKS):
+    """
+    以 股票×週 比例矩陣一次算出每檔：
+    - 週增減與 N 週累計增減 (400張以上% 最新一週 - N 週前)
+    - 週增減 Z 分數：本週增減相對前 z_weeks 週增減的平均 / 標準差
+    - 各項在同市場中的百分位 (0~100)
+    """
+    windows = windows or HOLDER_ANALYTICS_WINDOWS
+    if hist is None or hist.empty:
+        return pd.DataFrame()
+
+    date_cols, values = ratio_matrix_from_hist(hist)
+    if len(date_cols) < 2:
+        return pd.DataFrame()
+
+    weekly = values[:, :-1] - values[:, 1:]
+    latest = weekly[:, 0]
+
+    out = pd.DataFrame({
+        "代號": hist["代號"].astype(str).to_numpy(),
+        "股名": hist["股名"].astype(str).to_numpy(),
+        "類別": hist["類別"].astype(str).to_numpy() if "類別" in hist.columns else "-",
+        "市場": market,
+        "資料日期": normalize_date_str(date_cols[0]),
+        "400張以上%": values[:, 0],
+        "週增減": np.round(latest, 2),
+    })
+
+    rank_cols = ["週增減"]
+    for w in windows:
+        col = f"{w}週累計增減"
+        out[col] = np.round(values[:, 0] - values[:, w], 2) if len(date_cols) > w else np.nan
+        rank_cols.append(col)
+
+    past = weekly[:, 1:z_weeks + 1]
+    n = np.sum(~np.isnan(past), axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.nansum(past, axis=1) / n
+        std = np.sqrt(np.nansum((past - mean[:, None]) ** 2, axis=1) / (n - 1))
+        z = (latest - mean) / std
+    z[(n < max(3, z_weeks // 2)) | ~(std > 0)] = np.nan
+    out["週增減Z分數"] = np.round(z, 2)
+
+    for col in rank_cols:
+        out[f"{col}百分位"] = (out[col].rank(pct=True) * 100).round(1)
+
+    return out.sort_values("週增減Z分數", ascending=False, na_position="last").reset_index(drop=True)
+
+
+def save_holder_analytics(table):
+    try:
+        LOCAL_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        if pyarrow is not None:
+            table.to_parquet(HOLDER_ANALYTICS_FILE, index=False)
+            log(f"籌碼分析表已輸出：{HOLDER_ANALYTICS_FILE} ({len(table)} 筆)")
+        else:
+            csv_path = HOLDER_ANALYTICS_FILE.with_suffix(".csv")
+            table.to_csv(csv_path, index=False, encoding="utf-8-sig")
+            log(f"籌碼分析表已輸出 (未安裝 pyarrow，改存 CSV)：{csv_path} ({len(table)} 筆)")
+    except Exception as e:
+        log(f"⚠️ 籌碼分析表輸出失敗：{e}")
+
+
 # ================= 股價資訊 =================
 
 def get_week_price_info(code, market_suffix, latest_date_str):
@@ -1271,45 +2294,127 @@ def get_week_price_info(code, market_suffix, latest_date_str):
         prev_close = float(past_df["Close"].iloc[-1])
         current_close = float(current_week_df["Close"].iloc[-1])
 
-        if prev_close <= 0:
-            return f"{current_close:.1f}", "-"
-
-        week_pct = ((current_close - prev_close) / prev_close) * 100
-        arrow = "▲" if week_pct > 0 else "▼" if week_pct < 0 else "—"
-
-        return f"{current_close:.1f}", f"{arrow}{abs(week_pct):.1f}%"
+        return format_week_price(current_close, prev_close)
 
     except Exception as e:
         print(f"⚠️ 股價資料取得失敗 ({code}{market_suffix}): {e}")
         return "-", "-"
 
 
-def add_price_info(df):
-    if df is None or df.empty:
-        return df
+def format_week_price(current_close, prev_close):
+    if pd.isna(current_close) or pd.isna(prev_close):
+        return "-", "-"
+    if prev_close <= 0:
+        return f"{current_close:.1f}", "-"
+
+    week_pct = ((current_close - prev_close) / prev_close) * 100
+    arrow = "▲" if week_pct > 0 else "▼" if week_pct < 0 else "—"
+    return f"{current_close:.1f}", f"{arrow}{abs(week_pct):.1f}%"
+
+
+def fetch_week_price_table(tickers, latest_date_str):
+    """
+    一次 yf.download 多檔，向量化算出本週收盤與週漲跌：
+    上週最後收盤 = 本週一以前最後一筆有效收盤；本週收盤 = 本週最後一筆有效收盤。
+    回傳 {ticker: (現價, 週漲跌)}；整批都沒有資料的股票不列入。
+    """
+    ref_date = parse_latest_trade_date(latest_date_str)
+    week_start = pd.Timestamp((ref_date - timedelta(days=ref_date.weekday())).date())
+    fetch_start = week_start - timedelta(days=15)
+    fetch_end = week_start + timedelta(days=7)
+
+    data = yf.download(
+        tickers,
+        start=fetch_start.strftime("%Y-%m-%d"),
+        end=fetch_end.strftime("%Y-%m-%d"),
+        auto_adjust=True,
+        group_by="column",
+        progress=False,
+        threads=True,
+    )
+    if data is None or data.empty or "Close" not in data:
+        return {}
+
+    close = data["Close"]
+    if isinstance(close, pd.Series):
+        close = close.to_frame(name=tickers[0])
+
+    try:
+        close.index = close.index.tz_localize(None)
+    except Exception:
+        pass
+
+    past = close[close.index < week_start].ffill()
+    current = close[close.index >= week_start].ffill()
+    if past.empty or current.empty:
+        return {}
 
-    out = df.copy()
-    metas = [r.to_dict() for _, r in out.iterrows()]
+    prev_close = past.iloc[-1]
+    current_close = current.iloc[-1]
+    has_data = close.notna().any()
+
+    return {
+        t: format_week_price(current_close.get(t), prev_close.get(t))
+        for t in close.columns if has_data.get(t, False)
+    }
+
+
+def split_ticker(ticker):
+    code, _, suffix = ticker.partition(".")
+    return code, f".{suffix}"
+
+
+def add_price_info_all(dfs):
+    """
+    四張排行榜共用一次批次下載：取所有榜單代號的聯集 (依最新日期分組)，
+    批次缺漏的個股才逐檔補抓。
+    """
     price_map = {}
+    groups = {}
 
-    def one(meta):
-        code = str(meta["代號"])
-        suffix = str(meta["suffix"])
-        return code, get_week_price_info(code, suffix, str(meta["最新日期"]))
+    for df in dfs:
+        if df is None or df.empty:
+            continue
+        for code, suffix, latest in zip(df["代號"].astype(str), df["suffix"].astype(str), df["最新日期"].astype(str)):
+            groups.setdefault(latest, set()).add(f"{code}{suffix}")
 
-    with ThreadPoolExecutor(max_workers=PRICE_WORKERS) as ex:
-        futures = {ex.submit(one, meta): meta for meta in metas}
-        for fut in as_completed(futures):
-            try:
-                code, result = fut.result()
-                price_map[str(code)] = result
-            except Exception:
-                pass
+    for latest, tickers in groups.items():
+        tickers = sorted(tickers)
+        log(f"批次下載股價：{len(tickers)} 檔，資料日期 {latest}")
+        try:
+            result = fetch_week_price_table(tickers, latest)
+        except Exception as e:
+            log(f"⚠️ 批次股價下載失敗，改逐檔抓取：{repr(e)}")
+            result = {}
 
-    out["現價"] = out["代號"].astype(str).map(lambda c: price_map.get(c, ("-", "-"))[0])
-    out["週漲跌"] = out["代號"].astype(str).map(lambda c: price_map.get(c, ("-", "-"))[1])
+        missing = [t for t in tickers if t not in result]
+        if missing:
+            with ThreadPoolExecutor(max_workers=PRICE_WORKERS) as ex:
+                futures = {
+                    ex.submit(get_week_price_info, *split_ticker(t), latest): t
+                    for t in missing
+                }
+                for fut in as_completed(futures):
+                    try:
+                        result[futures[fut]] = fut.result()
+                    except Exception:
+                        pass
+
+        for t, info in result.items():
+            price_map[(latest, t)] = info
+
+    out_dfs = []
+    for df in dfs:
+        if df is None or df.empty:
+            out_dfs.append(df)
+            continue
+        out = df.copy()
+        keys = list(zip(out["最新日期"].astype(str), out["代號"].astype(str) + out["suffix"].astype(str)))
+        out["現價"] = [price_map.get(k, ("-", "-"))[0] for k in keys]
+        out["週漲跌"] = [price_map.get(k, ("-", "-"))[1] for k in keys]
+        out_dfs.append(out)
 
-    return out
+    return out_dfs
 
 
 # ================= 大戶排行歷史紀錄與連續上榜 =================
@@ -1331,86 +2436,134 @@ def rows_to_append_values(rows):
     return [[r.get(h, "") for h in HOLDER_HISTORY_HEADERS] for r in rows]
 
 
-def append_history_rows(ws, rows):
-    if ws is None:
+def history_row_key(r):
+    date = str(r.get("資料日期", "")).strip()
+    return (
+        normalize_history_date(date) if date else "",
+        str(r.get("榜單類型", "")).strip(),
+        str(r.get("市場", "")).strip(),
+        str(r.get("代號", "")).replace("'", "").strip(),
+    )
+
+
+class RankHistoryStore:
+    """
+    每週大戶排行紀錄的本機索引：整張工作表每次執行只讀一次。
+    - keys：(資料日期, 榜單類型, 市場, 代號)，避免重複寫入
+    - members：(榜單類型, 市場) → {資料日期: 排序後的代號陣列}，供連續上榜計算
+    新增的列同時 append 到工作表並更新索引，不再回讀工作表。
+    """
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.keys = set()
+        self.members = {}
+        self.n_records = 0
+
+        records = ws.get_all_records() if ws is not None else []
+        self.add(records)
+
+    def add(self, rows):
+        grouped = {}
+        for r in rows:
+            key = history_row_key(r)
+            self.keys.add(key)
+            self.n_records += 1
+
+            date, rank_type, market, code = key
+            if date and code:
+                grouped.setdefault((rank_type, market), {}).setdefault(date, []).append(code)
+
+        for group, by_date in grouped.items():
+            dates = self.members.setdefault(group, {})
+            for date, codes in by_date.items():
+                dates[date] = np.union1d(dates.get(date, np.empty(0, dtype=object)), np.array(codes, dtype=object))
+
+    def is_empty(self):
+        return self.n_records == 0
+
+    def streak_map(self):
+        """
+        每個 (榜單類型, 市場)：代號 × 日期 (新→舊) 的上榜矩陣，
+        連續上榜週數 = 從最新一週起第一個 False 之前的 True 數。
+        """
+        streak_map = {}
+
+        for (rank_type, market), by_date in self.members.items():
+            dates = sorted(by_date, key=lambda x: date_sort_key(x), reverse=True)
+            universe = np.unique(np.concatenate([by_date[d] for d in dates]))
+            member = np.stack([np.isin(universe, by_date[d], assume_unique=True) for d in dates], axis=1)
+
+            streak = np.where(member.all(axis=1), len(dates), member.argmin(axis=1))
+            for code, n in zip(universe[streak >= 2], streak[streak >= 2]):
+                streak_map[(rank_type, market, str(code))] = int(n)
+
+        return streak_map
+
+
+def append_history_rows(history, rows):
+    if history is None or history.ws is None:
         raise RuntimeError("工作表物件為空，無法寫入每週大戶排行紀錄。")
     if not rows:
         return 0
 
-    existing_records = ws.get_all_records()
-    existing_keys = set()
-
-    for r in existing_records:
-        existing_keys.add((
-            str(r.get("資料日期", "")).strip(),
-            str(r.get("榜單類型", "")).strip(),
-            str(r.get("市場", "")).strip(),
-            str(r.get("代號", "")).replace("'", "").strip(),
-        ))
-
     new_rows = []
+    seen = set(history.keys)
     for r in rows:
-        key = (
-            str(r.get("資料日期", "")).strip(),
-            str(r.get("榜單類型", "")).strip(),
-            str(r.get("市場", "")).strip(),
-            str(r.get("代號", "")).replace("'", "").strip(),
-        )
-        if key not in existing_keys:
+        key = history_row_key(r)
+        if key not in seen:
             new_rows.append(r)
-            existing_keys.add(key)
+            seen.add(key)
 
     if new_rows:
-        ws.append_rows(rows_to_append_values(new_rows), value_input_option="USER_ENTERED")
+        history.ws.append_rows(rows_to_append_values(new_rows), value_input_option="USER_ENTERED")
+        history.add(new_rows)
     return len(new_rows)
 
 
-def build_rank_rows_for_date(hist, market, date_idx, rank_type="增加", top_n=20):
+def build_rank_rows_for_weeks(hist, market, weeks, rank_type="增加", top_n=20):
+    """
+    一次算出第 1 ~ weeks-1 週 (0 為本週) 的前 N 名紀錄列：
+    比例矩陣只建一次，各週週增減與排名一起向量化計算。
+    """
     if hist is None or hist.empty:
         return []
 
-    date_cols = identify_date_columns(hist)
-    date_cols = sorted(date_cols, key=lambda x: date_sort_key(x), reverse=True)
-
-    if len(date_cols) < date_idx + 2:
+    date_cols, values = ratio_matrix_from_hist(hist)
+    last_idx = min(weeks - 1, len(date_cols) - 2)
+    if last_idx < 1:
         return []
 
-    cur_col = date_cols[date_idx]
-    prev_col = date_cols[date_idx + 1]
-    rank_date = normalize_history_date(cur_col)
-
-    df = hist.copy()
-    df["_diff"] = (
-        pd.to_numeric(df[cur_col], errors="coerce")
-        - pd.to_numeric(df[prev_col], errors="coerce")
-    ).round(2)
-    df = df.dropna(subset=["_diff"])
-
-    ascending = rank_type == "減少"
-    top_df = df.sort_values("_diff", ascending=ascending).head(top_n).copy()
+    diffs = np.round(values[:, 1:last_idx + 1] - values[:, 2:last_idx + 2], 2)
+    picks = top_n_indices(diffs, top_n, ascending=(rank_type == "減少"))
 
+    codes = hist["代號"].astype(str).to_numpy()
+    names = hist["股名"].astype(str).to_numpy()
+    cats = (hist["類別"] if "類別" in hist.columns else pd.Series("-", index=hist.index)).astype(str).to_numpy()
     write_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     rows = []
 
-    for rank, (_, row) in enumerate(top_df.iterrows(), start=1):
-        rows.append({
-            "資料日期": rank_date,
-            "榜單類型": rank_type,
-            "市場": market,
-            "排名": rank,
-            "代號": str(row.get("代號", "")),
-            "名稱": str(row.get("股名", "")),
-            "類別": str(row.get("類別", "-")),
-            "現價": "-",
-            "週漲跌": "-",
-            "總增減%": f"{float(row['_diff']):+.2f}%",
-            "寫入時間": write_time,
-        })
+    for j, idx in enumerate(picks):
+        rank_date = normalize_history_date(date_cols[j + 1])
+        for rank, i in enumerate(idx, start=1):
+            rows.append({
+                "資料日期": rank_date,
+                "榜單類型": rank_type,
+                "市場": market,
+                "排名": rank,
+                "代號": codes[i],
+                "名稱": names[i],
+                "類別": cats[i],
+                "現價": "-",
+                "週漲跌": "-",
+                "總增減%": f"{float(diffs[i, j]):+.2f}%",
+                "寫入時間": write_time,
+            })
 
     return rows
 
 
-def backfill_holder_history_from_ratio(ws, listed_hist, otc_hist, weeks):
+def backfill_holder_history_from_ratio(history, listed_hist, otc_hist, weeks):
     """
     用我們自己的比例歷史表回補最近幾週 Top20，
     不再回去爬 Norway。
@@ -1419,10 +2572,10 @@ def backfill_holder_history_from_ratio(ws, listed_hist, otc_hist, weeks):
 
     all_rows = []
     for market, hist in [("上市", listed_hist), ("上櫃", otc_hist)]:
-        for i in range(1, weeks):  # 從上一週開始回補；本週會用 current rows 寫入
-            all_rows.extend(build_rank_rows_for_date(hist, market, i, "增加", TOP_N))
+        # 從上一週開始回補；本週會用 current rows 寫入
+        all_rows.extend(build_rank_rows_for_weeks(hist, market, weeks, "增加", TOP_N))
 
-    added = append_history_rows(ws, all_rows)
+    added = append_history_rows(history, all_rows)
     log(f"歷史 Top20 回補完成，新增 {added} 筆。")
 
 
@@ -1455,62 +2608,29 @@ def build_current_history_rows(df, display_date, rank_type, market):
     return rows
 
 
-def append_current_rank_history(ws, listed_df, otc_df, display_date, rank_type):
+def append_current_rank_history(history, listed_df, otc_df, display_date, rank_type):
     rows = []
     rows.extend(build_current_history_rows(listed_df, display_date, rank_type, "上市"))
     rows.extend(build_current_history_rows(otc_df, display_date, rank_type, "上櫃"))
-    added = append_history_rows(ws, rows)
+    added = append_history_rows(history, rows)
     log(f"每週大戶{rank_type}排行本週紀錄新增 {added} 筆。")
 
 
-def compute_streak_map(ws):
-    streak_map = {}
-    if ws is None:
-        return streak_map
-
-    records = ws.get_all_records()
-    if not records:
-        return streak_map
-
-    df = pd.DataFrame(records)
-    required_cols = {"資料日期", "榜單類型", "市場", "代號"}
-    if not required_cols.issubset(df.columns):
-        return streak_map
-
-    df["資料日期"] = df["資料日期"].astype(str).str.strip()
-    df["榜單類型"] = df["榜單類型"].astype(str).str.strip()
-    df["市場"] = df["市場"].astype(str).str.strip()
-    df["代號"] = df["代號"].astype(str).str.replace("'", "", regex=False).str.strip()
-    df = df[(df["資料日期"] != "") & (df["代號"] != "")]
-
-    for (rank_type, market), group in df.groupby(["榜單類型", "市場"]):
-        dates = sorted(group["資料日期"].unique().tolist(), reverse=True)
-        date_code_map = {
-            d: set(group[group["資料日期"] == d]["代號"].astype(str).tolist())
-            for d in dates
-        }
-        all_codes = set(group["代號"].astype(str).tolist())
-        for code in all_codes:
-            streak = 0
-            for d in dates:
-                if code in date_code_map.get(d, set()):
-                    streak += 1
-                else:
-                    break
-            if streak >= 2:
-                streak_map[(rank_type, market, code)] = streak
-    return streak_map
+def compute_streak_map(history):
+    if history is None:
+        return {}
+    return history.streak_map()
 
 
-def maybe_extend_history_for_long_streak(ws, streak_map, listed_hist, otc_hist):
-    if ws is None or not streak_map:
+def maybe_extend_history_for_long_streak(history, streak_map, listed_hist, otc_hist):
+    if history is None or not streak_map:
         return streak_map
 
     max_streak = max(streak_map.values()) if streak_map else 0
     if max_streak >= HISTORY_INITIAL_WEEKS:
         log(f"偵測到連{max_streak}上榜股票，擴充回補最近 {HISTORY_EXTEND_WEEKS} 週歷史資料...")
-        backfill_holder_history_from_ratio(ws, listed_hist, otc_hist, HISTORY_EXTEND_WEEKS)
-        return compute_streak_map(ws)
+        backfill_holder_history_from_ratio(history, listed_hist, otc_hist, HISTORY_EXTEND_WEEKS)
+        return compute_streak_map(history)
     return streak_map
 
 
@@ -2105,16 +3225,20 @@ def push_rank_to_dc():
     history_ws = get_or_create_ws(sh, HOLDER_HISTORY_SHEET_NAME, HOLDER_HISTORY_HEADERS, rows=3000)
     listed_ratio_ws = get_or_create_ws(sh, LISTED_RATIO_SHEET_NAME, [], rows=2500, cols=80)
     otc_ratio_ws = get_or_create_ws(sh, OTC_RATIO_SHEET_NAME, [], rows=2500, cols=80)
-    api_ws = get_or_create_ws(sh, API_CACHE_SHEET_NAME, API_CACHE_HEADERS, rows=2500, cols=4)
+    api_ws = get_or_create_ws(sh, API_CACHE_SHEET_NAME, API_CACHE_HEADERS, rows=2500, cols=len(API_CACHE_HEADERS))
+    registry_ws = get_or_create_ws(sh, TICKER_REGISTRY_SHEET_NAME, TICKER_REGISTRY_HEADERS, rows=2500, cols=5)
 
     # 先讀 API 快取，再抓股票清單。
     # 若 ISIN 網站在 GitHub Actions 偶發 DNS 失敗，可用 Google Sheet 既有資料 fallback。
     cache = load_api_cache_from_sheet(api_ws)
     stock_df = fetch_all_stock_list(listed_ratio_ws, otc_ratio_ws, cache)
+    update_ticker_registry(registry_ws, stock_df)
 
     cache, cache_errors = ensure_api_cache_threaded(stock_df, cache, api_ws)
 
-    history_long, pscnet_errors = fetch_pscnet_history_all(stock_df, cache)
+    history_long, pscnet_errors = update_holder_store(stock_df, cache, [listed_ratio_ws, otc_ratio_ws])
+    # 記錄本週實際抓到 / 抓失敗的 API URL (驗證時間、失敗次數)。
+    save_api_cache_to_sheet(api_ws, cache)
 
     listed_hist = build_ratio_history_from_long(history_long, "上市")
     otc_hist = build_ratio_history_from_long(history_long, "上櫃")
@@ -2133,22 +3257,22 @@ def push_rank_to_dc():
     otc_dec_df = build_bottom_from_history(otc_hist, "上櫃")
 
     # 股價資訊
-    listed_df = add_price_info(listed_df)
-    otc_df = add_price_info(otc_df)
-    listed_dec_df = add_price_info(listed_dec_df)
-    otc_dec_df = add_price_info(otc_dec_df)
+    listed_df, otc_df, listed_dec_df, otc_dec_df = add_price_info_all(
+        [listed_df, otc_df, listed_dec_df, otc_dec_df]
+    )
 
     # 若歷史不足，先用 PSCNet ratio history 回補最近幾週前20。
-    records = history_ws.get_all_records()
-    if not records:
-        backfill_holder_history_from_ratio(history_ws, listed_hist, otc_hist, HISTORY_INITIAL_WEEKS)
+    # 每週大戶排行紀錄整張只讀這一次，之後寫入與連續上榜都用本機索引。
+    history = RankHistoryStore(history_ws)
+    if history.is_empty():
+        backfill_holder_history_from_ratio(history, listed_hist, otc_hist, HISTORY_INITIAL_WEEKS)
 
     # 寫入本週歷史：增加榜 / 減少榜
-    append_current_rank_history(history_ws, listed_df, otc_df, display_date, "增加")
-    append_current_rank_history(history_ws, listed_dec_df, otc_dec_df, display_date, "減少")
+    append_current_rank_history(history, listed_df, otc_df, display_date, "增加")
+    append_current_rank_history(history, listed_dec_df, otc_dec_df, display_date, "減少")
 
-    streak_map = compute_streak_map(history_ws)
-    streak_map = maybe_extend_history_for_long_streak(history_ws, streak_map, listed_hist, otc_hist)
+    streak_map = compute_streak_map(history)
+    streak_map = maybe_extend_history_for_long_streak(history, streak_map, listed_hist, otc_hist)
 
     listed_df = apply_streak_labels(listed_df, "上市", "增加", streak_map)
     otc_df = apply_streak_labels(otc_df, "上櫃", "增加", streak_map)
@@ -2176,5 +3300,47 @@ def push_rank_to_dc():
     log("=" * 100)
 
 
+def run_holder_analytics():
+    """分析模式：更新本機股權分散資料庫後，只輸出全市場籌碼分析表 (不推播、不寫排行紀錄)。"""
+    start = time.time()
+    log("=" * 100)
+    log("啟動：400張籌碼分析 (全市場累計增減 / Z 分數 / 百分位)")
+    log("=" * 100)
+
+    sh = connect_google_sheet()
+
+    listed_ratio_ws = get_or_create_ws(sh, LISTED_RATIO_SHEET_NAME, [], rows=2500, cols=80)
+    otc_ratio_ws = get_or_create_ws(sh, OTC_RATIO_SHEET_NAME, [], rows=2500, cols=80)
+    api_ws = get_or_create_ws(sh, API_CACHE_SHEET_NAME, API_CACHE_HEADERS, rows=2500, cols=len(API_CACHE_HEADERS))
+    analytics_ws = get_or_create_ws(sh, HOLDER_ANALYTICS_SHEET_NAME, [], rows=4000, cols=30)
+
+    cache = load_api_cache_from_sheet(api_ws)
+    stock_df = fetch_all_stock_list(listed_ratio_ws, otc_ratio_ws, cache)
+    cache, _ = ensure_api_cache_threaded(stock_df, cache, api_ws)
+
+    history_long, _ = update_holder_store(stock_df, cache, [listed_ratio_ws, otc_ratio_ws])
+    save_api_cache_to_sheet(api_ws, cache)
+
+    table = pd.concat([
+        build_holder_analytics(build_ratio_history_from_long(history_long, market), market)
+        for market in ["上市", "上櫃"]
+    ], ignore_index=True)
+
+    if table.empty:
+        raise RuntimeError("籌碼分析表沒有資料，請檢查股權分散資料庫。")
+
+    headers, rows = sheet_values_from_df(table)
+    overwrite_ws(analytics_ws, headers, rows)
+    save_holder_analytics(table)
+
+    log("=" * 100)
+    log(f"完成：籌碼分析 {len(table)} 檔，資料日期 {table['資料日期'].iloc[0]}")
+    log(f"耗時：{time.time() - start:.2f} 秒")
+    log("=" * 100)
+
+
 if __name__ == "__main__":
-    push_rank_to_dc()
+    if HOLDER_RANK_MODE == "analytics":
+        run_holder_analytics()
+    else:
+        push_rank_to_dc()
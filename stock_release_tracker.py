@@ -2,15 +2,27 @@ import gspread
 import requests
 import os
 import json
+import math
 import re
+import sqlite3
 import time
+import threading
+import bisect
+import itertools
 import yfinance as yf
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta, date
 from google.oauth2.service_account import Credentials
 from gspread.exceptions import WorksheetNotFound
+from gspread.utils import rowcol_to_a1
 from io import StringIO
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+try:
+    import pyarrow  # 事件表以 Parquet 輸出 (未安裝時改存 CSV)
+except Exception:
+    pyarrow = None
 
 # === 爬蟲相關套件 ===
 from selenium import webdriver
@@ -21,18 +33,72 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from webdriver_manager.chrome import ChromeDriverManager
 
+from stock_common import fetch_twse_punish_json, iter_month_ranges, yahoo_suffix_candidates
+from stock_common import load_ticker_registry as _load_ticker_registry
+
 # ============================
 # ⚙️ 設定區
 # ============================
 SHEET_NAME = "台股注意股資料庫_V33"
 DEST_WORKSHEET = "一年期處置回測數據" 
 MA_TOUCH_DETAIL_WORKSHEET = "月線回測個股明細"  # [新增] 月線回測個股逐筆明細工作表
+TICKER_REGISTRY_WORKSHEET = "股票市場對照"  # 代號→.TW/.TWO 對照 (stock_holder_rank.py 每週更新)
+TICKER_REGISTRY = {}
 
 SERVICE_KEY_FILE = "service_key.json"
 
 # ⚡ 法人判斷閥值
 THRESH_FOREIGN = 0.010  # 外資 1.0%
 THRESH_OTHERS  = 0.005  # 投信/自營 0.5%
+# ⚡ 處置期間漲跌幅分類閥值：±5% 強勢/疲軟、±15% 妖股/人去樓空
+STATUS_STRONG_PCT = 5
+STATUS_EXTREME_PCT = 15
+
+# 🏦 法人買賣超 (富邦 zcl.djhtm)：以 HTTP 直接抓取，多檔並行但限制整體請求速率
+INST_URL_TEMPLATE = "https://fubon-ebrokerdj.fbs.com.tw/z/zc/zcl/zcl.djhtm?a={stock_id}&c={start}&d={end}"
+INST_MAX_WORKERS = int(os.getenv("INST_MAX_WORKERS", "4"))
+INST_MIN_INTERVAL_SEC = float(os.getenv("INST_MIN_INTERVAL_SEC", "0.3"))  # 任兩次請求最短間隔
+INST_USE_SELENIUM = os.getenv("INST_USE_SELENIUM", "0") == "1"           # HTTP 失敗時是否退回瀏覽器
+
+# 📈 月線(MA20)回測條件 (參數掃描時可覆寫)
+MA_TOUCH_BAND_PCT = float(os.getenv("MA_TOUCH_BAND_PCT", "5"))            # 收盤價在 MA20 ±N% 內視為接近月線
+MA_TOUCH_MIN_SLOPE_PCT = float(os.getenv("MA_TOUCH_MIN_SLOPE_PCT", "1"))  # 買進日 MA20 斜率需 > N%
+MA_TOUCH_TRACK_DAYS = 20                                                  # 追蹤 D+1~D+N
+
+# 📈 股價下載：同一檔股票多次處置只下載一次涵蓋區間，多檔並行
+PRICE_MAX_WORKERS = int(os.getenv("PRICE_MAX_WORKERS", "8"))
+
+# 💾 本機快取目錄 (GitHub Actions 以 actions/cache 保留)
+LOCAL_CACHE_DIR = os.getenv("STOCK_CACHE_DIR", ".stock_cache")
+# 法人買賣超逐日資料庫：過去日期的資料不會再變，只補抓缺少的區間
+INST_STORE_FILE = os.path.join(LOCAL_CACHE_DIR, "institutional_flows.sqlite")
+# 回測事件表 (數值欄位 + 狀態分類)，每次回測整份輸出，供其他分析直接讀取
+EVENT_TABLE_FILE = os.path.join(LOCAL_CACHE_DIR, "release_events.parquet")
+# 處置事件清單與日線面板：每次回測順手存下，參數掃描模式直接讀取
+RELEASE_PANEL_FILE = os.path.join(LOCAL_CACHE_DIR, "release_panel.sqlite")
+
+# 🔬 參數掃描模式 (RELEASE_BACKTEST_MODE=sweep)：讀本機面板一次，多程序平行評估門檻組合
+RELEASE_BACKTEST_MODE = os.getenv("RELEASE_BACKTEST_MODE", "backtest")
+SWEEP_MAX_WORKERS = int(os.getenv("SWEEP_MAX_WORKERS", str(os.cpu_count() or 2)))
+SWEEP_RESULT_FILE = os.path.join(LOCAL_CACHE_DIR, "release_sweep_results.csv")
+SWEEP_GRID = {
+    "status_cutoffs": [(5, 15), (3, 10), (8, 20)],   # (強勢/疲軟, 妖股/人去樓空) 處置中漲跌幅%
+    "thresh_foreign": [0.005, 0.010, 0.020],
+    "thresh_others": [0.0025, 0.005, 0.010],
+    "ma_band_pct": [3, 5, 8],
+    "ma_min_slope_pct": [0.5, 1, 2],
+    "horizon": [10, 20],                            # 追蹤天數 (最多 20)
+}
+# 覆寫部分掃描參數 (掃描模式啟動時才解析)，例：SWEEP_GRID_JSON='{"ma_band_pct": [4, 5, 6], "horizon": [5, 10, 20]}'
+SWEEP_GRID_JSON = os.getenv("SWEEP_GRID_JSON", "").strip()
+
+# 🏛️ TPEx 處置公告：按月並行抓取，已結束的月份存本機後不再重抓
+TPEX_DISPOSAL_URL = "https://www.tpex.org.tw/www/zh-tw/bulletin/disposal"
+TPEX_MAX_WORKERS = int(os.getenv("TPEX_MAX_WORKERS", "4"))
+TPEX_MONTH_CACHE_DIR = os.path.join(LOCAL_CACHE_DIR, "tpex_disposal")
+
+# 📡 TWSE 處置公告 JSON 端點 (Selenium 僅作為選用備援)
+TWSE_PUNISH_USE_SELENIUM = os.getenv("TWSE_PUNISH_USE_SELENIUM", "0") == "1"
 
 # ============================
 # 🛠️ 爬蟲與工具函式
@@ -89,57 +155,112 @@ def parse_roc_date(date_str):
 # 📅 歷史名單爬取 (一年份核心邏輯)
 # ============================
 
+_TPEX_SESSION = requests.Session()
+_TPEX_SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(TPEX_MAX_WORKERS, 1)))
+
+def _tpex_month_cache_path(month_start):
+    return os.path.join(TPEX_MONTH_CACHE_DIR, f"{month_start.strftime('%Y-%m')}.json")
+
+def _fetch_tpex_month(month_start, batch_end, retries=3):
+    """抓取單一月份 (month_start ~ batch_end) 的上櫃處置公告，失敗回傳 None"""
+    sd_str = f"{month_start.year - 1911}/{month_start.month:02d}/{month_start.day:02d}"
+    ed_str = f"{batch_end.year - 1911}/{batch_end.month:02d}/{batch_end.day:02d}"
+    headers = {
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+        "X-Requested-With": "XMLHttpRequest",
+        "Content-Type": "application/x-www-form-urlencoded; charset=UTF-8",
+        "Referer": TPEX_DISPOSAL_URL
+    }
+    payload = {"startDate": sd_str, "endDate": ed_str, "response": "json"}
+
+    for attempt in range(retries):
+        try:
+            r = _TPEX_SESSION.post(TPEX_DISPOSAL_URL, data=payload, headers=headers, timeout=10)
+            r.raise_for_status()
+            data = r.json()
+            month_rows = []
+            if "tables" in data and len(data["tables"]) > 0:
+                for row in data["tables"][0].get("data", []):
+                    if len(row) < 6: continue
+                    c_code = str(row[2]).strip()
+                    c_name = str(row[3]).split("(")[0].strip()
+                    c_period = str(row[5]).strip()
+                    if c_code.isdigit() and len(c_code) == 4:
+                        month_rows.append({"Code": c_code, "Name": c_name, "Period": c_period, "Market": "上櫃"})
+            return month_rows
+        except Exception as e:
+            if attempt == retries - 1:
+                print(f"    ❌ TPEx {sd_str} 抓取失敗: {e}")
+            else:
+                time.sleep(1 + attempt)
+    return None
+
 def fetch_tpex_history_requests(start_date, end_date):
     """
-    [上櫃 TPEx] 使用 Requests 抓取歷史資料 (按月迴圈)
+    [上櫃 TPEx] 使用 Requests 抓取歷史資料 (按月切段、多月並行)
+    已結束的月份整月抓取並存成本機 JSON，之後直接讀取；只有當月與未來月份每次重新查詢
     """
     print(f"  [上櫃] 啟動 Requests 爬蟲，範圍: {start_date.strftime('%Y-%m-%d')} ~ {end_date.strftime('%Y-%m-%d')}")
-    
-    all_data = []
-    curr = start_date
+    today = datetime.now().date()
+
+    months = []   # (月初, 查詢截止日, 是否已結束)
+    curr = start_date.replace(day=1)
     while curr <= end_date:
         # 計算當月最後一天
         next_month = curr.replace(day=28) + timedelta(days=4)
         last_day_of_month = next_month - timedelta(days=next_month.day)
-        batch_end = min(last_day_of_month, end_date)
-        
-        sd_str = f"{curr.year - 1911}/{curr.month:02d}/{curr.day:02d}"
-        ed_str = f"{batch_end.year - 1911}/{batch_end.month:02d}/{batch_end.day:02d}"
-        
-        url = "https://www.tpex.org.tw/www/zh-tw/bulletin/disposal"
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-            "X-Requested-With": "XMLHttpRequest",
-            "Content-Type": "application/x-www-form-urlencoded; charset=UTF-8",
-            "Referer": "https://www.tpex.org.tw/www/zh-tw/bulletin/disposal"
-        }
-        payload = {"startDate": sd_str, "endDate": ed_str, "response": "json"}
-        
-        try:
-            r = requests.post(url, data=payload, headers=headers, timeout=10)
-            if r.status_code == 200:
-                data = r.json()
-                if "tables" in data and len(data["tables"]) > 0:
-                    rows = data["tables"][0].get("data", [])
-                    for row in rows:
-                        if len(row) < 6: continue
-                        c_code = str(row[2]).strip()
-                        c_name = str(row[3]).split("(")[0].strip()
-                        c_period = str(row[5]).strip()
-                        
-                        if c_code.isdigit() and len(c_code) == 4:
-                            all_data.append({
-                                "Code": c_code,
-                                "Name": c_name,
-                                "Period": c_period,
-                                "Market": "上櫃"
-                            })
-            time.sleep(0.5) 
-        except Exception as e:
-            print(f"    ❌ TPEx {sd_str} 抓取失敗: {e}")
-        
+        closed = last_day_of_month.date() < today
+        months.append((curr, last_day_of_month if closed else min(last_day_of_month, end_date), closed))
         curr = last_day_of_month + timedelta(days=1)
 
+    month_data = {}
+    to_fetch = []
+    for month_start, batch_end, closed in months:
+        if closed:
+            try:
+                with open(_tpex_month_cache_path(month_start), "r", encoding="utf-8") as f:
+                    month_data[month_start] = json.load(f)
+                continue
+            except Exception:
+                pass
+        to_fetch.append((month_start, batch_end, closed))
+
+    if to_fetch:
+        print(f"  [上櫃] 本機已有 {len(month_data)} 個月，需查詢 {len(to_fetch)} 個月 (workers={TPEX_MAX_WORKERS})")
+        with ThreadPoolExecutor(max_workers=max(TPEX_MAX_WORKERS, 1)) as pool:
+            futures = {pool.submit(_fetch_tpex_month, ms, be): (ms, closed) for ms, be, closed in to_fetch}
+            for f in as_completed(futures):
+                month_start, closed = futures[f]
+                month_rows = f.result()
+                if month_rows is None: continue
+                month_data[month_start] = month_rows
+                if closed and month_rows:
+                    try:
+                        os.makedirs(TPEX_MONTH_CACHE_DIR, exist_ok=True)
+                        with open(_tpex_month_cache_path(month_start), "w", encoding="utf-8") as fp:
+                            json.dump(month_rows, fp, ensure_ascii=False)
+                    except Exception as e:
+                        print(f"    ⚠️ TPEx {month_start.strftime('%Y-%m')} 快取寫入失敗: {e}")
+
+    all_data = [row for month_start in sorted(month_data) for row in month_data[month_start]]
+    if all_data:
+        return pd.DataFrame(all_data)
+    return pd.DataFrame()
+
+def fetch_twse_history(start_date, end_date):
+    """
+    [上市 TWSE] JSON 端點為主；TWSE_PUNISH_USE_SELENIUM=1 時失敗才退回 Selenium
+    """
+    print(f"  [上市] 啟動 JSON 爬蟲，範圍: {start_date.strftime('%Y-%m-%d')} ~ {end_date.strftime('%Y-%m-%d')}")
+    all_data = fetch_twse_punish_json(start_date, end_date, log=lambda msg: print(f"    ⚠️ {msg}"))
+
+    if all_data is None:
+        if TWSE_PUNISH_USE_SELENIUM:
+            print("  ⚠️ TWSE JSON 失敗，改用 Selenium 備援")
+            return fetch_twse_history_selenium(start_date, end_date)
+        print("  ❌ TWSE JSON 失敗 (未啟用 Selenium 備援)")
+        return pd.DataFrame()
+
     if all_data:
         return pd.DataFrame(all_data)
     return pd.DataFrame()
@@ -158,12 +279,7 @@ def fetch_twse_history_selenium(start_date, end_date):
         driver.get(url)
         wait = WebDriverWait(driver, 15)
         
-        curr = start_date
-        while curr <= end_date:
-            next_month = curr.replace(day=28) + timedelta(days=4)
-            last_day_of_month = next_month - timedelta(days=next_month.day)
-            batch_end = min(last_day_of_month, end_date)
-            
+        for curr, batch_end in iter_month_ranges(start_date, end_date):
             sd_str = curr.strftime("%Y%m%d")
             ed_str = batch_end.strftime("%Y%m%d")
             
@@ -198,8 +314,6 @@ def fetch_twse_history_selenium(start_date, end_date):
                     
             except Exception as e:
                 print(f"    ❌ TWSE {sd_str} 操作失敗: {e}")
-                
-            curr = last_day_of_month + timedelta(days=1)
             
     except Exception as e:
         print(f"  ❌ TWSE Driver 錯誤: {e}")
@@ -214,61 +328,390 @@ def fetch_twse_history_selenium(start_date, end_date):
 # 📊 整合與統計函式
 # ============================
 
-def determine_status(pre_pct, in_pct):
-    if in_pct > 15: return "👑 妖股誕生"
-    elif in_pct > 5: return "🔥 強勢突圍"
-    elif in_pct < -15: return "💀 人去樓空"
-    elif in_pct < -5: return "📉 走勢疲軟"
+STATUS_ORDER = ["👑 妖股誕生", "🔥 強勢突圍", "🧊 多空膠著", "📉 走勢疲軟", "💀 人去樓空"]
+INST_ORDER = ["🔴 土洋合購", "🔴 外資大買", "🔴 投信大買", "🔴 外資買/投信賣", "🔴 投信買/外資賣",
+              "🟢 土洋合賣", "🟢 外資大賣", "🟢 投信大賣", "🧊 無明顯動向"]
+
+def determine_status(pre_pct, in_pct, strong_pct=STATUS_STRONG_PCT, extreme_pct=STATUS_EXTREME_PCT):
+    if in_pct > extreme_pct: return "👑 妖股誕生"
+    elif in_pct > strong_pct: return "🔥 強勢突圍"
+    elif in_pct < -extreme_pct: return "💀 人去樓空"
+    elif in_pct < -strong_pct: return "📉 走勢疲軟"
     else: return "🧊 多空膠著"
 
+def determine_inst_status(r_f, r_t, thresh_foreign=THRESH_FOREIGN, thresh_others=THRESH_OTHERS):
+    """外資 / 投信買賣超佔處置期間基準量的比率 → 法人動向"""
+    is_foreign_buy = r_f > thresh_foreign
+    is_foreign_sell = r_f < -thresh_foreign
+    is_trust_buy = r_t > thresh_others
+    is_trust_sell = r_t < -thresh_others
+
+    if is_foreign_buy and is_trust_buy: return "🔴 土洋合購"
+    elif is_foreign_sell and is_trust_sell: return "🟢 土洋合賣"
+    elif is_foreign_buy and is_trust_sell: return "🔴 外資買/投信賣"
+    elif is_foreign_sell and is_trust_buy: return "🔴 投信買/外資賣"
+    elif is_foreign_buy: return "🔴 外資大買"
+    elif is_trust_buy: return "🔴 投信大買"
+    elif is_foreign_sell: return "🟢 外資大賣"
+    elif is_trust_sell: return "🟢 投信大賣"
+    return "🧊 無明顯動向"
+
+def status_codes(in_pct, strong_pct, extreme_pct):
+    """determine_status 的陣列版：回傳 STATUS_ORDER 的索引"""
+    return np.select(
+        [in_pct > extreme_pct, in_pct > strong_pct, in_pct < -extreme_pct, in_pct < -strong_pct],
+        [0, 1, 4, 3], default=2)
+
+def inst_status_codes(r_f, r_t, thresh_foreign, thresh_others):
+    """determine_inst_status 的陣列版 (比率為 NaN 視為無明顯動向)：回傳 INST_ORDER 的索引"""
+    with np.errstate(invalid='ignore'):
+        fb, fs = r_f > thresh_foreign, r_f < -thresh_foreign
+        tb, ts = r_t > thresh_others, r_t < -thresh_others
+    return np.select(
+        [fb & tb, fs & ts, fb & ts, fs & tb, fb, tb, fs, ts],
+        [0, 5, 3, 4, 1, 2, 6, 7], default=8)
+
+def load_ticker_registry(sh):
+    """讀取「股票市場對照」(代號 → '.TW' / '.TWO')，由 stock_holder_rank.py 每週更新"""
+    _load_ticker_registry(sh, TICKER_REGISTRY, TICKER_REGISTRY_WORKSHEET, log=lambda msg: print(f"📒 {msg}"))
+
 def get_ticker_list(code, market=""):
     code = str(code)
-    if "上櫃" in market or "TPEx" in market: return [f"{code}.TWO", f"{code}.TW"]
-    if "上市" in market: return [f"{code}.TW", f"{code}.TWO"]
-    if code and code[0] in ['3', '4', '5', '6', '8']: return [f"{code}.TWO", f"{code}.TW"]
-    return [f"{code}.TW", f"{code}.TWO"]
+    if "上櫃" in market or "TPEx" in market: suffix = ".TWO"
+    elif "上市" in market: suffix = ".TW"
+    elif code and code[0] in ['3', '4', '5', '6', '8']: suffix = ".TWO"
+    else: suffix = ".TW"
+    # 股票市場對照有的代號以對照後綴優先，另一個後綴仍保留為備援
+    return [f"{code}{s}" for s in yahoo_suffix_candidates(code, TICKER_REGISTRY, suffix)]
+
+_INST_SESSION = requests.Session()
+_INST_SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(INST_MAX_WORKERS, 1)))
+_INST_RATE_LOCK = threading.Lock()
+_INST_LAST_REQUEST = [0.0]
+_INST_RESULT_CACHE = {}
+_INST_DRIVER = None
+_INST_DRIVER_LOCK = threading.Lock()
+_INST_STORE = None
+_INST_STORE_LOCK = threading.Lock()
+
+def _inst_rate_wait():
+    """全域速率限制：所有執行緒共用，確保兩次請求間隔至少 INST_MIN_INTERVAL_SEC"""
+    with _INST_RATE_LOCK:
+        wait = _INST_LAST_REQUEST[0] + INST_MIN_INTERVAL_SEC - time.time()
+        if wait > 0: time.sleep(wait)
+        _INST_LAST_REQUEST[0] = time.time()
+
+def parse_institutional_html(html):
+    """解析 zcl.djhtm 頁面中的法人買賣超表格"""
+    tables = pd.read_html(StringIO(html))
+    target_df = None
+    for df in tables:
+        if df.astype(str).apply(lambda x: x.str.contains('外資', na=False)).any().any():
+            target_df = df
+            break
+    if target_df is None:
+        return None
+    clean_df = target_df.copy()
+    clean_df.columns = clean_df.iloc[0]
+    clean_df = clean_df[1:].iloc[:, 0:4]
+    clean_df.columns = ['日期', '外資買賣超', '投信買賣超', '自營商買賣超']
+    clean_df = clean_df[clean_df['日期'].apply(is_valid_date_row)]
+    for col in ['外資買賣超', '投信買賣超', '自營商買賣超']:
+        clean_df[col] = pd.to_numeric(clean_df[col].astype(str).str.replace(',', '').str.replace('+', ''), errors='coerce').fillna(0)
+    clean_df['DateStr'] = clean_df['日期'].apply(roc_to_datestr)
+    return clean_df.dropna(subset=['DateStr'])
+
+def _fetch_institutional_http(stock_id, start_date, end_date, retries=3):
+    url = INST_URL_TEMPLATE.format(stock_id=stock_id, start=start_date, end=end_date)
+    headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"}
+    last_err = None
+    for attempt in range(retries):
+        try:
+            _inst_rate_wait()
+            r = _INST_SESSION.get(url, headers=headers, timeout=15)
+            r.raise_for_status()
+            # 頁面為 Big5；伺服器未宣告 charset 時 requests 會誤判為 ISO-8859-1
+            if not r.encoding or r.encoding.lower() == "iso-8859-1":
+                r.encoding = "cp950"
+            return parse_institutional_html(r.text)
+        except Exception as e:
+            last_err = e
+            time.sleep(1.0 * (attempt + 1))
+    raise last_err
+
+def _fetch_institutional_selenium(stock_id, start_date, end_date):
+    """備援：共用單一瀏覽器 (INST_USE_SELENIUM=1 才會使用)"""
+    global _INST_DRIVER
+    url = INST_URL_TEMPLATE.format(stock_id=stock_id, start=start_date, end=end_date)
+    with _INST_DRIVER_LOCK:
+        if _INST_DRIVER is None:
+            _INST_DRIVER = get_driver()
+        _INST_DRIVER.get(url)
+        time.sleep(1.0)
+        html = _INST_DRIVER.page_source
+    return parse_institutional_html(html)
+
+def close_institutional_driver():
+    global _INST_DRIVER
+    if _INST_DRIVER is not None:
+        try: _INST_DRIVER.quit()
+        except Exception: pass
+        _INST_DRIVER = None
+
+# ============================
+# 💾 法人買賣超本機資料庫 (stock_id × 日期)
+# ============================
+def _get_inst_store():
+    """開啟 (或建立) 法人資料庫；呼叫端需持有 _INST_STORE_LOCK"""
+    global _INST_STORE
+    if _INST_STORE is None:
+        os.makedirs(LOCAL_CACHE_DIR, exist_ok=True)
+        conn = sqlite3.connect(INST_STORE_FILE, check_same_thread=False)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS inst_daily (
+                stock_id TEXT NOT NULL,
+                date TEXT NOT NULL,
+                foreign_net REAL,
+                trust_net REAL,
+                dealer_net REAL,
+                PRIMARY KEY (stock_id, date)
+            )
+        """)
+        # 已抓取過的日期區間 (含無交易日)，用來判斷哪些區間還需要補抓
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS inst_coverage (
+                stock_id TEXT NOT NULL,
+                start_date TEXT NOT NULL,
+                end_date TEXT NOT NULL
+            )
+        """)
+        conn.commit()
+        _INST_STORE = conn
+    return _INST_STORE
+
+def close_inst_store():
+    global _INST_STORE
+    with _INST_STORE_LOCK:
+        if _INST_STORE is not None:
+            _INST_STORE.close()
+            _INST_STORE = None
+
+def _inst_missing_ranges(stock_id, start_date, end_date):
+    """回傳 [start_date, end_date] 中尚未被資料庫涵蓋的區間 (date 物件，含頭尾)"""
+    with _INST_STORE_LOCK:
+        rows = _get_inst_store().execute(
+            "SELECT start_date, end_date FROM inst_coverage WHERE stock_id = ? AND end_date >= ? AND start_date <= ? ORDER BY start_date",
+            (stock_id, start_date.isoformat(), end_date.isoformat())
+        ).fetchall()
+
+    missing = []
+    cursor = start_date
+    for cs, ce in rows:
+        cs, ce = date.fromisoformat(cs), date.fromisoformat(ce)
+        if cs > cursor:
+            missing.append((cursor, min(cs - timedelta(days=1), end_date)))
+        cursor = max(cursor, ce + timedelta(days=1))
+        if cursor > end_date: break
+    if cursor <= end_date:
+        missing.append((cursor, end_date))
+    return missing
+
+def _inst_store_save(stock_id, df, start_date, end_date):
+    """寫入抓到的逐日資料；只有今天以前的日期才記為已涵蓋 (今天盤後資料可能尚未公布)"""
+    rows = [
+        (stock_id, r['DateStr'], float(r['外資買賣超']), float(r['投信買賣超']), float(r['自營商買賣超']))
+        for _, r in df.iterrows()
+    ]
+    settled_end = min(end_date, date.today() - timedelta(days=1))
+    with _INST_STORE_LOCK:
+        conn = _get_inst_store()
+        conn.executemany("INSERT OR REPLACE INTO inst_daily VALUES (?, ?, ?, ?, ?)", rows)
+        if settled_end >= start_date:
+            conn.execute("INSERT INTO inst_coverage VALUES (?, ?, ?)", (stock_id, start_date.isoformat(), settled_end.isoformat()))
+        conn.commit()
+
+def _inst_store_load(stock_id, start_date, end_date):
+    with _INST_STORE_LOCK:
+        rows = _get_inst_store().execute(
+            "SELECT date, foreign_net, trust_net, dealer_net FROM inst_daily WHERE stock_id = ? AND date BETWEEN ? AND ? ORDER BY date",
+            (stock_id, start_date.isoformat(), end_date.isoformat())
+        ).fetchall()
+    df = pd.DataFrame(rows, columns=['DateStr', '外資買賣超', '投信買賣超', '自營商買賣超'])
+    df['日期'] = df['DateStr'].apply(lambda d: f"{int(d[:4]) - 1911}/{d[5:7]}/{d[8:10]}")
+    return df[['日期', '外資買賣超', '投信買賣超', '自營商買賣超', 'DateStr']]
+
+def _fetch_institutional_range(stock_id, start_str, end_str):
+    try:
+        return _fetch_institutional_http(stock_id, start_str, end_str)
+    except Exception as e:
+        print(f"⚠️ 法人資料 HTTP 失敗 {stock_id}: {e}")
+        if INST_USE_SELENIUM:
+            try:
+                return _fetch_institutional_selenium(stock_id, start_str, end_str)
+            except Exception as e2:
+                print(f"⚠️ 爬蟲錯誤 {stock_id}: {e2}")
+        return None
 
 def get_institutional_data(stock_id, start_date, end_date):
-    """爬取法人買賣超 (富邦證券)"""
-    driver = get_driver()
+    """法人買賣超 (富邦證券)：優先由本機資料庫回答，只抓缺少的日期區間"""
     if isinstance(start_date, datetime): start_date = start_date.strftime("%Y-%m-%d")
     if isinstance(end_date, datetime): end_date = end_date.strftime("%Y-%m-%d")
-    
-    url = f"https://fubon-ebrokerdj.fbs.com.tw/z/zc/zcl/zcl.djhtm?a={stock_id}&c={start_date}&d={end_date}"
+    stock_id = str(stock_id)
+
+    cache_key = (stock_id, start_date, end_date)
+    if cache_key in _INST_RESULT_CACHE:
+        return _INST_RESULT_CACHE[cache_key]
+
+    result = None
     try:
-        driver.get(url)
-        time.sleep(1.0)
-        html = driver.page_source
-        tables = pd.read_html(StringIO(html))
-        target_df = None
-        for df in tables:
-            if df.astype(str).apply(lambda x: x.str.contains('外資', na=False)).any().any():
-                target_df = df
+        sd, ed = date.fromisoformat(start_date), date.fromisoformat(end_date)
+        ok = True
+        for ms, me in _inst_missing_ranges(stock_id, sd, ed):
+            fetched = _fetch_institutional_range(stock_id, ms.isoformat(), me.isoformat())
+            if fetched is None:
+                ok = False
                 break
-        if target_df is not None:
-            clean_df = target_df.copy()
-            clean_df.columns = clean_df.iloc[0]
-            clean_df = clean_df[1:].iloc[:, 0:4]
-            clean_df.columns = ['日期', '外資買賣超', '投信買賣超', '自營商買賣超']
-            clean_df = clean_df[clean_df['日期'].apply(is_valid_date_row)]
-            for col in ['外資買賣超', '投信買賣超', '自營商買賣超']:
-                clean_df[col] = pd.to_numeric(clean_df[col].astype(str).str.replace(',', '').str.replace('+', ''), errors='coerce').fillna(0)
-            clean_df['DateStr'] = clean_df['日期'].apply(roc_to_datestr)
-            return clean_df.dropna(subset=['DateStr'])
+            _inst_store_save(stock_id, fetched, ms, me)
+        if ok:
+            result = _inst_store_load(stock_id, sd, ed)
     except Exception as e:
-        print(f"⚠️ 爬蟲錯誤 {stock_id}: {e}")
-        return None
-    finally:
-        driver.quit()
+        print(f"⚠️ 法人資料庫錯誤 {stock_id}: {e}")
+        result = None
+
+    _INST_RESULT_CACHE[cache_key] = result
+    return result
+
+def prefetch_institutional_data(jobs):
+    """
+    多檔並行預先抓取法人資料 (jobs: [(stock_id, start_date, end_date), ...])
+    結果存入快取，之後 fetch_stock_data 呼叫 get_institutional_data 時直接取用
+    """
+    jobs = list(dict.fromkeys(jobs))
+    if not jobs: return
+    print(f"🏦 並行抓取法人資料: {len(jobs)} 筆 (workers={INST_MAX_WORKERS}, 間隔≥{INST_MIN_INTERVAL_SEC}s)")
+    with ThreadPoolExecutor(max_workers=max(INST_MAX_WORKERS, 1)) as pool:
+        futures = [pool.submit(get_institutional_data, *job) for job in jobs]
+        for f in as_completed(futures):
+            try: f.result()
+            except Exception: pass
+
+# ============================
+# ⏩ 回測前置：交易日曆與既有結果沿用
+# ============================
+def get_trading_calendar(start_date, end_date):
+    """以加權指數 (^TWII) 日線取得交易日清單；下載失敗時退回週一至週五"""
+    try:
+        df = yf.Ticker("^TWII").history(start=start_date.strftime("%Y-%m-%d"),
+                                         end=end_date.strftime("%Y-%m-%d"), auto_adjust=True)
+        if not df.empty:
+            return sorted({d.date() for d in df.index.tz_localize(None)})
+    except Exception as e:
+        print(f"⚠️ 交易日曆下載失敗，改用平日推算: {e}")
+    return [d.date() for d in pd.bdate_range(start_date, end_date)]
+
+def derive_release_date(jail_end_date, trade_dates):
+    """出關日 = 處置結束日後第一個交易日 (與 fetch_stock_data 的推算一致)，日曆不足時取隔天"""
+    end_d = jail_end_date.date() if isinstance(jail_end_date, datetime) else jail_end_date
+    idx = bisect.bisect_right(trade_dates, end_d)
+    if idx < len(trade_dates):
+        return trade_dates[idx]
+    return end_d + timedelta(days=1)
+
+def load_ma_detail_map(sh):
+    """
+    讀取既有「月線回測個股明細」，Key: 股號_出關日期，供沿用已完成事件的月線回測數據
+    detail_map 值為 {"ma_returns": D+1~D+20 (NaN 為缺值), "ma_slope": 斜率}
+    回傳 (detail_map, values)；values 為工作表原始內容，寫回時只更新有變動的列
+    """
+    detail_map = {}
+    try:
+        values = sh.worksheet(MA_TOUCH_DETAIL_WORKSHEET).get_all_values()
+    except Exception:
+        return detail_map, []
+    for row in values[1:]:
+        if len(row) < 8 or not re.match(r"^\d{4}/\d{2}/\d{2}$", str(row[0]).strip()): continue
+        slope = parse_pct(row[7])
+        if np.isnan(slope): continue
+        returns = np.array([parse_pct(v) for v in (list(row[8:28]) + [""] * 20)[:20]], dtype=float)
+        detail_map[f"{row[1]}_{row[0]}"] = {"ma_returns": returns, "ma_slope": slope}
+    return detail_map, values
 
 # ============================
 # 📈 [新增] 月線(MA20)回測統計函式
 # ============================
-def get_ma_touch_stats(df, start_date, end_date, pre_pct_val):
+def compute_ma_touch_panel(panel, events, band_pct=MA_TOUCH_BAND_PCT,
+                           min_slope_pct=MA_TOUCH_MIN_SLOPE_PCT, horizon=MA_TOUCH_TRACK_DAYS):
+    """
+    月線回測 (向量化版)：一次處理多筆處置事件。
+
+    panel：堆疊後的日線，index 為日期，欄位 event (事件編號 0..N-1，同事件連續且依日期排序) 與 Close
+    events：DataFrame，index 為事件編號，欄位 start / end (處置起訖日) 與 pre_pct (處置前漲跌幅%)
+
+    每筆事件回傳 None 或 {"returns": [D+1~D+horizon 漲跌幅, 不足補 None], "slope": 買進日 MA20 斜率(%)}
+    條件與 get_ma_touch_stats 相同：pre_pct > 0、處置期間第一個收盤價落在 MA20 ±band_pct% 的日子為買進日、
+    買進日 MA20 斜率 > min_slope_pct。
+    """
+    n_events = len(events)
+    results = [None] * n_events
+    if n_events == 0 or panel.empty:
+        return results
+
+    event_ids = panel['event'].to_numpy(dtype=np.int64)
+    close = panel['Close'].to_numpy(dtype=float)
+    dates = panel.index.values
+    n = len(close)
+
+    # 每筆事件各自計算 MA20 (不跨事件)
+    ma = panel['Close'].groupby(event_ids).rolling(window=20).mean().to_numpy()
+    pos = np.arange(n)
+    is_first_row = np.r_[True, event_ids[1:] != event_ids[:-1]]
+    group_first = np.maximum.accumulate(np.where(is_first_row, pos, 0))
+    is_last_row = np.r_[event_ids[1:] != event_ids[:-1], True]
+    group_last = np.minimum.accumulate(np.where(is_last_row, pos, n - 1)[::-1])[::-1]
+
+    start = events['start'].to_numpy(dtype='datetime64[ns]')[event_ids]
+    end = events['end'].to_numpy(dtype='datetime64[ns]')[event_ids]
+    band = band_pct / 100.0
+    with np.errstate(invalid='ignore'):
+        touch = (
+            (dates >= start) & (dates <= end) & ~np.isnan(ma)
+            & (ma * (1 - band) <= close) & (close <= ma * (1 + band))
+        )
+
+    touch_pos = np.flatnonzero(touch)
+    if len(touch_pos) == 0:
+        return results
+    touch_events, first_idx = np.unique(event_ids[touch_pos], return_index=True)
+    t = touch_pos[first_idx]
+
+    # 買進日 MA20 斜率：(當天MA20 - 前一交易日MA20) / 前一交易日MA20 × 100
+    has_prev = t > group_first[t]
+    ma_prev = np.where(has_prev, ma[np.maximum(t - 1, 0)], np.nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = (ma[t] - ma_prev) / ma_prev * 100
+    pre_pct = events['pre_pct'].to_numpy(dtype=float)[touch_events]
+    ok = (pre_pct > 0) & np.isfinite(slope) & (slope > min_slope_pct) & (close[t] != 0)
+
+    # D+1~D+horizon：以買進日收盤為基準的逐日漲跌幅
+    steps = t[:, None] + 1 + np.arange(horizon)[None, :]
+    valid = steps <= group_last[t][:, None]
+    safe_steps = np.minimum(steps, n - 1)
+    prev_close = close[safe_steps - 1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rets = (close[safe_steps] - prev_close) / prev_close * 100
+    valid &= (prev_close != 0) & np.isfinite(rets)
+
+    for k in np.flatnonzero(ok):
+        returns = [float(r) if v else None for r, v in zip(rets[k], valid[k])]
+        results[touch_events[k]] = {"returns": returns, "slope": round(float(slope[k]), 4)}
+    return results
+
+def get_ma_touch_stats(df, start_date, end_date, pre_pct_val, band_pct=MA_TOUCH_BAND_PCT,
+                       min_slope_pct=MA_TOUCH_MIN_SLOPE_PCT, horizon=MA_TOUCH_TRACK_DAYS):
     """
     計算「上漲進處置 + 買進日MA20斜率>1% + 處置期間股價接近月線±5%」後的 D+1~D+20 每日漲跌幅。
 
-    條件說明：
+    條件說明 (±band_pct%、斜率 min_slope_pct% 與追蹤天數 horizon 可調整)：
     1. pre_pct_val > 0：股票在處置前期間為上漲走勢 (因上漲進入處置)
     2. 處置期間至少有一天收盤價落在 MA20 的 ±5% 範圍內
        即：MA20 * 0.95 <= Close <= MA20 * 1.05，此日為「買進日」
@@ -278,230 +721,720 @@ def get_ma_touch_stats(df, start_date, end_date, pre_pct_val):
     - D+1 為買進日隔天漲跌幅，以買進日收盤價為基準，往後追蹤 D+1~D+20
     - 回傳 dict：{"returns": [D+1~D+20 漲跌幅, 不足補 None], "slope": 買進日 MA20 斜率(%)}
     - 若任一條件不符合則回傳 None
+    - 單筆事件版本，實際計算交給 compute_ma_touch_panel
     """
     try:
-        # 條件 1: 因上漲進入處置 (處置前漲幅 > 0)
         if pre_pct_val <= 0:
             return None
+        panel = pd.DataFrame({'event': 0, 'Close': df['Close'].to_numpy(dtype=float)}, index=df.index)
+        events = pd.DataFrame({'start': [pd.Timestamp(start_date)], 'end': [pd.Timestamp(end_date)], 'pre_pct': [pre_pct_val]})
+        return compute_ma_touch_panel(panel, events, band_pct, min_slope_pct, horizon)[0]
+    except Exception as e:
+        return None
 
-        df_calc = df.copy()
-
-        # 計算 MA20 (月線，20日移動平均)
-        df_calc['MA20'] = df_calc['Close'].rolling(window=20).mean()
-
-        # 取處置期間資料，排除 MA20 為 NaN 的列
-        mask_jail = (
-            (df_calc.index >= pd.Timestamp(start_date)) &
-            (df_calc.index <= pd.Timestamp(end_date))
-        )
-        df_jail = df_calc[mask_jail].dropna(subset=['MA20'])
-
-        if len(df_jail) < 1:
-            return None
-
-        # 條件 2: 找處置期間第一個收盤價在 MA20 ±5% 範圍內的日子 (買進日)
-        # 即：MA20 * 0.95 <= Close <= MA20 * 1.05
-        touch_idx = None
-        for i in range(len(df_jail)):
-            ma_val = float(df_jail['MA20'].iloc[i])
-            close_val = float(df_jail['Close'].iloc[i])
-            if ma_val * 0.95 <= close_val <= ma_val * 1.05:
-                touch_idx = i
-                break
-
-        if touch_idx is None:
-            return None
+def download_price_history(code, fetch_start, fetch_end, market=""):
+    """下載 Yahoo 日線 (auto_adjust)，依 get_ticker_list 順序嘗試，回傳去除時區的 DataFrame"""
+    for ticker in get_ticker_list(code, market):
+        try:
+            temp_df = yf.Ticker(ticker).history(start=fetch_start.strftime("%Y-%m-%d"), 
+                                              end=fetch_end.strftime("%Y-%m-%d"), 
+                                              auto_adjust=True)
+            if not temp_df.empty:
+                temp_df.index = temp_df.index.tz_localize(None)
+                return temp_df
+        except Exception:
+            continue
+    return pd.DataFrame()
 
-        # 條件 3: 計算買進日當天的 MA20 斜率 (當天MA20 - 前一天MA20)
-        touch_ma_now = float(df_jail['MA20'].iloc[touch_idx])
-        if touch_idx > 0:
-            # 前一天在 df_jail 內
-            touch_ma_prev = float(df_jail['MA20'].iloc[touch_idx - 1])
+def price_windows(events):
+    """每檔股票涵蓋所有處置事件的下載區間 {code: (fetch_start, fetch_end, market)}"""
+    windows = {}
+    for code, _, market, s_date, e_date in events:
+        fs, fe = s_date - timedelta(days=365), e_date + timedelta(days=65)
+        if code in windows:
+            old_fs, old_fe, old_market = windows[code]
+            windows[code] = (min(old_fs, fs), max(old_fe, fe), old_market)
         else:
-            # touch_idx == 0，需從 df_calc 找 df_jail 第一天的前一個交易日
-            jail_first_loc = df_calc.index.get_loc(df_jail.index[0])
-            if jail_first_loc > 0 and not pd.isna(df_calc['MA20'].iloc[jail_first_loc - 1]):
-                touch_ma_prev = float(df_calc['MA20'].iloc[jail_first_loc - 1])
-            else:
-                return None  # 無法取得前一天 MA20，無法計算斜率
-
-        # 斜率 = (今日MA20 - 昨日MA20) / 昨日MA20 × 100%
-        if touch_ma_prev == 0:
-            return None
-        touch_slope = ((touch_ma_now - touch_ma_prev) / touch_ma_prev) * 100
+            windows[code] = (fs, fe, market)
+    return windows
 
-        # 買進日當天斜率必須 > 1 (即月線一天上漲超過 1%)
-        if touch_slope <= 1:
-            return None
-
-        touch_date = df_jail.index[touch_idx]
-        base_price = float(df_jail['Close'].iloc[touch_idx])
-
-        if base_price == 0:
-            return None
-
-        # D+1~D+20：以買進日收盤為基準，取隔天起的 20 個交易日
-        df_after = df_calc[df_calc.index > touch_date].head(20)
-
-        returns = []
-        for i in range(20):
-            if i < len(df_after):
-                curr = float(df_after['Close'].iloc[i])
-                prev = float(df_after['Close'].iloc[i - 1]) if i > 0 else base_price
-                if prev != 0:
-                    returns.append(((curr - prev) / prev) * 100)
-                else:
-                    returns.append(None)
-            else:
-                returns.append(None)
-
-        return {"returns": returns, "slope": round(touch_slope, 4)}
+def prefetch_price_histories(events):
+    """
+    依股號分組，每檔只下載一次涵蓋所有處置事件的區間 (最早 s-365 ~ 最晚 e+65)，多檔並行
+    events: [(code, name, market, s_date, e_date), ...]；回傳 {code: DataFrame}
+    """
+    windows = price_windows(events)
+    if not windows: return {}
+
+    print(f"📈 下載股價: {len(windows)} 檔 (共 {len(events)} 筆處置事件, workers={PRICE_MAX_WORKERS})")
+    price_map = {}
+    with ThreadPoolExecutor(max_workers=max(PRICE_MAX_WORKERS, 1)) as pool:
+        futures = {pool.submit(download_price_history, code, fs, fe, market): code
+                   for code, (fs, fe, market) in windows.items()}
+        for f in as_completed(futures):
+            try: price_map[futures[f]] = f.result()
+            except Exception: price_map[futures[f]] = pd.DataFrame()
+    return price_map
+
+def compute_event_metrics(df, start_date, jail_end_date, track_days=20):
+    """
+    處置事件的數值指標 (df 為已 ffill 的日線，與門檻無關，參數掃描時只需算一次)
+    回傳 pre_pct / in_pct / 處置前60日均量 / 處置天數 / 出關基準價 / 出關後收盤 (長度 track_days，不足補 NaN)
+    """
+    mask_jail = (df.index >= pd.Timestamp(start_date)) & (df.index <= pd.Timestamp(jail_end_date))
+    df_jail = df[mask_jail]
+    mask_before = df.index < pd.Timestamp(start_date)
+    
+    pre_pct = 0.0
+    in_pct = 0.0
+    pre_jail_avg_volume = 0
+    
+    if mask_before.any():
+        df_before = df[mask_before]
+        pre_jail_avg_volume = df_before['Volume'].tail(60).mean()
+        # 處置前%：處置幾天就往前找同樣天數，用 Close-to-Close 計算累積漲跌幅
+        jail_days = len(df_jail)
+        pre_exit_price = float(df_before['Close'].iloc[-1])   # 處置開始前最後一天收盤
+        if jail_days > 0 and len(df_before) >= jail_days:
+            pre_entry_price = float(df_before['Close'].iloc[-jail_days])
+        elif not df_before.empty:
+            pre_entry_price = float(df_before['Close'].iloc[0])
+        else:
+            pre_entry_price = pre_exit_price
+        if pre_entry_price != 0:
+            pre_pct = ((pre_exit_price - pre_entry_price) / pre_entry_price) * 100
+
+    jail_end_price = 0
+    if not df_jail.empty:
+        jail_start_price = df_jail['Open'].iloc[0]
+        jail_end_price = df_jail['Close'].iloc[-1]
+        if jail_start_price != 0:
+            in_pct = ((jail_end_price - jail_start_price) / jail_start_price) * 100
+
+    df_after = df[df.index > pd.Timestamp(jail_end_date)]
+    if not df_after.empty:
+        release_date = df_after.index[0]
+    else:
+        release_date = pd.Timestamp(jail_end_date + timedelta(days=1))
+
+    base_price = jail_end_price if jail_end_price != 0 else (df_after['Open'].iloc[0] if not df_after.empty else 0)
+    after_close = df_after['Close'].to_numpy(dtype=float)[:track_days]
+    post_close = np.full(track_days, np.nan)
+    post_close[:len(after_close)] = after_close
+
+    return {
+        "pre_pct": pre_pct,
+        "in_pct": in_pct,
+        "pre_jail_avg_volume": pre_jail_avg_volume,
+        "jail_days": len(df_jail),
+        "base_price": base_price,
+        "post_close": post_close,
+        "n_after": len(after_close),
+        "release_date": release_date,
+    }
 
-    except Exception as e:
-        return None
+def compute_inst_ratios(inst_df, pre_jail_avg_volume, jail_days):
+    """外資 / 投信處置期間買賣超 (張→股) 佔「處置前均量 × 處置天數」的比率"""
+    bm_shares = pre_jail_avg_volume * jail_days
+    if bm_shares == 0: bm_shares = 1
+    r_f = (inst_df['外資買賣超'].sum() * 1000) / bm_shares
+    r_t = (inst_df['投信買賣超'].sum() * 1000) / bm_shares
+    return r_f, r_t
 
-def fetch_stock_data(code, start_date, jail_end_date, market=""):
-    """抓取股價與法人資料"""
+def fetch_stock_data(code, start_date, jail_end_date, market="", price_df=None):
+    """
+    抓取股價與法人資料 (price_df 為該股預先下載的涵蓋區間，依本事件區間切片)
+    回傳型別化事件紀錄：數值漲跌幅、D+1~D+20 float 陣列、STATUS_ORDER / INST_ORDER 索引、月線回測陣列與斜率；
+    字串格式化留給寫入工作表時的 format_event_row
+    """
     try:
         fetch_start = start_date - timedelta(days=365)
         fetch_end = jail_end_date + timedelta(days=65) 
         
-        tickers_to_try = get_ticker_list(code, market)
-        df = pd.DataFrame()
-        
-        for ticker in tickers_to_try:
-            try:
-                temp_df = yf.Ticker(ticker).history(start=fetch_start.strftime("%Y-%m-%d"), 
-                                                  end=fetch_end.strftime("%Y-%m-%d"), 
-                                                  auto_adjust=True)
-                if not temp_df.empty:
-                    df = temp_df
-                    break
-            except Exception:
-                continue
+        if price_df is None:
+            df = download_price_history(code, fetch_start, fetch_end, market)
+        elif price_df.empty:
+            return None
+        else:
+            df = price_df[(price_df.index >= pd.Timestamp(fetch_start)) & (price_df.index < pd.Timestamp(fetch_end))].copy()
         
         if df.empty: return None
 
-        df.index = df.index.tz_localize(None)
         df = df.ffill()
 
-        mask_jail = (df.index >= pd.Timestamp(start_date)) & (df.index <= pd.Timestamp(jail_end_date))
-        df_jail = df[mask_jail]
-        mask_before = df.index < pd.Timestamp(start_date)
-        
-        pre_pct = 0.0
-        in_pct = 0.0
-        pre_jail_avg_volume = 0
-        
-        if mask_before.any():
-            df_before = df[mask_before]
-            pre_jail_avg_volume = df_before['Volume'].tail(60).mean()
-            # 處置前%：處置幾天就往前找同樣天數，用 Close-to-Close 計算累積漲跌幅
-            jail_days = len(df_jail)
-            pre_exit_price = float(df_before['Close'].iloc[-1])   # 處置開始前最後一天收盤
-            if jail_days > 0 and len(df_before) >= jail_days:
-                pre_entry_price = float(df_before['Close'].iloc[-jail_days])
-            elif not df_before.empty:
-                pre_entry_price = float(df_before['Close'].iloc[0])
-            else:
-                pre_entry_price = pre_exit_price
-            if pre_entry_price != 0:
-                pre_pct = ((pre_exit_price - pre_entry_price) / pre_entry_price) * 100
-
-        jail_end_price = 0
-        if not df_jail.empty:
-            jail_start_price = df_jail['Open'].iloc[0]
-            jail_end_price = df_jail['Close'].iloc[-1]
-            if jail_start_price != 0:
-                in_pct = ((jail_end_price - jail_start_price) / jail_start_price) * 100
+        track_days = 20
+        m = compute_event_metrics(df, start_date, jail_end_date, track_days)
+        pre_pct, in_pct = m['pre_pct'], m['in_pct']
         
         status = determine_status(pre_pct, in_pct)
 
         inst_status = "🧊 無明顯動向"
-        if not df_jail.empty and pre_jail_avg_volume > 0:
+        if m['jail_days'] > 0 and m['pre_jail_avg_volume'] > 0:
             print(f"  🕷️ 爬取法人資料: {code}...")
             inst_df = get_institutional_data(code, start_date, jail_end_date)
             
             if inst_df is not None:
-                bm_shares = pre_jail_avg_volume * len(df_jail) 
-                if bm_shares == 0: bm_shares = 1
-
-                r_f = (inst_df['外資買賣超'].sum() * 1000) / bm_shares
-                r_t = (inst_df['投信買賣超'].sum() * 1000) / bm_shares
-                
-                is_foreign_buy = r_f > THRESH_FOREIGN
-                is_foreign_sell = r_f < -THRESH_FOREIGN
-                is_trust_buy = r_t > THRESH_OTHERS
-                is_trust_sell = r_t < -THRESH_OTHERS
-                
-                if is_foreign_buy and is_trust_buy: inst_status = "🔴 土洋合購"
-                elif is_foreign_sell and is_trust_sell: inst_status = "🟢 土洋合賣"
-                elif is_foreign_buy and is_trust_sell: inst_status = "🔴 外資買/投信賣"
-                elif is_foreign_sell and is_trust_buy: inst_status = "🔴 投信買/外資賣"
-                elif is_foreign_buy: inst_status = "🔴 外資大買"
-                elif is_trust_buy: inst_status = "🔴 投信大買"
-                elif is_foreign_sell: inst_status = "🟢 外資大賣"
-                elif is_trust_sell: inst_status = "🟢 投信大賣"
-
-        df_after = df[df.index > pd.Timestamp(jail_end_date)]
-        
-        if not df_after.empty:
-            release_date_str = df_after.index[0].strftime("%Y/%m/%d")
-        else:
-            release_date_str = (jail_end_date + timedelta(days=1)).strftime("%Y/%m/%d")
+                r_f, r_t = compute_inst_ratios(inst_df, m['pre_jail_avg_volume'], m['jail_days'])
+                inst_status = determine_inst_status(r_f, r_t)
+
+        # 出關後逐日漲跌幅 (以處置最後收盤為 D+1 基準)，資料不足的天數為 NaN
+        base_price = m['base_price']
+        post_close = m['post_close']
+        n_after = m['n_after']
+        prev = np.r_[base_price, post_close[:-1]]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            daily = np.where(prev != 0, (post_close - prev) / prev * 100, 0.0)
+        daily[n_after:] = np.nan
 
-        post_data = []
         accumulated_pct = 0.0
-        base_price = jail_end_price if jail_end_price != 0 else (df_after['Open'].iloc[0] if not df_after.empty else 0)
-
-        track_days = 20
-        for i in range(track_days):
-            if i < len(df_after):
-                curr_close = df_after['Close'].iloc[i]
-                prev_close = df_after['Close'].iloc[i-1] if i > 0 else base_price
-                if prev_close != 0:
-                    daily_chg = ((curr_close - prev_close) / prev_close) * 100
-                    post_data.append(f"{daily_chg:+.1f}%")
-                else:
-                    post_data.append("0.0%")
-                
-                if i == len(df_after) - 1 or i == track_days - 1:
-                    if base_price != 0:
-                        accumulated_pct = ((curr_close - base_price) / base_price) * 100
-            else:
-                post_data.append("")
-
-        while len(post_data) < track_days:
-            post_data.append("")
+        if n_after > 0 and base_price != 0:
+            accumulated_pct = (post_close[n_after - 1] - base_price) / base_price * 100
 
         # ============================
         # [新增] 計算月線回測數據
         # ============================
-        ma_touch_returns = get_ma_touch_stats(df, start_date, jail_end_date, pre_pct)
+        ma_touch = get_ma_touch_stats(df, start_date, jail_end_date, pre_pct)
 
+        # 漲跌幅一律取到工作表顯示精度 (0.1%)，與沿用舊列解析出的數值一致，統計不會因事件來源不同而漂移
         return {
-            "status": status,
-            "inst_status": inst_status,
-            "pre_pct": f"{pre_pct:+.1f}%",
-            "in_pct": f"{in_pct:+.1f}%",
-            "acc_pct": f"{accumulated_pct:+.1f}%",
-            "daily_trends": post_data,
-            "release_date": release_date_str,
-            "ma_touch_returns": ma_touch_returns  # [新增] D+1~D+20，或 None
+            "release_date": m['release_date'],
+            "status": STATUS_INDEX[status],
+            "inst_status": INST_INDEX[inst_status],
+            "pre_pct": round(float(pre_pct), 1),
+            "in_pct": round(float(in_pct), 1),
+            "acc_pct": round(float(accumulated_pct), 1),
+            "daily": np.round(daily, 1),
+            # [新增] 月線回測 D+1~D+20 (未觸發為 None) 與買進日斜率
+            "ma_returns": None if ma_touch is None else np.round(np.array(
+                [np.nan if v is None else v for v in ma_touch['returns']], dtype=float), 1),
+            "ma_slope": np.nan if ma_touch is None else ma_touch['slope'],
         }
 
     except Exception as e:
         print(f"⚠️ 數據計算錯誤 {code}: {e}")
         return None
 
+# ============================
+# 🧮 回測統計彙總 (事件矩陣 + 分類代碼)
+# ============================
+STATUS_INDEX = {s: i for i, s in enumerate(STATUS_ORDER)}
+INST_INDEX = {s: i for i, s in enumerate(INST_ORDER)}
+INTERVAL_CHECKPOINTS = [5, 10, 15, 20]
+
+def parse_pct(val):
+    """'+1.2%' → 1.2；空白或無法解析 → NaN (只在資料進場時解析一次)"""
+    try: return float(str(val).replace('%', '').replace('+', ''))
+    except ValueError: return np.nan
+
+def group_stats(codes, values, n_groups):
+    """
+    依分類代碼彙總 (代碼 < 0 不計，NaN 不計)：values 可為 (事件,) 或 (事件, 天數)
+    回傳 count / wins / total，形狀為 (n_groups,) 或 (n_groups, 天數)
+    """
+    vals = values if values.ndim == 2 else values[:, None]
+    codes = np.asarray(codes)
+    keep = codes >= 0
+    valid = ~np.isnan(vals[keep])
+    count = np.zeros((n_groups, vals.shape[1]), dtype=int)
+    wins = np.zeros_like(count)
+    total = np.zeros(count.shape)
+    # np.add.at 依事件順序逐筆累加，加總順序與逐列統計一致 (四捨五入顯示不會因此變動)
+    np.add.at(count, codes[keep], valid)
+    np.add.at(wins, codes[keep], valid & (np.nan_to_num(vals[keep]) > 0))
+    np.add.at(total, codes[keep], np.where(valid, vals[keep], 0.0))
+    if values.ndim == 1:
+        return count[:, 0], wins[:, 0], total[:, 0]
+    return count, wins, total
+
+def compound_returns(daily):
+    """逐日漲跌幅(%)矩陣 → 逐日複利累積(%)，缺值當天視為 0%"""
+    return (np.cumprod(1 + np.nan_to_num(daily) / 100, axis=1) - 1) * 100
+
+def summarize_backtest(status_idx, inst_idx, acc, daily, ma_returns, ma_slopes):
+    """
+    由事件矩陣一次導出所有統計表：
+    status_idx / inst_idx：STATUS_ORDER / INST_ORDER 索引 (-1 為未知)、acc：累積漲跌幅
+    daily：事件 × 20 逐日漲跌幅、ma_returns / ma_slopes：月線回測命中事件的 D+1~D+20 與斜率 (缺值皆為 NaN)
+    """
+    n_s, n_i = len(STATUS_ORDER), len(INST_ORDER)
+    combo_idx = np.where((status_idx >= 0) & (inst_idx >= 0), status_idx * n_i + inst_idx, -1)
+
+    # 每5日累計：當天有資料才計入，數值為至當天為止的複利累積
+    cps = np.array(INTERVAL_CHECKPOINTS) - 1
+    interval = np.where(np.isnan(daily[:, cps]), np.nan, compound_returns(daily)[:, cps])
+
+    combo_count, _, combo_total = group_stats(combo_idx, acc, n_s * n_i)
+    combo_iv_count, combo_iv_wins, _ = group_stats(combo_idx, interval, n_s * n_i)
+
+    # 月線回測：整體以全部有效天數複利，斜率每 0.1% 一組統計 D+10 / D+20
+    ma_comp = compound_returns(ma_returns)
+    has_any = ~np.all(np.isnan(ma_returns), axis=1)
+    ma_d20 = np.where(has_any, ma_comp[:, -1], 0.0)
+    ma_d10 = ma_comp[:, 9]
+    bucket_keys, bucket_idx = np.unique(np.trunc(ma_slopes * 10).astype(int), return_inverse=True)
+    bk_count, bk_wins, bk_total = group_stats(bucket_idx, np.column_stack([ma_d10, ma_d20]), len(bucket_keys))
+
+    return {
+        "summary": group_stats(status_idx, acc, n_s),
+        "inst": group_stats(inst_idx, acc, n_i),
+        "daily": group_stats(status_idx, daily, n_s),
+        "interval": group_stats(status_idx, interval, n_s),
+        "combo": (combo_count.reshape(n_s, n_i), combo_total.reshape(n_s, n_i)),
+        "combo_interval": (combo_iv_count.reshape(n_s, n_i, -1), combo_iv_wins.reshape(n_s, n_i, -1)),
+        "ma_daily": group_stats(np.zeros(len(ma_returns), dtype=int), ma_returns, 1),
+        "ma_total": (int(has_any.sum()), int((ma_d20[has_any] > 0).sum()), float(ma_d20[has_any].sum())),
+        "ma_buckets": [(k / 10, bk_count[j], bk_wins[j], bk_total[j]) for j, k in enumerate(bucket_keys)],
+    }
+
+def _fmt_rate(wins, count, empty="-"):
+    return f"{wins / count * 100:.1f}%" if count > 0 else empty
+
+def _fmt_avg(total, count, empty="-"):
+    return f"{total / count:+.1f}%" if count > 0 else empty
+
+# ============================
+# 🗂️ 型別化事件紀錄與事件表
+# ============================
+def fmt_pct(val, digits=1):
+    """數值 → '+1.2%'，NaN → 空白 (僅在寫入工作表時使用)"""
+    return f"{val:+.{digits}f}%" if val is not None and np.isfinite(val) else ""
+
+def format_event_row(code, name, rec):
+    """型別化事件紀錄 → 主表一列 (出關日期 ~ D+20)"""
+    return [
+        rec['release_date'].strftime("%Y/%m/%d"), code, name,
+        STATUS_ORDER[rec['status']], INST_ORDER[rec['inst_status']],
+        fmt_pct(rec['pre_pct']), fmt_pct(rec['in_pct']), fmt_pct(rec['acc_pct'])
+    ] + [fmt_pct(v) for v in rec['daily']]
+
+def event_record_from_row(row_vals, track_days=20):
+    """主表既有列 (字串) → 型別化事件紀錄，只在讀入時解析一次 (未知狀態索引為 -1)"""
+    release = pd.to_datetime(str(row_vals[0]).strip(), format="%Y/%m/%d", errors="coerce")
+    return {
+        "release_date": release,
+        "status": STATUS_INDEX.get(row_vals[3], -1),
+        "inst_status": INST_INDEX.get(row_vals[4], -1),
+        "pre_pct": parse_pct(row_vals[5]),
+        "in_pct": parse_pct(row_vals[6]),
+        "acc_pct": parse_pct(row_vals[7]),
+        "daily": np.array([parse_pct(v) for v in (list(row_vals[8:8 + track_days]) + [""] * track_days)[:track_days]], dtype=float),
+        "ma_returns": None,
+        "ma_slope": np.nan,
+    }
+
+def save_event_table(event_rows, track_days=20):
+    """
+    把本次回測所有事件寫成欄式事件表 (EVENT_TABLE_FILE)：
+    數值欄位 + 狀態/法人分類 (category)、D+1~D+20 與月線回測 D+1~D+20 各自展開成欄
+    event_rows: [(code, name, market, s_date, e_date, rec), ...]
+    """
+    if not event_rows: return
+    recs = [r[-1] for r in event_rows]
+    table = pd.DataFrame({
+        "code": [r[0] for r in event_rows],
+        "name": [r[1] for r in event_rows],
+        "market": [r[2] for r in event_rows],
+        "start_date": pd.to_datetime([r[3] for r in event_rows]),
+        "end_date": pd.to_datetime([r[4] for r in event_rows]),
+        "release_date": pd.to_datetime([rec['release_date'] for rec in recs]),
+        "status": pd.Categorical.from_codes([rec['status'] for rec in recs], categories=STATUS_ORDER),
+        "inst_status": pd.Categorical.from_codes([rec['inst_status'] for rec in recs], categories=INST_ORDER),
+        "pre_pct": [rec['pre_pct'] for rec in recs],
+        "in_pct": [rec['in_pct'] for rec in recs],
+        "acc_pct": [rec['acc_pct'] for rec in recs],
+        "ma_slope": [rec['ma_slope'] for rec in recs],
+    })
+    daily = np.array([rec['daily'] for rec in recs], dtype=float).reshape(len(recs), track_days)
+    ma = np.array([rec['ma_returns'] if rec['ma_returns'] is not None else np.full(track_days, np.nan)
+                   for rec in recs], dtype=float).reshape(len(recs), track_days)
+    table = pd.concat([
+        table,
+        pd.DataFrame(daily, columns=[f"d{i+1}" for i in range(track_days)]),
+        pd.DataFrame(ma, columns=[f"ma_d{i+1}" for i in range(track_days)]),
+    ], axis=1)
+
+    try:
+        os.makedirs(LOCAL_CACHE_DIR, exist_ok=True)
+        if pyarrow is not None:
+            table.to_parquet(EVENT_TABLE_FILE, index=False)
+            print(f"💾 事件表已輸出: {EVENT_TABLE_FILE} ({len(table)} 筆)")
+        else:
+            csv_path = os.path.splitext(EVENT_TABLE_FILE)[0] + ".csv"
+            table.to_csv(csv_path, index=False, encoding="utf-8-sig")
+            print(f"💾 事件表已輸出 (未安裝 pyarrow，改存 CSV): {csv_path} ({len(table)} 筆)")
+    except Exception as e:
+        print(f"⚠️ 事件表輸出失敗: {e}")
+
+# ============================
+# 🎨 Google Sheets 寫入與格式化
+# ============================
+def write_changed_rows(ws, old_values, new_values, value_input_option="RAW"):
+    """
+    只寫入與工作表現況 (old_values = get_all_values) 不同的列，相鄰變動列合併成一個範圍一次送出；
+    舊資料多出來的列以空白覆蓋。回傳寫入的列數
+    """
+    def norm(row):
+        cells = ["" if v is None else str(v) for v in row]
+        while cells and cells[-1] == "": cells.pop()
+        return cells
+
+    width = max([len(r) for r in new_values] + [len(r) for r in old_values] + [1])
+    changed = []
+    for i in range(max(len(old_values), len(new_values))):
+        new_row = new_values[i] if i < len(new_values) else []
+        old_row = old_values[i] if i < len(old_values) else []
+        if norm(new_row) != norm(old_row): changed.append(i)
+    if not changed:
+        return 0
+
+    data = []
+    block_start = prev = changed[0]
+    for i in changed[1:] + [None]:
+        if i is not None and i == prev + 1:
+            prev = i
+            continue
+        rows = [list(new_values[r]) if r < len(new_values) else [] for r in range(block_start, prev + 1)]
+        data.append({
+            "range": f"{rowcol_to_a1(block_start + 1, 1)}:{rowcol_to_a1(prev + 1, width)}",
+            "values": [row + [""] * (width - len(row)) for row in rows],
+        })
+        if i is not None: block_start = prev = i
+    ws.batch_update(data, value_input_option=value_input_option)
+    return len(changed)
+
+def _rule_matches(existing, wanted):
+    """
+    wanted 的每個欄位都與 existing 相同 (existing 可多出 API 自動補上的欄位)；
+    Sheets 回傳的顏色是浮點數 (如 0.8509804) 且會省略 0 的分量，數值以容差比較
+    """
+    if isinstance(wanted, dict):
+        if not isinstance(existing, dict): return False
+        return all(_rule_matches(existing.get(k, 0 if _is_number(v) else None), v) for k, v in wanted.items())
+    if isinstance(wanted, list):
+        return isinstance(existing, list) and len(existing) == len(wanted) and all(map(_rule_matches, existing, wanted))
+    if _is_number(wanted) and _is_number(existing):
+        return math.isclose(existing, wanted, abs_tol=1e-3)
+    return existing == wanted
+
+def _is_number(v):
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+def replace_conditional_rules(sh, ws, rules):
+    """
+    以 rules ([{"ranges", "booleanRule"}, ...]) 取代工作表既有的條件格式，回傳 batch_update 請求：
+    既有規則由後往前刪除再依序新增，不會每次執行疊加一份；規則完全相同時回傳空清單
+    """
+    existing = []
+    try:
+        meta = sh.fetch_sheet_metadata({"fields": "sheets(properties(sheetId),conditionalFormats)"})
+        for sheet in meta.get("sheets", []):
+            if sheet.get("properties", {}).get("sheetId") == ws.id:
+                existing = sheet.get("conditionalFormats", [])
+    except Exception as e:
+        print(f"⚠️ 讀取既有條件格式失敗 ({ws.title}): {e}")
+
+    if len(existing) == len(rules) and all(map(_rule_matches, existing, rules)):
+        return []
+    reqs = [{"deleteConditionalFormatRule": {"sheetId": ws.id, "index": i}} for i in range(len(existing) - 1, -1, -1)]
+    reqs += [{"addConditionalFormatRule": {"rule": rule, "index": i}} for i, rule in enumerate(rules)]
+    return reqs
+
+def coalesce_cell_formats(sheet_id, cell_formats, fields):
+    """
+    {(row, col): userEnteredFormat} → repeatCell 請求：
+    同列相鄰且格式相同的儲存格先合併成橫向區段，上下相鄰、欄範圍與格式都相同的區段再合併成矩形
+    """
+    runs = []   # [row, col_start, col_end, key, fmt]
+    for (r, c) in sorted(cell_formats):
+        fmt = cell_formats[(r, c)]
+        k = json.dumps(fmt, sort_keys=True)
+        if runs and runs[-1][0] == r and runs[-1][2] == c and runs[-1][3] == k:
+            runs[-1][2] = c + 1
+        else:
+            runs.append([r, c, c + 1, k, fmt])
+
+    rects, open_rects = [], {}
+    for r, c0, c1, k, fmt in runs:
+        rect = open_rects.get((c0, c1, k))
+        if rect and rect[1] == r:
+            rect[1] = r + 1
+        else:
+            rect = [r, r + 1, c0, c1, fmt]
+            rects.append(rect)
+            open_rects[(c0, c1, k)] = rect
+
+    return [{
+        "repeatCell": {
+            "range": {"sheetId": sheet_id, "startRowIndex": r0, "endRowIndex": r1,
+                      "startColumnIndex": c0, "endColumnIndex": c1},
+            "cell": {"userEnteredFormat": fmt},
+            "fields": fields
+        }
+    } for r0, r1, c0, c1, fmt in rects]
+
+# ============================
+# 🔬 處置事件面板 (本機) 與參數掃描模式
+# ============================
+def _open_release_panel():
+    os.makedirs(LOCAL_CACHE_DIR, exist_ok=True)
+    conn = sqlite3.connect(RELEASE_PANEL_FILE)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS release_events (
+            code TEXT, name TEXT, market TEXT, start_date TEXT, end_date TEXT,
+            PRIMARY KEY (code, start_date, end_date));
+        CREATE TABLE IF NOT EXISTS price_daily (
+            code TEXT, date TEXT, open REAL, close REAL, volume REAL,
+            PRIMARY KEY (code, date));
+        CREATE TABLE IF NOT EXISTS price_coverage (
+            code TEXT PRIMARY KEY, start_date TEXT, end_date TEXT);
+    """)
+    return conn
+
+def _read_release_events(conn):
+    return [(code, name, market, datetime.strptime(s, "%Y-%m-%d"), datetime.strptime(e, "%Y-%m-%d"))
+            for code, name, market, s, e in conn.execute(
+                "SELECT code, name, market, start_date, end_date FROM release_events ORDER BY end_date, code")]
+
+def save_release_events(events):
+    """記錄處置事件清單，回傳本機面板的全部事件 (寫入失敗時回傳 events)"""
+    try:
+        conn = _open_release_panel()
+        try:
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO release_events VALUES (?,?,?,?,?)",
+                                 [(code, name, market, s.strftime("%Y-%m-%d"), e.strftime("%Y-%m-%d"))
+                                  for code, name, market, s, e in events])
+            return _read_release_events(conn)
+        finally:
+            conn.close()
+    except Exception as e:
+        print(f"⚠️ 處置事件面板寫入失敗: {e}")
+        return list(events)
+
+def save_release_prices(fetched_events, price_map):
+    """
+    以剛下載的日線整檔取代本機面板的舊資料，涵蓋區間 (最晚到今天) 同步改為這次下載的區間。
+    auto_adjust 價格會隨除權息改變基準，不同次下載的列不可混在同一檔序列裡，
+    因此 fetched_events 須包含該檔在面板中的所有事件，讓這次下載涵蓋整段區間。
+    """
+    today_str = datetime.now().strftime("%Y-%m-%d")
+    try:
+        conn = _open_release_panel()
+        with conn:
+            for code, (fs, fe, _) in price_windows(fetched_events).items():
+                df = price_map.get(code)
+                if df is None or df.empty: continue
+                conn.execute("DELETE FROM price_daily WHERE code=?", (code,))
+                conn.executemany("INSERT INTO price_daily VALUES (?,?,?,?,?)",
+                                 [(code, d.strftime("%Y-%m-%d"), float(o), float(c), float(v))
+                                  for d, o, c, v in zip(df.index, df['Open'], df['Close'], df['Volume'])])
+                conn.execute("INSERT OR REPLACE INTO price_coverage VALUES (?,?,?)",
+                             (code, fs.strftime("%Y-%m-%d"), min(fe.strftime("%Y-%m-%d"), today_str)))
+        conn.close()
+    except Exception as e:
+        print(f"⚠️ 處置事件面板日線寫入失敗: {e}")
+
+def load_release_panel():
+    """讀取本機面板的處置事件與日線 {code: DataFrame}；涵蓋區間不足的股票先補下載"""
+    today_str = datetime.now().strftime("%Y-%m-%d")
+    conn = _open_release_panel()
+    try:
+        events = _read_release_events(conn)
+        coverage = {r[0]: (r[1], r[2]) for r in conn.execute("SELECT code, start_date, end_date FROM price_coverage")}
+    finally:
+        conn.close()
+
+    stale = set()
+    for code, (fs, fe, _) in price_windows(events).items():
+        old = coverage.get(code)
+        if not old or fs.strftime("%Y-%m-%d") < old[0] or min(fe.strftime("%Y-%m-%d"), today_str) > old[1]:
+            stale.add(code)
+    if stale:
+        fetch_events = [ev for ev in events if ev[0] in stale]
+        save_release_prices(fetch_events, prefetch_price_histories(fetch_events))
+
+    conn = _open_release_panel()
+    try:
+        prices = pd.read_sql_query(
+            "SELECT code, date, open AS Open, close AS Close, volume AS Volume FROM price_daily ORDER BY code, date",
+            conn, parse_dates=['date'])
+    finally:
+        conn.close()
+    price_map = {code: g.drop(columns='code').set_index('date') for code, g in prices.groupby('code')}
+    return events, price_map
+
+def build_sweep_inputs(events, price_map, track_days=20):
+    """
+    把處置事件整理成掃描用的陣列 (只算一次)：處置中漲跌幅、法人比率、出關後收盤，與月線回測用的堆疊日線。
+    與門檻有關的分類全部留到 _sweep_evaluate 以陣列運算處理。
+    """
+    prepared = []
+    for code, _, _, s_date, e_date in events:
+        price_df = price_map.get(code)
+        if price_df is None or price_df.empty: continue
+        fetch_start, fetch_end = s_date - timedelta(days=365), e_date + timedelta(days=65)
+        df = price_df[(price_df.index >= pd.Timestamp(fetch_start)) & (price_df.index < pd.Timestamp(fetch_end))].ffill()
+        if df.empty: continue
+        prepared.append((code, s_date, e_date, df, compute_event_metrics(df, s_date, e_date, track_days)))
+
+    need_inst = [(code, s, e) for code, s, e, _, m in prepared if m['jail_days'] > 0 and m['pre_jail_avg_volume'] > 0]
+    prefetch_institutional_data(need_inst)
+
+    r_f, r_t, frames, ma_events = [], [], [], []
+    for event_id, (code, s_date, e_date, df, m) in enumerate(prepared):
+        rf = rt = np.nan
+        if m['jail_days'] > 0 and m['pre_jail_avg_volume'] > 0:
+            inst_df = get_institutional_data(code, s_date, e_date)
+            if inst_df is not None:
+                rf, rt = compute_inst_ratios(inst_df, m['pre_jail_avg_volume'], m['jail_days'])
+        r_f.append(rf)
+        r_t.append(rt)
+        frames.append(pd.DataFrame({'event': event_id, 'Close': df['Close'].to_numpy(dtype=float)}, index=df.index))
+        ma_events.append({'start': pd.Timestamp(s_date), 'end': pd.Timestamp(e_date), 'pre_pct': m['pre_pct']})
+
+    return {
+        "track_days": track_days,
+        "in_pct": np.array([m['in_pct'] for *_, m in prepared], dtype=float),
+        "r_f": np.array(r_f, dtype=float),
+        "r_t": np.array(r_t, dtype=float),
+        "base_price": np.array([m['base_price'] for *_, m in prepared], dtype=float),
+        "post_close": np.array([m['post_close'] for *_, m in prepared], dtype=float).reshape(len(prepared), track_days),
+        "n_after": np.array([m['n_after'] for *_, m in prepared], dtype=np.int64),
+        "ma_panel": pd.concat(frames) if frames else pd.DataFrame(columns=['event', 'Close']),
+        "ma_events": pd.DataFrame(ma_events, columns=['start', 'end', 'pre_pct']),
+    }
+
+# 掃描子程序的共用輸入 (由 initializer 載入一次) 與月線回測結果快取
+_SWEEP_INPUTS = {}
+_SWEEP_MA_CACHE = {}
+
+def _sweep_worker_init(inputs):
+    global _SWEEP_INPUTS
+    _SWEEP_INPUTS = inputs
+    _SWEEP_MA_CACHE.clear()
+
+def _sweep_ma_matrix(band_pct, min_slope_pct):
+    """同一組 (帶寬, 斜率) 的月線回測只算一次：回傳命中事件的 D+1~D+N 報酬矩陣 (缺值為 NaN)"""
+    key = (band_pct, min_slope_pct)
+    if key not in _SWEEP_MA_CACHE:
+        d = _SWEEP_INPUTS
+        hits = [r['returns'] for r in compute_ma_touch_panel(d['ma_panel'], d['ma_events'], band_pct,
+                                                              min_slope_pct, d['track_days']) if r is not None]
+        _SWEEP_MA_CACHE[key] = np.array([[np.nan if v is None else v for v in r] for r in hits],
+                                        dtype=float).reshape(len(hits), d['track_days'])
+    return _SWEEP_MA_CACHE[key]
+
+def _sweep_evaluate(combo):
+    (strong_pct, extreme_pct), thresh_foreign, thresh_others, band_pct, min_slope_pct, horizon = combo
+    d = _SWEEP_INPUTS
+    row = {"強勢門檻%": strong_pct, "妖股門檻%": extreme_pct, "外資門檻": thresh_foreign, "投信門檻": thresh_others,
+           "月線帶寬%": band_pct, "斜率下限%": min_slope_pct, "追蹤天數": horizon}
+
+    # 出關後第 horizon 天 (資料不足取最後一天) 相對基準價的累積漲跌幅
+    base = d['base_price']
+    last = np.minimum(d['n_after'], horizon) - 1
+    close_at = d['post_close'][np.arange(len(base)), np.maximum(last, 0)]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        acc = np.where((last >= 0) & (base != 0), (close_at - base) / base * 100, 0.0)
+    acc = np.nan_to_num(acc)
+
+    for labels, codes in (
+        (STATUS_ORDER, status_codes(d['in_pct'], strong_pct, extreme_pct)),
+        (INST_ORDER, inst_status_codes(d['r_f'], d['r_t'], thresh_foreign, thresh_others)),
+    ):
+        count, wins, total = group_stats(codes, acc, len(labels))
+        for label, c, w, t in zip(labels, count, wins, total):
+            tag = label.split(" ", 1)[-1]
+            row[f"{tag}_筆數"] = int(c)
+            row[f"{tag}_勝率%"] = round(w / c * 100, 1) if c else 0.0
+            row[f"{tag}_平均%"] = round(t / c, 2) if c else 0.0
+
+    # 月線回測：D+1~D+horizon 複利累積 (至少有一天資料才計入)
+    ma = _sweep_ma_matrix(band_pct, min_slope_pct)[:, :horizon]
+    has_any = ~np.all(np.isnan(ma), axis=1)
+    ma_acc = (np.nanprod(1 + ma / 100, axis=1)[has_any] - 1) * 100
+    row["月線_筆數"] = int(has_any.sum())
+    row["月線_勝率%"] = round(float((ma_acc > 0).mean() * 100), 1) if len(ma_acc) else 0.0
+    row["月線_平均%"] = round(float(ma_acc.mean()), 2) if len(ma_acc) else 0.0
+    return row
+
+def _sweep_evaluate_chunk(combos):
+    return [_sweep_evaluate(c) for c in combos]
+
+def iter_sweep_chunks(grid, chunk_size=64):
+    """依 (帶寬, 斜率) 分組產生參數組合，同組在同一程序內共用月線回測結果"""
+    horizons = [min(int(h), MA_TOUCH_TRACK_DAYS) for h in grid['horizon']]
+    for band_pct, min_slope_pct in itertools.product(grid['ma_band_pct'], grid['ma_min_slope_pct']):
+        combos = [(tuple(cut), tf, to, band_pct, min_slope_pct, h) for cut, tf, to, h in itertools.product(
+            grid['status_cutoffs'], grid['thresh_foreign'], grid['thresh_others'], horizons)]
+        for i in range(0, len(combos), chunk_size):
+            yield combos[i:i + chunk_size]
+
+def load_sweep_grid():
+    """SWEEP_GRID 套用 SWEEP_GRID_JSON 的覆寫；JSON 無效或不是物件時略過，沿用預設參數"""
+    grid = dict(SWEEP_GRID)
+    if not SWEEP_GRID_JSON:
+        return grid
+    try:
+        override = json.loads(SWEEP_GRID_JSON)
+    except ValueError as e:
+        print(f"⚠️ SWEEP_GRID_JSON 不是有效的 JSON，沿用預設參數: {e}")
+        return grid
+    if not isinstance(override, dict):
+        print(f"⚠️ SWEEP_GRID_JSON 必須是物件 (收到 {type(override).__name__})，沿用預設參數")
+        return grid
+    for key, values in override.items():
+        if key not in SWEEP_GRID or not isinstance(values, list) or not values:
+            print(f"⚠️ SWEEP_GRID_JSON 略過 {key}: 必須是既有參數名稱且為非空陣列")
+            continue
+        grid[key] = values
+    return grid
+
+def run_parameter_sweep():
+    print("🔬 啟動處置回測參數掃描 (讀取本機事件面板)...")
+    if os.path.exists(SERVICE_KEY_FILE):
+        sh = connect_google_sheets(SHEET_NAME)
+        if sh: load_ticker_registry(sh)
+
+    events, price_map = load_release_panel()
+    if not events:
+        print(f"❌ 本機面板沒有處置事件 ({RELEASE_PANEL_FILE})，請先以一般模式執行一次回測。")
+        return
+
+    inputs = build_sweep_inputs(events, price_map)
+    close_institutional_driver()
+    close_inst_store()
+    if len(inputs['in_pct']) == 0:
+        print("❌ 沒有可用的日線資料，無法掃描。")
+        return
+
+    chunks = list(iter_sweep_chunks(load_sweep_grid()))
+    print(f"🧮 事件 {len(inputs['in_pct'])} 筆，參數組合 {sum(len(c) for c in chunks)} 組 (workers={SWEEP_MAX_WORKERS})")
+    rows = []
+    with ProcessPoolExecutor(max_workers=max(SWEEP_MAX_WORKERS, 1),
+                             initializer=_sweep_worker_init, initargs=(inputs,)) as pool:
+        for part in pool.map(_sweep_evaluate_chunk, chunks):
+            rows.extend(part)
+
+    result_df = pd.DataFrame(rows)
+    os.makedirs(LOCAL_CACHE_DIR, exist_ok=True)
+    result_df.to_csv(SWEEP_RESULT_FILE, index=False, encoding="utf-8-sig")
+    print(f"💾 掃描結果已寫入 {SWEEP_RESULT_FILE} ({len(result_df)} 組)")
+
+    param_cols = ["強勢門檻%", "妖股門檻%", "外資門檻", "投信門檻", "月線帶寬%", "斜率下限%", "追蹤天數"]
+    top = result_df.sort_values("月線_平均%", ascending=False).head(5)
+    print("📈 月線回測平均報酬前 5 組：")
+    print(top[param_cols + ["月線_筆數", "月線_勝率%", "月線_平均%"]].to_string(index=False))
+
 # ============================
 # 🚀 主程式
 # ============================
 def main():
-    print("🚀 啟動一年期全量處置股回測 (TWSE-Selenium / TPEx-Requests)...")
+    print("🚀 啟動一年期全量處置股回測 (TWSE-JSON / TPEx-Requests)...")
     
     sh = connect_google_sheets(SHEET_NAME)
     if not sh: return
+    load_ticker_registry(sh)
 
     today = datetime.now()
     one_year_ago = today - timedelta(days=365)
@@ -513,7 +1446,7 @@ def main():
     df_tpex = fetch_tpex_history_requests(one_year_ago, end_fetch)
     print(f"  --> 上櫃抓到: {len(df_tpex)} 筆")
     
-    df_twse = fetch_twse_history_selenium(one_year_ago, end_fetch)
+    df_twse = fetch_twse_history(one_year_ago, end_fetch)
     print(f"  --> 上市抓到: {len(df_twse)} 筆")
 
     all_dfs = []
@@ -563,35 +1496,28 @@ def main():
 
     processed_list = []
     
-    status_order = ["👑 妖股誕生", "🔥 強勢突圍", "🧊 多空膠著", "📉 走勢疲軟", "💀 人去樓空"]
-    inst_order = ["🔴 土洋合購", "🔴 外資大買", "🔴 投信大買", "🔴 外資買/投信賣", "🔴 投信買/外資賣", 
-                  "🟢 土洋合賣", "🟢 外資大賣", "🟢 投信大賣", "🧊 無明顯動向"]
+    status_order = STATUS_ORDER
+    inst_order = INST_ORDER
     
     track_days = 20
-    interval_checkpoints = [5, 10, 15, 20]
-    
-    daily_stats = {s: [{'sum': 0.0, 'wins': 0, 'count': 0} for _ in range(track_days)] for s in status_order}
-    summary_stats = {s: {'count': 0, 'wins': 0, 'total_pct': 0.0} for s in status_order}
-    interval_data = {s: {cp: [] for cp in interval_checkpoints} for s in status_order}
-    inst_stats_data = {i: {'count': 0, 'wins': 0, 'total_pct': 0.0} for i in inst_order}
+    interval_checkpoints = INTERVAL_CHECKPOINTS
     
-    # 📌 新增：組合的區間統計 (狀態+法人)
-    combo_interval_data = {} # Key: (status, inst), Value: {5: [], 10: [], 15: [], 20: []}
+    # 統計用事件矩陣：每筆事件只在進場時把百分比字串解析一次，彙總交給 summarize_backtest
+    ev_status, ev_inst, ev_acc, ev_daily = [], [], [], []
+    event_rows = []           # (code, name, market, s_date, e_date, 型別化事件紀錄)，輸出事件表用
 
     # ============================
     # [新增] 月線回測追蹤變數
     # 條件：上漲進處置 + 買進日MA20斜率>1 + 處置期間收盤價在月線±15%範圍內
     # 追蹤買進日後 D+1~D+20 的每日統計
     # ============================
-    MA_TOUCH_TRACK_DAYS = 20  # 追蹤 D+1~D+20
-    ma_touch_daily = [{'sum': 0.0, 'wins': 0, 'count': 0} for _ in range(MA_TOUCH_TRACK_DAYS)]
-    ma_touch_total = {'count': 0, 'wins': 0, 'total_pct': 0.0}
-    ma_detail_list = []       # [新增] 逐筆個股明細，用於寫入「月線回測個股明細」工作表
-    ma_slope_buckets = {}     # [新增] 月線斜率區間統計，Key: 斜率下限(float，以0.1為單位)
+    ma_returns_rows, ma_slopes = [], []   # 命中事件的 D+1~D+20 (NaN 為缺值) 與買進日斜率
+    ma_detail_list = []       # [新增] 逐筆個股明細 (主表前7欄, 斜率, D+1~D+20)，用於寫入「月線回測個股明細」工作表
 
     total_count = 0
     update_count = 0
 
+    events = []
     for row in source_data:
         code = str(row.get('Code', '')).strip()
         name = str(row.get('Name', '')).strip()
@@ -611,12 +1537,40 @@ def main():
         if e_date < one_year_ago: continue 
         if e_date > today: continue 
 
-        result = fetch_stock_data(code, s_date, e_date, market)
-        
-        if not result: continue
-            
-        release_date_str = result['release_date']
-        key = f"{code}_{release_date_str}"
+        events.append((code, name, market, s_date, e_date))
+
+    # ⏩ 先用處置期間 + 交易日曆推算出關日，已完成 (D+20 已滿且有法人動向) 的事件直接沿用，不做任何抓取
+    trade_dates = get_trading_calendar(one_year_ago - timedelta(days=10), today + timedelta(days=1))
+    ma_detail_map, ma_detail_values = load_ma_detail_map(sh)
+    reuse_keys = {}
+    for code, name, market, s_date, e_date in events:
+        key = f"{code}_{derive_release_date(e_date, trade_dates).strftime('%Y/%m/%d')}"
+        old = existing_map.get(key)
+        if old and old['done'] and old['data'].get('法人動向', '') != "":
+            reuse_keys[(code, s_date, e_date)] = key
+    pending = [ev for ev in events if (ev[0], ev[3], ev[4]) not in reuse_keys]
+    print(f"⏩ 已完成事件直接沿用 {len(reuse_keys)} 筆，需重新計算 {len(pending)} 筆")
+
+    # 法人資料改為 HTTP 多檔並行預抓，回測迴圈內直接讀快取
+    prefetch_institutional_data([(code, s_date, e_date) for code, _, _, s_date, e_date in pending])
+    # 日線依股號整段重抓 (含面板中該檔較舊的事件)，寫回面板時同一檔不會混到不同還原基準的價格
+    pending_codes = {ev[0] for ev in pending}
+    fetch_events = [ev for ev in save_release_events(events) if ev[0] in pending_codes]
+    price_map = prefetch_price_histories(fetch_events)
+    save_release_prices(fetch_events, price_map)
+
+    for code, name, market, s_date, e_date in events:
+        reuse_key = reuse_keys.get((code, s_date, e_date))
+        if reuse_key:
+            # 已完成事件：主表沿用舊列，月線回測數據沿用既有明細 (無明細代表未觸發)
+            fresh = None
+            ma_source = ma_detail_map.get(reuse_key)
+            key = reuse_key
+        else:
+            fresh = fetch_stock_data(code, s_date, e_date, market, price_df=price_map.get(code, pd.DataFrame()))
+            if not fresh: continue
+            ma_source = fresh
+            key = f"{code}_{fresh['release_date'].strftime('%Y/%m/%d')}"
         
         row_vals = []
         need_rerun = True
@@ -627,225 +1581,86 @@ def main():
                 need_rerun = False
         
         if need_rerun:
-            row_vals = [
-                release_date_str, code, name, result['status'], result['inst_status'],
-                result['pre_pct'], result['in_pct'], result['acc_pct']
-            ] + result['daily_trends']
+            rec = fresh
+            row_vals = format_event_row(code, name, rec)
             update_count += 1
-            print(f"  ✨ ({update_count}) 更新: {result['release_date']} {code} {name} | {result['status']} | {result['inst_status']}")
+            print(f"  ✨ ({update_count}) 更新: {row_vals[0]} {code} {name} | {row_vals[3]} | {row_vals[4]}")
+        else:
+            # 沿用舊列：字串只在這裡解析一次
+            rec = event_record_from_row(row_vals, track_days)
+        if ma_source is not None:
+            rec['ma_returns'], rec['ma_slope'] = ma_source['ma_returns'], ma_source['ma_slope']
         
         processed_list.append(row_vals)
+        event_rows.append((code, name, market, s_date, e_date, rec))
 
-        stat_status = row_vals[3] 
-        inst_tag = row_vals[4]    
-        acc_pct_str = row_vals[7] 
-        
-        # 初始化組合鍵
-        combo_key = (stat_status, inst_tag)
-        if combo_key not in combo_interval_data:
-            combo_interval_data[combo_key] = {cp: [] for cp in interval_checkpoints}
-            combo_interval_data[combo_key]['total_pct_sum'] = 0.0
-            combo_interval_data[combo_key]['count'] = 0
-
-        try:
-            acc_val = float(acc_pct_str.replace('%', '').replace('+', ''))
-            
-            if stat_status in summary_stats:
-                summary_stats[stat_status]['count'] += 1
-                summary_stats[stat_status]['total_pct'] += acc_val
-                if acc_val > 0: summary_stats[stat_status]['wins'] += 1
-            
-            if inst_tag in inst_stats_data:
-                inst_stats_data[inst_tag]['count'] += 1
-                inst_stats_data[inst_tag]['total_pct'] += acc_val
-                if acc_val > 0: inst_stats_data[inst_tag]['wins'] += 1
-            
-            # 更新組合總計
-            combo_interval_data[combo_key]['count'] += 1
-            combo_interval_data[combo_key]['total_pct_sum'] += acc_val
-
-        except: pass
-            
-        if stat_status in daily_stats:
-            current_compound = 1.0 
-            for day_idx in range(track_days):
-                col_idx = 8 + day_idx 
-                if col_idx < len(row_vals):
-                    val_str = row_vals[col_idx]
-                    if val_str:
-                        try:
-                            daily_val = float(val_str.replace('%', '').replace('+', ''))
-                            daily_stats[stat_status][day_idx]['count'] += 1
-                            daily_stats[stat_status][day_idx]['sum'] += daily_val
-                            if daily_val > 0: daily_stats[stat_status][day_idx]['wins'] += 1
-                            
-                            current_compound *= (1 + daily_val / 100)
-                            current_day = day_idx + 1
-                            if current_day in interval_checkpoints:
-                                ret = (current_compound - 1) * 100
-                                # 狀態區間
-                                interval_data[stat_status][current_day].append(ret)
-                                # 組合區間 (新增)
-                                combo_interval_data[combo_key][current_day].append(ret)
-                        except: pass
+        ev_status.append(rec['status'])
+        ev_inst.append(rec['inst_status'])
+        ev_acc.append(rec['acc_pct'])
+        ev_daily.append(rec['daily'])
 
         # ============================
         # [新增] 月線回測統計追蹤
         # ============================
-        ma_touch_returns = result.get('ma_touch_returns')
-        if ma_touch_returns is not None:
-            ma_returns_list = ma_touch_returns['returns']   # D+1~D+20 列表
-            ma_slope_val = ma_touch_returns['slope']        # 買進日當天 MA20 斜率 (點/日)
-
-            # D+1~D+20 每日統計 + 累積計算
-            compound_ma = 1.0
-            last_valid_acc_ma = 0.0
-            has_any_ma = False
-            for day_idx in range(MA_TOUCH_TRACK_DAYS):
-                ret = ma_returns_list[day_idx] if day_idx < len(ma_returns_list) else None
-                if ret is not None:
-                    ma_touch_daily[day_idx]['count'] += 1
-                    ma_touch_daily[day_idx]['sum'] += ret
-                    if ret > 0:
-                        ma_touch_daily[day_idx]['wins'] += 1
-                    compound_ma *= (1 + ret / 100)
-                    last_valid_acc_ma = (compound_ma - 1) * 100
-                    has_any_ma = True
-            if has_any_ma:
-                ma_touch_total['count'] += 1
-                ma_touch_total['total_pct'] += last_valid_acc_ma
-                if last_valid_acc_ma > 0:
-                    ma_touch_total['wins'] += 1
-
-            # [新增] 月線斜率區間統計 (每 0.1 一組，如 1.0~1.1、1.1~1.2...)
-            # bucket_key 為斜率無條件捨去至最近 0.1，e.g. 1.35 -> 1.3、2.07 -> 2.0
-            bucket_key = int(ma_slope_val * 10) / 10
-            if bucket_key not in ma_slope_buckets:
-                ma_slope_buckets[bucket_key] = {
-                    'count': 0,
-                    'wins_d10': 0, 'd10_sum': 0.0,
-                    'wins_d20': 0, 'd20_sum': 0.0
-                }
-            bk = ma_slope_buckets[bucket_key]
-            bk['count'] += 1
-            # 計算 D+10 累積報酬
-            comp_d10 = 1.0
-            for i in range(10):
-                r = ma_returns_list[i] if i < len(ma_returns_list) else None
-                if r is not None:
-                    comp_d10 *= (1 + r / 100)
-            d10_ret = (comp_d10 - 1) * 100
-            bk['d10_sum'] += d10_ret
-            if d10_ret > 0:
-                bk['wins_d10'] += 1
-            # D+20 累積
-            bk['d20_sum'] += last_valid_acc_ma
-            if last_valid_acc_ma > 0:
-                bk['wins_d20'] += 1
-
-            # [新增] 收集個股明細 (D+1~D+20)
-            detail_row = [
-                result['release_date'],                 # 出關日期
-                code,                                   # 股號
-                name,                                   # 股名
-                result['status'],                       # 狀態
-                result['inst_status'],                  # 法人動向
-                result['pre_pct'],                      # 處置前 N 天漲跌幅 (同處置天數)
-                result['in_pct'],                       # 處置期間累積漲跌幅
-                f"{ma_slope_val:+.4f}%"                  # 買進日 MA20 斜率(%)
-            ]
-            for i in range(20):
-                ret = ma_returns_list[i] if i < len(ma_returns_list) else None
-                if ret is not None:
-                    detail_row.append(f"{ret:+.1f}%")
-                else:
-                    detail_row.append("")
-            ma_detail_list.append(detail_row)
+        if rec['ma_returns'] is not None:
+            ma_returns_rows.append(rec['ma_returns'])   # D+1~D+20 (NaN 為缺值)
+            ma_slopes.append(rec['ma_slope'])           # 買進日當天 MA20 斜率 (%)
+
+            # [新增] 收集個股明細：出關日期~處置中% 沿用主表該列，其餘欄位於寫入時格式化
+            ma_detail_list.append((row_vals[:7], rec['ma_slope'], rec['ma_returns']))
         
         total_count += 1
 
     processed_list.sort(key=lambda x: x[0], reverse=True)
     
     print("📊 正在計算彙整統計數據...")
+    stats = summarize_backtest(
+        np.array(ev_status, dtype=int), np.array(ev_inst, dtype=int),
+        np.array(ev_acc, dtype=float), np.array(ev_daily, dtype=float).reshape(-1, track_days),
+        np.array(ma_returns_rows, dtype=float).reshape(-1, MA_TOUCH_TRACK_DAYS), np.array(ma_slopes, dtype=float))
     right_side_rows = []
     
     right_side_rows.append(["", "📊 狀態總覽 (一年期回測)", "個股數", "D+20勝率", "D+20平均", "", "", "", ""])
-    for s in status_order:
-        t = summary_stats[s]['count']
-        w = summary_stats[s]['wins']
-        avg = summary_stats[s]['total_pct'] / t if t > 0 else 0
-        wr = (w / t * 100) if t > 0 else 0
-        right_side_rows.append(["", s, t, f"{wr:.1f}%", f"{avg:+.1f}%", "", "", "", ""])
+    count, wins, total = stats['summary']
+    for k, s in enumerate(status_order):
+        t = int(count[k])
+        right_side_rows.append(["", s, t, _fmt_rate(wins[k], t, "0.0%"), _fmt_avg(total[k], t, "+0.0%"), "", "", "", ""])
 
     right_side_rows.append([""] * 9) 
     days_header = [f"D+{i+1}" for i in range(track_days)]
 
+    count, wins, total = stats['daily']
     right_side_rows.append(["", "📈 平均漲跌幅 (每日)"] + days_header)
-    for s in status_order:
-        row_vals = ["", s]
-        for d in range(track_days):
-            data = daily_stats[s][d]
-            if data['count'] > 0:
-                avg = data['sum'] / data['count']
-                row_vals.append(f"{avg:+.1f}%")
-            else:
-                row_vals.append("-")
-        right_side_rows.append(row_vals)
+    for k, s in enumerate(status_order):
+        right_side_rows.append(["", s] + [_fmt_avg(total[k, d], count[k, d]) for d in range(track_days)])
 
     right_side_rows.append([""] * (2 + track_days)) 
 
     right_side_rows.append(["", "🏆 每日勝率 (每日)"] + days_header)
-    for s in status_order:
-        row_vals = ["", s]
-        for d in range(track_days):
-            data = daily_stats[s][d]
-            if data['count'] > 0:
-                wr = (data['wins'] / data['count']) * 100
-                row_vals.append(f"{wr:.1f}%")
-            else:
-                row_vals.append("-")
-        right_side_rows.append(row_vals)
+    for k, s in enumerate(status_order):
+        right_side_rows.append(["", s] + [_fmt_rate(wins[k, d], count[k, d]) for d in range(track_days)])
         
     right_side_rows.append([""] * (2 + track_days)) 
 
-    interval_header = ["D+5", "D+10", "D+15", "D+20"]
+    interval_header = [f"D+{cp}" for cp in interval_checkpoints]
+    count, wins, total = stats['interval']
     right_side_rows.append(["", "🏆 每5日累計勝率"] + interval_header)
-    for s in status_order:
-        row_vals = ["", s]
-        for cp in interval_checkpoints:
-            data_list = interval_data[s][cp]
-            if data_list:
-                wins = sum(1 for x in data_list if x > 0)
-                total = len(data_list)
-                wr = (wins / total * 100)
-                row_vals.append(f"{wr:.1f}%")
-            else:
-                row_vals.append("-")
-        right_side_rows.append(row_vals)
+    for k, s in enumerate(status_order):
+        right_side_rows.append(["", s] + [_fmt_rate(wins[k, j], count[k, j]) for j in range(len(interval_checkpoints))])
 
     right_side_rows.append([""] * (2 + 4))
 
     right_side_rows.append(["", "📈 每5日累計漲跌"] + interval_header)
-    for s in status_order:
-        row_vals = ["", s]
-        for cp in interval_checkpoints:
-            data_list = interval_data[s][cp]
-            if data_list:
-                avg = sum(data_list) / len(data_list)
-                row_vals.append(f"{avg:+.1f}%")
-            else:
-                row_vals.append("-")
-        right_side_rows.append(row_vals)
+    for k, s in enumerate(status_order):
+        right_side_rows.append(["", s] + [_fmt_avg(total[k, j], count[k, j]) for j in range(len(interval_checkpoints))])
 
     right_side_rows.append([""] * (2 + 4))
 
     right_side_rows.append(["", "📊 法人籌碼統計 (D+20)", "個股數", "勝率", "平均漲幅"])
-    for i in inst_order:
-        d = inst_stats_data[i]
-        t = d['count']
-        wr = (d['wins'] / t * 100) if t > 0 else 0.0
-        avg = d['total_pct'] / t if t > 0 else 0.0
-        right_side_rows.append(["", i, t, f"{wr:.1f}%", f"{avg:+.1f}%"])
+    count, wins, total = stats['inst']
+    for k, i in enumerate(inst_order):
+        t = int(count[k])
+        right_side_rows.append(["", i, t, _fmt_rate(wins[k], t, "0.0%"), _fmt_avg(total[k], t, "+0.0%")])
 
     right_side_rows.append([""] * 5)
 
@@ -853,31 +1668,19 @@ def main():
     combo_header = ["D+5勝率", "D+10勝率", "D+15勝率", "D+20勝率"]
     right_side_rows.append(["", "📊 狀態+法人 組合統計", "個股數"] + combo_header + ["D+20平均漲跌"])
     
-    for s in status_order:
-        for i in inst_order:
-            combo_key = (s, i)
-            if combo_key in combo_interval_data:
-                d = combo_interval_data[combo_key]
-                t = d['count']
-                if t > 0:
-                    display_name = f"{s} + {i}"
-                    row_vals = ["", display_name, t]
-                    
-                    # 填入區間勝率
-                    for cp in interval_checkpoints:
-                        data_list = d[cp]
-                        if data_list:
-                            wins = sum(1 for x in data_list if x > 0)
-                            wr = (wins / len(data_list) * 100)
-                            row_vals.append(f"{wr:.1f}%")
-                        else:
-                            row_vals.append("-")
-                    
-                    # 填入總平均
-                    avg = d['total_pct_sum'] / t
-                    row_vals.append(f"{avg:+.1f}%")
-                    
-                    right_side_rows.append(row_vals)
+    combo_count, combo_total = stats['combo']
+    combo_iv_count, combo_iv_wins = stats['combo_interval']
+    for ks, s in enumerate(status_order):
+        for ki, i in enumerate(inst_order):
+            t = int(combo_count[ks, ki])
+            if t > 0:
+                row_vals = ["", f"{s} + {i}", t]
+                # 填入區間勝率
+                row_vals += [_fmt_rate(combo_iv_wins[ks, ki, j], combo_iv_count[ks, ki, j])
+                             for j in range(len(interval_checkpoints))]
+                # 填入總平均
+                row_vals.append(_fmt_avg(combo_total[ks, ki], t))
+                right_side_rows.append(row_vals)
 
     # ============================
     # [新增] 月線回測統計輸出區塊
@@ -886,9 +1689,9 @@ def main():
     # ============================
     right_side_rows.append([""] * (2 + MA_TOUCH_TRACK_DAYS))
 
-    t_ma = ma_touch_total['count']
-    wr_ma_overall = (ma_touch_total['wins'] / t_ma * 100) if t_ma > 0 else 0.0
-    avg_ma_overall = ma_touch_total['total_pct'] / t_ma if t_ma > 0 else 0.0
+    t_ma, wins_ma, total_ma = stats['ma_total']
+    wr_ma_overall = (wins_ma / t_ma * 100) if t_ma > 0 else 0.0
+    avg_ma_overall = total_ma / t_ma if t_ma > 0 else 0.0
 
     ma_days_header = [f"D+{i+1}" for i in range(MA_TOUCH_TRACK_DAYS)]
 
@@ -900,32 +1703,11 @@ def main():
     right_side_rows.append(["", "計算基準：第一個符合條件當天(買進日)的收盤價，D+1 為隔日漲跌幅，往後追蹤至 D+20"])
     right_side_rows.append(["", ""] + ma_days_header)
 
-
-    # 每日平均漲跌幅
-    avg_row_ma = ["", "平均漲跌幅"]
-    for d in range(MA_TOUCH_TRACK_DAYS):
-        data = ma_touch_daily[d]
-        if data['count'] > 0:
-            avg_row_ma.append(f"{data['sum'] / data['count']:+.1f}%")
-        else:
-            avg_row_ma.append("-")
-    right_side_rows.append(avg_row_ma)
-
-    # 每日勝率
-    wr_row_ma = ["", "勝率"]
-    for d in range(MA_TOUCH_TRACK_DAYS):
-        data = ma_touch_daily[d]
-        if data['count'] > 0:
-            wr_row_ma.append(f"{data['wins'] / data['count'] * 100:.1f}%")
-        else:
-            wr_row_ma.append("-")
-    right_side_rows.append(wr_row_ma)
-
-    # 各日樣本數
-    cnt_row_ma = ["", "樣本數"]
-    for d in range(MA_TOUCH_TRACK_DAYS):
-        cnt_row_ma.append(str(ma_touch_daily[d]['count']))
-    right_side_rows.append(cnt_row_ma)
+    count, wins, total = stats['ma_daily']
+    # 每日平均漲跌幅 / 每日勝率 / 各日樣本數
+    right_side_rows.append(["", "平均漲跌幅"] + [_fmt_avg(total[0, d], count[0, d]) for d in range(MA_TOUCH_TRACK_DAYS)])
+    right_side_rows.append(["", "勝率"] + [_fmt_rate(wins[0, d], count[0, d]) for d in range(MA_TOUCH_TRACK_DAYS)])
+    right_side_rows.append(["", "樣本數"] + [str(count[0, d]) for d in range(MA_TOUCH_TRACK_DAYS)])
 
     # ============================
     # [新增] 月線斜率區間勝率統計表 (每 0.1 一組)
@@ -938,18 +1720,13 @@ def main():
     right_side_rows.append([
         "", "說明：斜率 = (今日MA20 - 昨日MA20) / 昨日MA20 × 100%，區間為無條件捨去至 0.1%"
     ])
-    for bk_key in sorted(ma_slope_buckets.keys()):
-        bk = ma_slope_buckets[bk_key]
-        t_bk = bk['count']
-        wr_d10 = (bk['wins_d10'] / t_bk * 100) if t_bk > 0 else 0.0
-        avg_d10 = bk['d10_sum'] / t_bk if t_bk > 0 else 0.0
-        wr_d20 = (bk['wins_d20'] / t_bk * 100) if t_bk > 0 else 0.0
-        avg_d20 = bk['d20_sum'] / t_bk if t_bk > 0 else 0.0
+    for bk_key, bk_count, bk_wins, bk_total in stats['ma_buckets']:
+        t_bk = int(bk_count[0])
         bk_label = f"{bk_key:.1f}%~{bk_key + 0.1:.1f}%"
         right_side_rows.append([
             "", bk_label, t_bk,
-            f"{wr_d10:.1f}%", f"{avg_d10:+.1f}%",
-            f"{wr_d20:.1f}%", f"{avg_d20:+.1f}%"
+            _fmt_rate(bk_wins[0], t_bk, "0.0%"), _fmt_avg(bk_total[0], t_bk, "+0.0%"),
+            _fmt_rate(bk_wins[1], t_bk, "0.0%"), _fmt_avg(bk_total[1], t_bk, "+0.0%")
         ])
 
     final_header = header + [""] * (3 + track_days) 
@@ -963,8 +1740,8 @@ def main():
         else: right_part = [""] * (3 + track_days)
         final_output.append(left_part + [""] + right_part)
 
-    ws_dest.clear()
-    ws_dest.update(final_output)
+    written = write_changed_rows(ws_dest, raw_rows, final_output)
+    print(f"💾 「{DEST_WORKSHEET}」更新 {written} 列 (共 {len(final_output)} 列)")
 
     print("🎨 更新條件格式化...")
     ranges = [
@@ -972,49 +1749,35 @@ def main():
         {"sheetId": ws_dest.id, "startRowIndex": 1, "startColumnIndex": 29, "endColumnIndex": 60}
     ]
 
-    header_rule = {
-        "addConditionalFormatRule": {
-            "rule": {
-                "ranges": ranges,
-                "booleanRule": {
-                    "condition": {"type": "TEXT_STARTS_WITH", "values": [{"userEnteredValue": "D+"}]},
-                    "format": {
-                        "backgroundColor": {"red": 1.0, "green": 0.9, "blue": 0.7}, 
-                        "textFormat": {"bold": True}
-                    }
+    dest_rules = [
+        {
+            "ranges": ranges,
+            "booleanRule": {
+                "condition": {"type": "TEXT_STARTS_WITH", "values": [{"userEnteredValue": "D+"}]},
+                "format": {
+                    "backgroundColor": {"red": 1.0, "green": 0.9, "blue": 0.7}, 
+                    "textFormat": {"bold": True}
                 }
-            },
-            "index": 0 
-        }
-    }
-
-    positive_rule = {
-        "addConditionalFormatRule": {
-            "rule": {
-                "ranges": ranges,
-                "booleanRule": {
-                    "condition": {"type": "TEXT_CONTAINS", "values": [{"userEnteredValue": "+"}]},
-                    "format": {"backgroundColor": {"red": 1.0, "green": 0.8, "blue": 0.8}}
-                }
-            },
-            "index": 1
-        }
-    }
-
-    negative_rule = {
-        "addConditionalFormatRule": {
-            "rule": {
-                "ranges": ranges,
-                "booleanRule": {
-                    "condition": {"type": "TEXT_CONTAINS", "values": [{"userEnteredValue": "-"}]},
-                    "format": {"backgroundColor": {"red": 0.8, "green": 1.0, "blue": 0.8}}
-                }
-            },
-            "index": 2
-        }
-    }
+            }
+        },
+        {
+            "ranges": ranges,
+            "booleanRule": {
+                "condition": {"type": "TEXT_CONTAINS", "values": [{"userEnteredValue": "+"}]},
+                "format": {"backgroundColor": {"red": 1.0, "green": 0.8, "blue": 0.8}}
+            }
+        },
+        {
+            "ranges": ranges,
+            "booleanRule": {
+                "condition": {"type": "TEXT_CONTAINS", "values": [{"userEnteredValue": "-"}]},
+                "format": {"backgroundColor": {"red": 0.8, "green": 1.0, "blue": 0.8}}
+            }
+        },
+    ]
 
-    requests = [header_rule, positive_rule, negative_rule]
+    # 既有條件格式整批取代 (不再每次執行疊加)
+    requests = replace_conditional_rules(sh, ws_dest, dest_rules)
 
     win_rate_start_row = -1
     for idx, row in enumerate(final_output):
@@ -1025,6 +1788,21 @@ def main():
     if win_rate_start_row != -1:
         start_col = 31 
         end_col = 31 + track_days
+        # 先清掉上次的最高/最低底色，再把相鄰同色儲存格合併成範圍請求
+        requests.append({
+            "repeatCell": {
+                "range": {
+                    "sheetId": ws_dest.id,
+                    "startRowIndex": win_rate_start_row + 1,
+                    "endRowIndex": win_rate_start_row + 1 + len(status_order),
+                    "startColumnIndex": start_col,
+                    "endColumnIndex": end_col
+                },
+                "cell": {"userEnteredFormat": {}},
+                "fields": "userEnteredFormat.backgroundColor"
+            }
+        })
+        highlight = {}
         for col_idx in range(start_col, end_col): 
             col_values = []
             valid_rows = []
@@ -1050,23 +1828,12 @@ def main():
                     if val == max_val: bg_color = {"red": 1.0, "green": 0.8, "blue": 0.8} 
                     elif val == min_val: bg_color = {"red": 0.8, "green": 1.0, "blue": 0.8} 
                     if bg_color:
-                        req = {
-                            "repeatCell": {
-                                "range": {
-                                    "sheetId": ws_dest.id,
-                                    "startRowIndex": valid_rows[i],
-                                    "endRowIndex": valid_rows[i] + 1,
-                                    "startColumnIndex": col_idx,
-                                    "endColumnIndex": col_idx + 1
-                                },
-                                "cell": {"userEnteredFormat": {"backgroundColor": bg_color}},
-                                "fields": "userEnteredFormat.backgroundColor"
-                            }
-                        }
-                        requests.append(req)
+                        highlight[(valid_rows[i], col_idx)] = {"backgroundColor": bg_color}
+        requests += coalesce_cell_formats(ws_dest.id, highlight, "userEnteredFormat.backgroundColor")
 
     try:
-        sh.batch_update({"requests": requests})
+        if requests:
+            sh.batch_update({"requests": requests})
     except Exception as e:
         print(f"⚠️ 格式化設定失敗 (可能是權限或版本問題): {e}")
 
@@ -1082,35 +1849,30 @@ def main():
 
     try:
         ws_ma_detail = sh.worksheet(MA_TOUCH_DETAIL_WORKSHEET)
-        ws_ma_detail.clear()
     except WorksheetNotFound:
         print(f"💡 工作表 '{MA_TOUCH_DETAIL_WORKSHEET}' 不存在，正在建立...")
         ws_ma_detail = sh.add_worksheet(title=MA_TOUCH_DETAIL_WORKSHEET, rows=5000, cols=len(ma_detail_header) + 5)
 
     # 按出關日期降冪排序
-    ma_detail_list.sort(key=lambda x: x[0], reverse=True)
+    ma_detail_list.sort(key=lambda x: x[0][0], reverse=True)
+    ma_matrix = np.array([m for _, _, m in ma_detail_list], dtype=float).reshape(-1, 20)
 
     # ============================
     # [新增] 每支股票 D+1~D+20 累積漲跌幅，附加在每列最後
+    # 由 D+1 起連續有資料的天數複利累積 (遇到空格就停止)
     # ============================
-    for row in ma_detail_list:
-        compound = 1.0
-        has_data = False
-        for d in range(20):
-            col_idx = 8 + d  # D+1 在 index 8
-            if col_idx < len(row) and row[col_idx] != "":
-                try:
-                    r = float(str(row[col_idx]).replace('%', '').replace('+', ''))
-                    compound *= (1 + r / 100)
-                    has_data = True
-                except:
-                    break
-            else:
-                break  # 遇到空格就停止（後面也沒有資料）
-        if has_data:
-            row.append(f"{(compound - 1) * 100:+.1f}%")
-        else:
-            row.append("")
+    lead_valid = np.cumprod(~np.isnan(ma_matrix), axis=1).astype(bool)   # D+1~D+N 皆有資料
+    ma_compound = compound_returns(ma_matrix)
+    n_lead = lead_valid.sum(axis=1)
+    row_cum = ma_compound[np.arange(len(ma_matrix)), np.maximum(n_lead - 1, 0)]
+
+    detail_rows = []
+    for (base_cols, slope, returns), n_valid, cum in zip(ma_detail_list, n_lead, row_cum):
+        detail_rows.append(
+            list(base_cols) + [f"{slope:+.4f}%"]                # 買進日 MA20 斜率(%)
+            + [fmt_pct(v) for v in returns]                      # D+1~D+20
+            + [fmt_pct(cum) if n_valid > 0 else ""]              # D+1~D+20累積
+        )
 
     # ============================
     # [新增] 摘要統計列（放在所有個股資料下方）
@@ -1119,57 +1881,19 @@ def main():
     # 賺錢股平均：D+N 當天 > 0 的股票平均
     # 賠錢股平均：D+N 當天 < 0 的股票平均
     # ============================
-    win_rate_row     = ["", "勝率(以買進日累積)",     "", "", "", "", "", ""]
-    avg_return_row   = ["", "平均漲跌幅(當日)",       "", "", "", "", "", ""]
-    avg_win_row      = ["", "賺錢股平均漲跌幅",       "", "", "", "", "", ""]
-    avg_lose_row     = ["", "賠錢股平均漲跌幅",       "", "", "", "", "", ""]
-
-    for day_idx in range(20):
-        col_idx = 8 + day_idx  # D+(day_idx+1) 所在欄位
-
-        # 1. 勝率：累積到第 day_idx+1 天的複利報酬 > 0
-        cum_rets = []
-        for row in ma_detail_list:
-            cmp = 1.0
-            valid = True
-            for d in range(day_idx + 1):
-                ci = 8 + d
-                if ci < len(row) and row[ci] != "":
-                    try:
-                        r = float(str(row[ci]).replace('%', '').replace('+', ''))
-                        cmp *= (1 + r / 100)
-                    except:
-                        valid = False; break
-                else:
-                    valid = False; break
-            if valid:
-                cum_rets.append((cmp - 1) * 100)
-
-        if cum_rets:
-            wins = sum(1 for x in cum_rets if x > 0)
-            win_rate_row.append(f"{wins / len(cum_rets) * 100:.1f}%")
-        else:
-            win_rate_row.append("-")
-
-        # 2. 平均漲跌幅（當日 D+N 那格的值）
-        daily_vals = []
-        for row in ma_detail_list:
-            if col_idx < len(row) and row[col_idx] != "":
-                try:
-                    daily_vals.append(float(str(row[col_idx]).replace('%', '').replace('+', '')))
-                except:
-                    pass
-
-        if daily_vals:
-            avg_return_row.append(f"{sum(daily_vals) / len(daily_vals):+.1f}%")
-        else:
-            avg_return_row.append("-")
-
-        # 3. 賺錢股平均 / 賠錢股平均（當日）
-        pos_vals = [v for v in daily_vals if v > 0]
-        neg_vals = [v for v in daily_vals if v < 0]
-        avg_win_row.append(f"{sum(pos_vals) / len(pos_vals):+.1f}%" if pos_vals else "-")
-        avg_lose_row.append(f"{sum(neg_vals) / len(neg_vals):+.1f}%" if neg_vals else "-")
+    ma_valid = ~np.isnan(ma_matrix)
+    filled = np.where(ma_valid, ma_matrix, 0.0)
+    cum_count = lead_valid.sum(axis=0)
+    cum_wins = (lead_valid & (ma_compound > 0)).sum(axis=0)
+    day_count, day_sum = ma_valid.sum(axis=0), filled.sum(axis=0)
+    pos, neg = filled > 0, filled < 0
+    pos_count, pos_sum = pos.sum(axis=0), np.where(pos, filled, 0.0).sum(axis=0)
+    neg_count, neg_sum = neg.sum(axis=0), np.where(neg, filled, 0.0).sum(axis=0)
+
+    win_rate_row     = ["", "勝率(以買進日累積)",     "", "", "", "", "", ""] + [_fmt_rate(cum_wins[d], cum_count[d]) for d in range(20)]
+    avg_return_row   = ["", "平均漲跌幅(當日)",       "", "", "", "", "", ""] + [_fmt_avg(day_sum[d], day_count[d]) for d in range(20)]
+    avg_win_row      = ["", "賺錢股平均漲跌幅",       "", "", "", "", "", ""] + [_fmt_avg(pos_sum[d], pos_count[d]) for d in range(20)]
+    avg_lose_row     = ["", "賠錢股平均漲跌幅",       "", "", "", "", "", ""] + [_fmt_avg(neg_sum[d], neg_count[d]) for d in range(20)]
 
     # 摘要列最後補「D+1~D+20累積」欄對齊（空白）
     win_rate_row.append("")
@@ -1179,12 +1903,12 @@ def main():
 
     ma_detail_output = (
         [ma_detail_header]
-        + ma_detail_list
+        + detail_rows
         + [[""]]  # 空行分隔
         + [win_rate_row, avg_return_row, avg_win_row, avg_lose_row]
     )
-    ws_ma_detail.update(ma_detail_output, value_input_option="RAW")
-    print(f"✅ 已寫入 {len(ma_detail_list)} 筆個股明細至「{MA_TOUCH_DETAIL_WORKSHEET}」")
+    written = write_changed_rows(ws_ma_detail, ma_detail_values, ma_detail_output)
+    print(f"✅ 已寫入 {len(ma_detail_list)} 筆個股明細至「{MA_TOUCH_DETAIL_WORKSHEET}」(實際更新 {written} 列)")
 
     # 條件格式化：D+1~D+20 正值紅底、負值綠底 (與主工作表相同配色)
     if len(ma_detail_list) > 0:
@@ -1203,36 +1927,37 @@ def main():
                     "endColumnIndex": 29     # D+20 (index=27) + D+1~D+20累積 (index=28)
                 }
             ]
-            detail_positive_rule = {
-                "addConditionalFormatRule": {
-                    "rule": {
-                        "ranges": detail_ranges,
-                        "booleanRule": {
-                            "condition": {"type": "TEXT_CONTAINS", "values": [{"userEnteredValue": "+"}]},
-                            "format": {"backgroundColor": {"red": 1.0, "green": 0.8, "blue": 0.8}}
-                        }
-                    },
-                    "index": 0
-                }
-            }
-            detail_negative_rule = {
-                "addConditionalFormatRule": {
-                    "rule": {
-                        "ranges": detail_ranges,
-                        "booleanRule": {
-                            "condition": {"type": "TEXT_CONTAINS", "values": [{"userEnteredValue": "-"}]},
-                            "format": {"backgroundColor": {"red": 0.8, "green": 1.0, "blue": 0.8}}
-                        }
-                    },
-                    "index": 1
-                }
-            }
-            sh.batch_update({"requests": [detail_positive_rule, detail_negative_rule]})
+            detail_rules = [
+                {
+                    "ranges": detail_ranges,
+                    "booleanRule": {
+                        "condition": {"type": "TEXT_CONTAINS", "values": [{"userEnteredValue": "+"}]},
+                        "format": {"backgroundColor": {"red": 1.0, "green": 0.8, "blue": 0.8}}
+                    }
+                },
+                {
+                    "ranges": detail_ranges,
+                    "booleanRule": {
+                        "condition": {"type": "TEXT_CONTAINS", "values": [{"userEnteredValue": "-"}]},
+                        "format": {"backgroundColor": {"red": 0.8, "green": 1.0, "blue": 0.8}}
+                    }
+                },
+            ]
+            detail_requests = replace_conditional_rules(sh, ws_ma_detail, detail_rules)
+            if detail_requests:
+                sh.batch_update({"requests": detail_requests})
         except Exception as e:
             print(f"⚠️ 月線明細格式化設定失敗: {e}")
 
+    save_event_table(event_rows, track_days)
+
+    close_institutional_driver()
+    close_inst_store()
     print(f"🎉 完成！共掃描 {total_count} 筆，本次更新 {update_count} 筆。")
-    print(f"📈 月線回測命中統計：共 {ma_touch_total['count']} 筆符合條件，整體勝率 {wr_ma_overall:.1f}%，D+10累積平均 {avg_ma_overall:+.1f}%")
+    print(f"📈 月線回測命中統計：共 {t_ma} 筆符合條件，整體勝率 {wr_ma_overall:.1f}%，D+10累積平均 {avg_ma_overall:+.1f}%")
 
 if __name__ == "__main__":
-    main()
+    if RELEASE_BACKTEST_MODE == "sweep":
+        run_parameter_sweep()
+    else:
+        main()